@@ -12,6 +12,7 @@ from theano.compile.mode import get_default_mode
 
 # Local imports
 from pylearn2.utils import subdict
+from pylearn2.utils.function_cache import function
 
 theano.config.warn.sum_div_dimshuffle_bug = False
 
@@ -82,10 +83,10 @@ class Block(object):
         """ Returns a compiled theano function to compute a representation """
         inputs = tensor.matrix()
         if self.cpu_only:
-            return theano.function([inputs], self(inputs), name=name,
-                                   mode=get_default_mode().excluding('gpu'))
+            return function([inputs], self(inputs), name=name,
+                            mode=get_default_mode().excluding('gpu'))
         else:
-            return theano.function([inputs], self(inputs), name=name)
+            return function([inputs], self(inputs), name=name)
 
     def perform(self, X):
         if self.fn is None:
@@ -165,7 +166,7 @@ class StackedBlocks(Block):
         else:
             inputs = tensor.matrix()
 
-        return theano.function(
+        return function(
                 [inputs],
                 outputs=self(inputs)[repr_index],
                 name=name)
@@ -186,7 +187,7 @@ class StackedBlocks(Block):
             the concatenation. We must have start_index < end_index.
         """
         inputs = tensor.matrix()
-        return theano.function([inputs],
+        return function([inputs],
             outputs=tensor.concatenate(self(inputs)[start_index:end_index]),
             name=name)
 
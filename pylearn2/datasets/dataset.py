@@ -33,8 +33,10 @@ class Dataset(object):
         Parameters
         ----------
         mode : str or object, optional
-            One of 'sequential', 'random_slice', or 'random_uniform',
-            *or* a class that instantiates an iterator that returns
+            One of 'sequential', 'random_slice', 'random_uniform' or
+            'shuffled_chunks' (see
+            `pylearn2.utils.iteration.ShuffledChunkSubsetIterator`, for
+            data that does not fit in memory), *or* a class that instantiates an iterator that returns
             slices or index sequences on every call to next().
         batch_size : int, optional
             The size of an individual batch. Unnecessary if `mode` is
@@ -60,7 +62,7 @@ class Dataset(object):
         raise NotImplementedError()
 
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 topo=None, rng=None):
+                 topo=None, rng=None, num_buffers=0):
         """
         Return an iterator for this dataset with the specified
         behaviour. Unspecified values are filled-in by the default.
@@ -68,8 +70,10 @@ class Dataset(object):
         Parameters
         ----------
         mode : str or object, optional
-            One of 'sequential', 'random_slice', or 'random_uniform',
-            *or* a class that instantiates an iterator that returns
+            One of 'sequential', 'random_slice', 'random_uniform' or
+            'shuffled_chunks' (see
+            `pylearn2.utils.iteration.ShuffledChunkSubsetIterator`, for
+            data that does not fit in memory), *or* a class that instantiates an iterator that returns
             slices or index sequences on every call to next().
         batch_size : int, optional
             The size of an individual batch. Unnecessary if `mode` is
@@ -92,6 +96,13 @@ class Dataset(object):
             through the dataset and may potentially be shared by
             multiple iterator objects simultaneously (see "Notes"
             below).
+        num_buffers : int, optional
+            If 1 or 2, the iterator assembles batches into that many
+            reusable buffers instead of allocating a new array for
+            every batch. A returned batch is then only valid until
+            `num_buffers` further calls to `next()`; see
+            `pylearn2.utils.iteration.FiniteDatasetIterator`. Defaults
+            to 0 (a new array for every batch).
 
         Returns
         -------
@@ -67,6 +67,8 @@ class DenseDesignMatrix(Dataset):
         self.y = y
         self.compress = False
         self.design_loc = None
+        self.design_mmap_mode = None
+        self.targets_loc = None
         if hasattr(rng, 'random_integers'):
             self.rng = rng
         else:
@@ -99,7 +101,7 @@ class DenseDesignMatrix(Dataset):
 
     @functools.wraps(Dataset.iterator)
     def iterator(self, mode=None, batch_size=None, num_batches=None,
-                 topo=None, targets=None, rng=None):
+                 topo=None, targets=None, rng=None, num_buffers=0):
         # TODO: Refactor, deduplicate with set_iteration_scheme
         if mode is None:
             if hasattr(self, '_iter_subset_class'):
@@ -122,19 +124,32 @@ class DenseDesignMatrix(Dataset):
         return FiniteDatasetIterator(self,
                                      mode(self.X.shape[0], batch_size,
                                      num_batches, rng),
-                                     topo, targets)
+                                     topo, targets, num_buffers)
 
-    def use_design_loc(self, path):
+    def use_design_loc(self, path, mmap_mode=None, targets_path=None):
         """
         When pickling, save the design matrix to path as a .npy file rather
         than pickling the design matrix along with the rest of the dataset
         object. This avoids pickle's unfortunate behavior of using 2X the RAM
         when unpickling.
 
+        If `mmap_mode` is given (see `numpy.load`), the unpickled dataset
+        memory-maps the file instead of reading it into RAM: batches are
+        read from disk and cast to floatX one at a time, and several
+        processes that load the same dataset share the operating system's
+        page cache instead of each holding a private copy. A design matrix
+        that is still the map of `path` is not written again on later
+        pickles.
+
+        If `targets_path` is given, the targets are stored in (and mapped
+        from) that .npy file the same way.
+
         TODO: Get rid of this logic, use custom array-aware picklers (joblib,
         custom pylearn2 serialization format).
         """
         self.design_loc = path
+        self.design_mmap_mode = mmap_mode
+        self.targets_loc = targets_path
 
     def enable_compression(self):
         """
@@ -162,22 +177,83 @@ class DenseDesignMatrix(Dataset):
             rval['X'] *= 255. / rval['compress_max']
             rval['X'] = N.cast['uint8'](rval['X'])
 
+        # Memory maps belong to this process; they are recreated from the
+        # files when unpickling.
+        design_map = rval.pop('_design_map', None)
+        targets_map = rval.pop('_targets_map', None)
+
+        # Arrays mapped from source files that belong to the user (see
+        # NpyDataset) are pickled as the names of the files as long as
+        # they are still those maps, and inline once they have been
+        # replaced. The source files are never written.
+        design_source_map = rval.pop('_design_source_map', None)
+        targets_source_map = rval.pop('_targets_source_map', None)
+        # A design_loc given explicitly takes precedence.
+        if rval.get('design_source') is not None:
+            if self.design_loc is None and rval['X'] is design_source_map:
+                del rval['X']
+            else:
+                rval['design_source'] = None
+        if rval.get('targets_source') is not None:
+            if (getattr(self, 'targets_loc', None) is None and
+                    rval['y'] is targets_source_map):
+                del rval['y']
+            else:
+                rval['targets_source'] = None
+
         if self.design_loc is not None:
             # TODO: Get rid of this logic, use custom array-aware picklers
             # (joblib, custom pylearn2 serialization format).
-            N.save(self.design_loc, rval['X'])
+            # Writing the array over the file it is mapped from would
+            # destroy it, and is useless anyway.
+            if rval['X'] is not design_map:
+                N.save(self.design_loc, rval['X'])
             del rval['X']
 
+        if getattr(self, 'targets_loc', None) is not None:
+            if rval['y'] is not targets_map:
+                N.save(self.targets_loc, rval['y'])
+            del rval['y']
+
         return rval
 
     def __setstate__(self, d):
 
+        # Datasets pickled before memory-mapping was supported lack these.
+        mmap_mode = d.setdefault('design_mmap_mode', None)
+        d.setdefault('targets_loc', None)
+
+        source_mmap_mode = d.get('source_mmap_mode')
+        if d.get('design_source') is not None:
+            if control.get_load_data():
+                d['X'] = N.load(d['design_source'], mmap_mode=source_mmap_mode)
+                d['_design_source_map'] = d['X']
+            else:
+                d['X'] = None
+        if d.get('targets_source') is not None:
+            if control.get_load_data():
+                d['y'] = N.load(d['targets_source'],
+                                mmap_mode=source_mmap_mode)
+                d['_targets_source_map'] = d['y']
+            else:
+                d['y'] = None
+
         if d['design_loc'] is not None:
             if control.get_load_data():
-                d['X'] = N.load(d['design_loc'])
+                d['X'] = N.load(d['design_loc'], mmap_mode=mmap_mode)
+                if mmap_mode is not None and not d['compress']:
+                    d['_design_map'] = d['X']
             else:
                 d['X'] = None
 
+        if d['targets_loc'] is not None:
+            if control.get_load_data():
+                d['y'] = N.load(d['targets_loc'], mmap_mode=mmap_mode)
+                if mmap_mode is not None:
+                    d['_targets_map'] = d['y']
+            else:
+                d['y'] = None
+
         if d['compress']:
             X = d['X']
             mx = d['compress_max']
@@ -393,7 +469,9 @@ class DenseDesignMatrix(Dataset):
 
     def set_design_matrix(self, X):
         assert len(X.shape) == 2
-        assert not N.any(N.isnan(X))
+        # min propagates NaNs, and unlike isnan doesn't allocate a
+        # temporary as large as X (which may be memory-mapped)
+        assert not N.isnan(X.min())
         self.X = X
 
     def get_targets(self):
@@ -1,12 +1,13 @@
 """Objects for datasets serialized in the NumPy native format (.npy/.npz)."""
 import functools
+import warnings
 import numpy
 from theano import config
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 
 class NpyDataset(DenseDesignMatrix):
     """A dense dataset based on a single array stored as a .npy file."""
-    def __init__(self, file, mmap_mode=None):
+    def __init__(self, file, mmap_mode=None, targets=None):
         """
         Creates an NpzDataset object.
 
@@ -18,21 +19,54 @@ class NpyDataset(DenseDesignMatrix):
         mmap_mode : str, optional
             Memory mapping options for memory-mapping an array on disk,
             rather than loading it into memory. See the `numpy.load`
-            docstring for details.
+            docstring for details. Only 2-dimensional arrays (design
+            matrices) can be used in place; topological views are
+            converted to a design matrix in memory. When `file` is a
+            filename, pickling the dataset only records the filename,
+            and unpickling maps the file again, as long as the design
+            matrix is the map of the file (i.e. it has not been replaced,
+            e.g. by a preprocessor). The file itself is never written.
+        targets : file-like object or str, optional
+            A .npy file containing the targets, loaded (or mapped) in the
+            same way as `file`.
         """
         self._path = file
+        self._targets_path = targets
+        self._mmap_mode = mmap_mode
         self._loaded = False
 
     def _deferred_load(self):
         self._loaded = True
-        loaded = numpy.load(self._path)
+        # Pickles made before mmap_mode was honoured lack these.
+        mmap_mode = getattr(self, '_mmap_mode', None)
+        targets_path = getattr(self, '_targets_path', None)
+        loaded = numpy.load(self._path, mmap_mode=mmap_mode)
         assert isinstance(loaded, numpy.ndarray), (
             "single arrays (.npy) only"
         )
+        if targets_path is not None:
+            y = numpy.load(targets_path, mmap_mode=mmap_mode)
+        else:
+            y = None
         if len(loaded.shape) == 2:
-            super(NpyDataset, self).__init__(X=loaded)
+            super(NpyDataset, self).__init__(X=loaded, y=y)
         else:
-            super(NpyDataset, self).__init__(topo_view=loaded)
+            if mmap_mode is not None:
+                warnings.warn("%s is a topological view, it will be "
+                              "converted to a design matrix in memory "
+                              "rather than memory-mapped" % str(self._path))
+            super(NpyDataset, self).__init__(topo_view=loaded, y=y)
+        if mmap_mode is not None:
+            # Pickle the file names rather than the arrays, as long as they
+            # are still the maps of the files. The files are never written:
+            # see DenseDesignMatrix.__getstate__.
+            self.source_mmap_mode = mmap_mode
+            if len(loaded.shape) == 2 and isinstance(self._path, basestring):
+                self.design_source = self._path
+                self._design_source_map = loaded
+            if isinstance(targets_path, basestring):
+                self.targets_source = targets_path
+                self._targets_source_map = y
 
     @functools.wraps(DenseDesignMatrix.get_design_matrix)
     def get_design_matrix(self, topo=None):
@@ -54,6 +88,17 @@ class NpyDataset(DenseDesignMatrix):
             self._deferred_load()
         return super(NpyDataset, self).iterator(*args, **kwargs)
 
+    def __getstate__(self):
+        if not self._loaded:
+            return dict(self.__dict__)
+        return super(NpyDataset, self).__getstate__()
+
+    def __setstate__(self, d):
+        if not d['_loaded']:
+            self.__dict__.update(d)
+        else:
+            super(NpyDataset, self).__setstate__(d)
+
 
 class NpzDataset(DenseDesignMatrix):
     """A dense dataset based on a single array from a .npz archive."""
@@ -0,0 +1,216 @@
+"""
+A dataset wrapper that assembles minibatches on a background thread, so
+that batch assembly (fancy indexing, casting, view conversion) overlaps
+with whatever the caller does with the previous batch.
+"""
+import Queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+from pylearn2.datasets.dataset import Dataset
+
+# Blocking Queue.get() calls without a timeout can't be interrupted with
+# Ctrl-C in python 2, so we poll with this timeout instead.
+_POLL_INTERVAL = 1.
+
+
+class PrefetchingDataset(Dataset):
+    """
+    Wraps a dataset and draws the next few minibatches from it on a worker
+    thread while the caller is busy with the current one (typically running
+    a theano update, which releases the GIL).
+
+    Batches are copied into a bounded ring of `depth + 1` preallocated
+    buffers, so memory use does not grow with the number of batches drawn.
+    A batch returned by `get_batch_design` or `get_batch_topo` is only
+    valid until the next call to either method: at that point its buffer
+    is handed back to the worker to be refilled. Callers that need to keep
+    a batch around must copy it.
+
+    The batches returned are exactly the ones the wrapped dataset would
+    have returned to the same sequence of calls, but the wrapped dataset
+    is read up to `depth` batches ahead, so its own random stream is
+    ahead of what the caller has consumed. Use `get_stream_position` on
+    the wrapper rather than on the wrapped dataset.
+
+    Only one batch size and one view (design matrix or topological) is
+    prefetched at a time. Asking for a different one discards the
+    prefetched batches and restarts the worker. Closing the wrapper or
+    discarding prefetched batches rewinds the wrapped dataset's stream to
+    just after the last batch handed to the caller, if the wrapped dataset
+    supports `set_stream_position`; otherwise the discarded batches are
+    lost.
+
+    The time the caller spent blocked waiting for the worker is
+    accumulated in `stall_time` (in seconds).
+    """
+    def __init__(self, raw, depth=2):
+        """
+        Parameters
+        ----------
+        raw : object
+            The Dataset to draw batches from.
+        depth : int, optional
+            Number of batches to assemble ahead of the one currently held
+            by the caller.
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1, got " + str(depth))
+        self.raw = raw
+        self.depth = int(depth)
+        self.stall_time = 0.
+        self._reset()
+
+    def _reset(self):
+        self._key = None
+        self._worker = None
+        self._free = None
+        self._filled = None
+        self._held = None
+        self._buffers = None
+        self._position = None
+
+    def _start(self, batch_size, topo):
+        track_position = hasattr(self.raw, 'get_stream_position')
+        if track_position:
+            self._position = self.raw.get_stream_position()
+        self._key = (batch_size, topo)
+        self._buffers = [None] * (self.depth + 1)
+        self._free = Queue.Queue()
+        self._filled = Queue.Queue()
+        for slot in xrange(len(self._buffers)):
+            self._free.put(slot)
+        self._worker = threading.Thread(target=self._produce,
+                                        args=(batch_size, topo,
+                                              track_position,
+                                              self._free, self._filled))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _produce(self, batch_size, topo, track_position, free, filled):
+        while True:
+            slot = free.get()
+            if slot is None:
+                return
+            try:
+                if topo:
+                    batch = self.raw.get_batch_topo(batch_size)
+                else:
+                    batch = self.raw.get_batch_design(batch_size)
+                buf = self._buffers[slot]
+                if (buf is None or buf.shape != batch.shape or
+                        buf.dtype != batch.dtype):
+                    buf = np.empty(batch.shape, dtype=batch.dtype)
+                    self._buffers[slot] = buf
+                buf[...] = batch
+                if track_position:
+                    position = self.raw.get_stream_position()
+                else:
+                    position = None
+            except Exception:
+                filled.put((slot, None, sys.exc_info()))
+                return
+            filled.put((slot, position, None))
+
+    def close(self):
+        """
+        Stops the worker thread, discards any prefetched batches and
+        rewinds the wrapped dataset's stream to just after the last batch
+        handed to the caller.
+        """
+        if self._worker is not None:
+            self._free.put(None)
+            self._worker.join()
+            if self._position is not None:
+                self.raw.set_stream_position(self._position)
+        self._reset()
+
+    def _get_batch(self, batch_size, topo):
+        if self._key != (batch_size, topo):
+            self.close()
+            self._start(batch_size, topo)
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+        wait_start = time.time()
+        while True:
+            try:
+                slot, position, exc_info = self._filled.get(True,
+                                                            _POLL_INTERVAL)
+                break
+            except Queue.Empty:
+                pass
+        self.stall_time += time.time() - wait_start
+        if exc_info is not None:
+            self.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._held = slot
+        self._position = position
+        return self._buffers[slot]
+
+    def get_batch_design(self, batch_size):
+        return self._get_batch(batch_size, False)
+
+    def get_batch_topo(self, batch_size):
+        return self._get_batch(batch_size, True)
+
+    def get_stream_position(self):
+        """
+        Returns the position of the wrapped dataset's stream just after
+        the last batch handed to the caller, ignoring prefetched batches.
+        """
+        if self._key is None:
+            return self.raw.get_stream_position()
+        return self._position
+
+    def set_stream_position(self, pos):
+        self.close()
+        self.raw.set_stream_position(pos)
+
+    def restart_stream(self):
+        self.close()
+        self.raw.restart_stream()
+
+    def set_iteration_scheme(self, mode=None, batch_size=None,
+                             num_batches=None, topo=False):
+        self.raw.set_iteration_scheme(mode, batch_size, num_batches, topo)
+
+    def iterator(self, mode=None, batch_size=None, num_batches=None,
+                 topo=None, rng=None, num_buffers=0):
+        kwargs = {}
+        if num_buffers > 0:
+            # Not every dataset supports this argument.
+            kwargs['num_buffers'] = num_buffers
+        return self.raw.iterator(mode=mode, batch_size=batch_size,
+                                 num_batches=num_batches, topo=topo, rng=rng,
+                                 **kwargs)
+
+    def __getattr__(self, name):
+        # Everything else (get_design_matrix, view_shape, ...) is read
+        # straight from the wrapped dataset.
+        if name == 'raw':
+            raise AttributeError(name)
+        return getattr(self.raw, name)
+
+    def __getstate__(self):
+        rval = dict(self.__dict__)
+        for key in ['_key', '_worker', '_free', '_filled', '_held',
+                    '_buffers', '_position']:
+            rval[key] = None
+        return rval
+
+
+def get_prefetcher(dataset, prefetcher, depth):
+    """
+    Returns a PrefetchingDataset wrapping `dataset`, reusing `prefetcher`
+    if it already wraps it (so batches it has already drawn are not lost)
+    and closing it otherwise.
+    """
+    if prefetcher is not None:
+        if prefetcher.raw is dataset and prefetcher.depth == depth:
+            return prefetcher
+        prefetcher.close()
+    return PrefetchingDataset(dataset, depth)
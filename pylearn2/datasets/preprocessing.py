@@ -1,18 +1,225 @@
 import warnings
 import copy
+import cPickle
+import hashlib
+import os
+import shutil
+import tempfile
 import numpy as np
 from scipy import linalg
 from theano import function
+from theano.compile import SharedVariable
+from theano.compile.function_module import Function
+from theano.gof import Variable
 import theano.tensor as T
 
+def _row_blocks(num_rows, batch_size):
+    """ Yields slices covering range(num_rows), batch_size rows at a time.
+        A batch_size of None gives a single slice. """
+    if batch_size is None:
+        batch_size = max(num_rows, 1)
+    for start in xrange(0, num_rows, batch_size):
+        yield slice(start, min(start + batch_size, num_rows))
+
+def _output_like(X, output_path):
+    """ Returns X itself if output_path is None, otherwise a new .npy file
+        memory-mapped at output_path with the same shape and dtype as X. """
+    if output_path is None:
+        return X
+    return np.lib.format.open_memmap(output_path, mode = 'w+',
+            dtype = X.dtype, shape = X.shape)
+
+def _dataset_fingerprint(dataset, batch_size = 10000):
+    """ Returns a hash of the design matrix and view converter of a
+        DenseDesignMatrix. The design matrix is hashed batch_size rows at
+        a time so that memory-mapped data is not copied into memory. """
+    X = dataset.get_design_matrix()
+    h = hashlib.sha1()
+    h.update(dataset.__class__.__name__)
+    h.update(str(X.dtype) + str(X.shape))
+    for block in _row_blocks(X.shape[0], batch_size):
+        h.update(np.ascontiguousarray(X[block]).tostring())
+    _update_hash(h, getattr(dataset, 'view_converter', None))
+    return h.hexdigest()
+
+def _update_hash(h, obj):
+    """ Feeds a description of obj to the hash object h. Unlike a pickle,
+        the description does not depend on dictionary order or on the
+        automatically generated names of theano variables. """
+    if isinstance(obj, dict):
+        h.update('dict' + str(len(obj)))
+        for key in sorted(obj):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(obj.__class__.__name__ + str(len(obj)))
+        for elem in obj:
+            _update_hash(h, elem)
+    elif isinstance(obj, np.ndarray):
+        h.update(str(obj.dtype) + str(obj.shape))
+        h.update(np.ascontiguousarray(obj).tostring())
+    elif isinstance(obj, np.random.RandomState):
+        _update_hash(h, obj.get_state())
+    elif isinstance(obj, SharedVariable):
+        _update_hash(h, obj.get_value(borrow = True))
+    elif isinstance(obj, (Variable, Function)):
+        # Symbolic variables and compiled functions are built from the
+        # other parameters.
+        h.update(obj.__class__.__name__)
+    elif hasattr(obj, '__dict__'):
+        h.update(obj.__class__.__module__ + '.' + obj.__class__.__name__)
+        _update_hash(h, obj.__dict__)
+    else:
+        h.update(repr(obj))
+
+def _patch_view(X, patch_shape, patch_stride):
+    """ Returns a read-only view of the batch of images X (examples, topological
+        dimensions..., channels) with shape
+        (examples, grid positions per topological dimension...,
+        patch shape..., channels), such that
+        view[n, i, j, ...] is the patch of X[n] whose corner is at
+        (i * patch_stride[0], j * patch_stride[1], ...). """
+    X = np.asarray(X)
+    grid_shape = []
+    grid_strides = []
+    for data_width, patch_width, stride, byte_stride in zip(X.shape[1:-1],
+            patch_shape, patch_stride, X.strides[1:-1]):
+        if stride == 0:
+            num_positions = 1
+        else:
+            num_positions = (data_width - patch_width) / stride + 1
+        grid_shape.append(num_positions)
+        grid_strides.append(stride * byte_stride)
+    shape = [X.shape[0]] + grid_shape + list(patch_shape) + [X.shape[-1]]
+    strides = ([X.strides[0]] + grid_strides + list(X.strides[1:-1]) +
+            [X.strides[-1]])
+    view = np.lib.stride_tricks.as_strided(X, shape = shape, strides = strides)
+    view.flags.writeable = False
+    return view
+
 class Pipeline(object):
-    def __init__(self):
+    def __init__(self, cache_dir = None, cache_size = None):
+        """
+        A sequence of preprocessors, applied in order.
+
+        cache_dir: if not None, the state of each preprocessor after it has
+            been applied, together with the dataset it produced, is stored
+            in this directory. A later call to apply with the same input
+            data, the same preprocessors (with the same parameters and, if
+            already fit, the same fitted state) and the same value of
+            can_fit loads the stored results instead of recomputing them.
+            Only DenseDesignMatrix datasets are supported.
+        cache_size: if not None, the maximum total size in bytes of the
+            entries in cache_dir. The least recently used entries are
+            deleted to make room for new ones.
+        """
         self.items = []
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
     #
 
     def apply(self, dataset, can_fit = False):
+        # Pickles made before the cache was supported lack cache_dir.
+        if getattr(self, 'cache_dir', None) is None:
+            for item in self.items:
+                item.apply(dataset, can_fit)
+            return
+
+        # Entry i stores the result of applying items[:i+1]. Its key is
+        # computed from the input data and the state of those items before
+        # they are applied, so all the keys are known up front.
+        keys = []
+        key = _dataset_fingerprint(dataset)
         for item in self.items:
-            item.apply(dataset, can_fit)
+            h = hashlib.sha1()
+            h.update(key)
+            _update_hash(h, item)
+            h.update(str(bool(can_fit)))
+            key = h.hexdigest()
+            keys.append(key)
+
+        start = 0
+        for i in xrange(len(self.items) - 1, -1, -1):
+            if self._load_entry(keys[i], dataset):
+                start = i + 1
+                break
+
+        for i in xrange(start, len(self.items)):
+            self.items[i].apply(dataset, can_fit)
+            self._save_entry(keys[i], dataset, self.items[:i+1])
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _load_entry(self, key, dataset):
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return False
+        f = open(os.path.join(path, 'state.pkl'), 'rb')
+        try:
+            items_state, dataset_state = cPickle.load(f)
+        finally:
+            f.close()
+        for item, state in zip(self.items, items_state):
+            item.__dict__.update(state)
+        dataset.__dict__.update(dataset_state)
+        dataset.set_design_matrix(np.load(os.path.join(path, 'X.npy')))
+        # The modification time of an entry records when it was last used.
+        os.utime(path, None)
+        return True
+
+    def _save_entry(self, key, dataset, items):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            return
+        # Written to a temporary directory and then renamed, so that
+        # interrupted writes never leave a partial entry behind.
+        tmp_path = tempfile.mkdtemp(dir = self.cache_dir, prefix = '.tmp')
+        try:
+            dataset_state = dict(dataset.__dict__)
+            del dataset_state['X']
+            f = open(os.path.join(tmp_path, 'state.pkl'), 'wb')
+            try:
+                cPickle.dump(([item.__dict__ for item in items],
+                    dataset_state), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            np.save(os.path.join(tmp_path, 'X.npy'), dataset.get_design_matrix())
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process may have stored the same entry while we
+                # were writing ours. Its content is equivalent, so use it.
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors = True)
+        self._evict(keep = key)
+
+    def _evict(self, keep):
+        if self.cache_size is None:
+            return
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            path = self._entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name))
+                    for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), key, size))
+            total += size
+        entries.sort()
+        for mtime, key, size in entries:
+            if total <= self.cache_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_path(key), ignore_errors = True)
+            total -= size
 
 class ExtractGridPatches(object):
     """ Converts a dataset into a dataset of patches
@@ -36,8 +243,6 @@ class ExtractGridPatches(object):
 
         num_patches = X.shape[0]
 
-        max_strides = [X.shape[0]-1]
-
         for i in xrange(num_topological_dimensions):
             patch_width = self.patch_shape[i]
             data_width = X.shape[i+1]
@@ -54,8 +259,6 @@ class ExtractGridPatches(object):
 
             num_strides_this_axis = max_stride_this_axis + 1
 
-            max_strides.append(max_stride_this_axis)
-
             num_patches *= num_strides_this_axis
 
         #batch size
@@ -66,49 +269,12 @@ class ExtractGridPatches(object):
         #number of channels
         output_shape.append(X.shape[-1])
 
-        output = np.zeros(output_shape, dtype = X.dtype)
-
-        channel_slice = slice(0,X.shape[-1])
-
-        coords = [ 0 ]  *  (num_topological_dimensions + 1)
-
-        keep_going = True
-        i = 0
-        while keep_going:
-
-            args = [ coords[0] ]
-
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j+1] * self.patch_stride[j]
-                args.append(slice(coord,coord+self.patch_shape[j]))
-            #end for j
-
-            args.append(channel_slice)
-
-            patch = X[args]
-            output[i,:] = patch
-            i += 1
-
-            #increment coordinates
-            j = 0
-
-            keep_going = False
-
-            while not keep_going:
-                if coords[-(j+1)] < max_strides[-(j+1)]:
-                    coords[-(j+1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j+1)] = 0
-
-                    if j == num_topological_dimensions:
-                        break
-
-                    j = j + 1
-                    #end if j
-                #end if coords
-            #end while not continue
-        #end while continue
+        # Patches are ordered by example, then by grid position with the
+        # last topological dimension varying fastest
+        view = _patch_view(X, self.patch_shape, self.patch_stride)
+        output = np.empty(view.shape, dtype = X.dtype)
+        output[...] = view
+        output = output.reshape(output_shape)
 
         dataset.set_topological_view(output)
 
@@ -131,6 +297,11 @@ class ReassembleGridPatches(object):
                 +""" topological dimensions called on dataset with """+
                 str(num_topological_dimensions)+""".""")
 
+        if tuple(patches.shape[1:-1]) != tuple(self.patch_shape):
+            raise ValueError('ReassembleGridPatches with patch_shape '+\
+                    str(tuple(self.patch_shape))+' called on patches of shape '+\
+                    str(tuple(patches.shape[1:-1])))
+
         num_patches = patches.shape[0]
 
         num_examples = num_patches
@@ -138,14 +309,15 @@ class ReassembleGridPatches(object):
         for im_dim, patch_dim in zip(self.orig_shape, self.patch_shape):
 
             if im_dim % patch_dim != 0:
-                raise Exception('Trying to assemble patches of shape '+\
-                        str(self.patch_shape)+' into images of shape '+\
-                        str(self.orig_shape))
+                raise ValueError('Trying to assemble patches of shape '+\
+                        str(tuple(self.patch_shape))+' into images of shape '+\
+                        str(tuple(self.orig_shape))+': each patch dimension '+\
+                        'must divide the corresponding image dimension')
 
             patches_this_dim = im_dim / patch_dim
 
             if num_examples % patches_this_dim != 0:
-                raise Exception('Trying to re-assemble '+str(num_patches) + \
+                raise ValueError('Trying to re-assemble '+str(num_patches) + \
                         ' patches of shape '+str(self.patch_shape)+\
                         ' into images of shape '+str(self.orig_shape))
             num_examples /= patches_this_dim
@@ -158,60 +330,21 @@ class ReassembleGridPatches(object):
         #number of channels
         reassembled_shape.append(patches.shape[-1])
 
-        reassembled = np.zeros(reassembled_shape, dtype = patches.dtype)
-
-        channel_slice = slice(0,patches.shape[-1])
-
-        coords = [ 0 ]  *  (num_topological_dimensions + 1)
-
-
-        max_strides = [ num_examples - 1]
-        for dim, pd in zip(self.orig_shape, self.patch_shape):
-            assert dim % pd == 0
-            max_strides.append(dim/pd-1)
-
-        keep_going = True
-        i = 0
-        while keep_going:
-
-            args = [ coords[0] ]
-
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j+1]
-                args.append(slice(coord*self.patch_shape[j],(coord+1)*self.patch_shape[j]))
-                assert (coord + 1) * self.patch_shape[j] <= reassembled.shape[j+1]
-            #end for j
-
-            args.append(channel_slice)
-
-            try:
-                patch = patches[i,:]
-            except IndexError:
-                raise IndexError('Gave index of '+str(i)+',: into thing of shape '+str(patches.shape))
-
-            reassembled[args] = patch
-            i += 1
-
-            #increment coordinates
-            j = 0
-
-            keep_going = False
-
-            while not keep_going:
-                if coords[-(j+1)] < max_strides[-(j+1)]:
-                    coords[-(j+1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j+1)] = 0
-
-                    if j == num_topological_dimensions:
-                        break
-
-                    j = j + 1
-                    #end if j
-                #end if coords
-            #end while not continue
-        #end while continue
+        # Split the patch index into example and grid position, then
+        # interleave each grid axis with the corresponding patch axis
+        grid_shape = [ im_dim / patch_dim for im_dim, patch_dim in
+                zip(self.orig_shape, self.patch_shape) ]
+        patches = patches.reshape([num_examples] + grid_shape +
+                list(self.patch_shape) + [patches.shape[-1]])
+        axes = [ 0 ]
+        for j in xrange(num_topological_dimensions):
+            axes.append(1 + j)
+            axes.append(1 + num_topological_dimensions + j)
+        axes.append(len(patches.shape) - 1)
+        patches = patches.transpose(axes)
+        reassembled = np.empty(patches.shape, dtype = patches.dtype)
+        reassembled[...] = patches
+        reassembled = reassembled.reshape(reassembled_shape)
 
         dataset.set_topological_view(reassembled)
 
@@ -249,25 +382,21 @@ class ExtractPatches(object):
         #number of channels
         output_shape.append(X.shape[-1])
 
-        output = np.zeros(output_shape, dtype = X.dtype)
-
-        channel_slice = slice(0,X.shape[-1])
-
-        for i in xrange(self.num_patches):
-            args = []
-
-            args.append(rng.randint(X.shape[0]))
-
-            for j in xrange(num_topological_dimensions):
-                max_coord = X.shape[j+1]-self.patch_shape[j]
-                coord = rng.randint(max_coord+1)
-                args.append(slice(coord,coord+self.patch_shape[j]))
-            #
-
-            args.append(channel_slice)
-
-            output[i,:] = X[args]
-        #
+        # The coordinates are drawn in the same order as when the patches
+        # were copied one at a time, so the rng sequence is unchanged, but
+        # the copy itself is a single gather from a view of all patches.
+        bounds = [ X.shape[0] ] + [ X.shape[j+1] - self.patch_shape[j] + 1
+                for j in xrange(num_topological_dimensions) ]
+        randint = rng.randint
+        coords = [ randint(bound) for i in xrange(self.num_patches)
+                for bound in bounds ]
+        coords = np.array(coords, dtype = 'int64').reshape(
+                (self.num_patches, len(bounds))).T
+
+        view = _patch_view(X, self.patch_shape,
+                [ 1 ] * num_topological_dimensions)
+        output = view[tuple(coords)]
+        assert list(output.shape) == output_shape
 
         dataset.set_topological_view(output)
 
@@ -355,8 +484,8 @@ class PCA(object):
         if self.pca is None:
             assert can_fit
             from pylearn2 import pca
-            self.pca = pca.CovEigPCA(self.num_components)
-            self.pca.train(dataset.get_design_matrix())
+            self.pca = pca.CovEigPCA(num_components=self.num_components)
+            self.pca.train(dataset)
 
             self.transform_func = function([self.input],self.pca(self.input))
             self.invert_func = function([self.output],self.pca.reconstruct(self.output))
@@ -438,7 +567,8 @@ class Downsample(object):
         dataset.set_topological_view(X)
 
 class GlobalContrastNormalization(object):
-    def __init__(self, subtract_mean = True, std_bias = 10.0, use_norm = False):
+    def __init__(self, subtract_mean = True, std_bias = 10.0, use_norm = False,
+            batch_size = None, output_path = None):
         """
 
         Optionally subtracts the mean of each example
@@ -451,6 +581,13 @@ class GlobalContrastNormalization(object):
             std_bias: Add this amount inside the square root when computing
                       the standard deviation or the norm
             use_norm: If True uses the norm instead of the standard deviation
+            batch_size: If not None, the examples are processed this many
+                      at a time, so that no more than one block of
+                      temporaries is ever held in memory
+            output_path: If not None, the result is written to a
+                      memory-mapped .npy file at this path, which becomes
+                      the dataset's design matrix. Otherwise the design
+                      matrix is modified in place.
 
 
             The default parameters of subtract_mean = True, std_bias = 10.0,
@@ -464,14 +601,13 @@ class GlobalContrastNormalization(object):
         self.subtract_mean = subtract_mean
         self.std_bias = std_bias
         self.use_norm = use_norm
+        self.batch_size = batch_size
+        self.output_path = output_path
 
-    def apply(self, dataset, can_fit = False):
-        X = dataset.get_design_matrix()
-
-        assert X.dtype == 'float32' or X.dtype == 'float64'
-
+    def _normalize(self, X, out):
         if self.subtract_mean:
-            X -= X.mean(axis=1)[:,None]
+            out[...] = X - X.mean(axis=1)[:,None]
+            X = out
 
         if self.use_norm:
             scale = np.sqrt( np.square(X).sum(axis=1) + self.std_bias)
@@ -482,14 +618,43 @@ class GlobalContrastNormalization(object):
         eps = 1e-8
         scale[scale < eps] = 1.
 
-        X /= scale[:,None]
+        np.divide(X, scale[:,None], out)
 
-        dataset.set_design_matrix(X)
+    def apply(self, dataset, can_fit = False):
+        X = dataset.get_design_matrix()
+
+        assert X.dtype == 'float32' or X.dtype == 'float64'
+
+        # Pickles made before blockwise processing was supported lack these.
+        batch_size = getattr(self, 'batch_size', None)
+        output_path = getattr(self, 'output_path', None)
+
+        if batch_size is None and output_path is None:
+            self._normalize(X, X)
+            dataset.set_design_matrix(X)
+            return
+
+        out = _output_like(X, output_path)
+        for block in _row_blocks(X.shape[0], batch_size):
+            self._normalize(X[block], out[block])
+
+        dataset.set_design_matrix(out)
 
 
 
 class ZCA(object):
-    def __init__(self, n_components=None, n_drop_components=None, filter_bias=0.1):
+    def __init__(self, n_components=None, n_drop_components=None, filter_bias=0.1,
+            batch_size=None, output_path=None):
+        """
+        batch_size: if not None, the mean and covariance are accumulated and
+            the whitening is applied this many examples at a time, so that
+            no more than one block of temporaries is ever held in memory.
+            The design matrix is then whitened in place.
+        output_path: if not None, the whitened data is written to a
+            memory-mapped .npy file at this path, which becomes the dataset's
+            design matrix, rather than to a new array (or, with batch_size,
+            rather than in place).
+        """
         warnings.warn("""This ZCA preprocessor class is known to yield very different results on different platforms. If you plan to conduct experiments with this preprocessing on multiple machines, it is probably a good idea to do the preprocessing on a single machine and copy the preprocessed datasets to the others, rather than preprocessing the data independently in each location.""")
         #TODO: test to see if differences across platforms
         # e.g., preprocessing STL-10 patches in LISA lab versus on
@@ -500,25 +665,51 @@ class ZCA(object):
         self.n_drop_components =n_drop_components
         self.copy = True
         self.filter_bias = filter_bias
+        self.batch_size = batch_size
+        self.output_path = output_path
         self.has_fit_ = False
 
+    def _blockwise_mean_and_covariance(self, X):
+        """
+        Two passes over blocks of rows of X: one for the mean, one for the
+        covariance of the centered data. Accumulates in float64.
+        """
+        total = np.zeros(X.shape[1])
+        for block in _row_blocks(X.shape[0], self.batch_size):
+            X_block = X[block]
+            assert not np.any(np.isnan(X_block))
+            total += X_block.sum(axis=0)
+        mean = np.cast[X.dtype](total / X.shape[0])
+
+        covariance = np.zeros((X.shape[1], X.shape[1]))
+        for block in _row_blocks(X.shape[0], self.batch_size):
+            X_block = X[block] - mean
+            covariance += np.dot(X_block.T, X_block)
+        covariance /= X.shape[0]
+
+        return mean, covariance
+
     def fit(self, X):
         assert X.dtype in ['float32','float64']
-        assert not np.any(np.isnan(X))
 
         assert len(X.shape) == 2
 
-        n_samples = X.shape[0]
+        if getattr(self, 'batch_size', None) is not None:
+            self.mean_, covariance = self._blockwise_mean_and_covariance(X)
+        else:
+            assert not np.any(np.isnan(X))
+
+            if self.copy:
+                X = X.copy()
 
-        if self.copy:
-            X = X.copy()
+            # Center data
+            self.mean_ = np.mean(X, axis=0)
+            X -= self.mean_
 
-        # Center data
-        self.mean_ = np.mean(X, axis=0)
-        X -= self.mean_
+            covariance = np.dot(X.T, X)/X.shape[0]
 
         print 'computing zca'
-        eigs, eigv = linalg.eigh(np.dot(X.T, X)/X.shape[0])
+        eigs, eigv = linalg.eigh(covariance)
 
         assert not np.any(np.isnan(eigs))
         assert not np.any(np.isnan(eigv))
@@ -556,7 +747,22 @@ class ZCA(object):
             self.fit(X)
         #
 
-        new_X =  np.dot(X-self.mean_, self.P_)
+        # Pickles made before blockwise processing was supported lack these.
+        batch_size = getattr(self, 'batch_size', None)
+        output_path = getattr(self, 'output_path', None)
+
+        if batch_size is None:
+            new_X =  np.dot(X-self.mean_, self.P_)
+            if output_path is not None:
+                out = _output_like(new_X, output_path)
+                out[...] = new_X
+                new_X = out
+        else:
+            # Each block is read in full before it is overwritten, so this
+            # works in place.
+            new_X = _output_like(X, output_path)
+            for block in _row_blocks(X.shape[0], batch_size):
+                new_X[block] = np.dot(X[block] - self.mean_, self.P_)
 
         #print 'mean absolute difference between new and old X'+str(np.abs(X-new_X).mean())
 
@@ -0,0 +1,73 @@
+import cPickle
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pylearn2.datasets.npy_npz import NpyDataset
+
+
+def test_npy_mmap():
+    #tests that the design matrix and targets are memory-mapped, that
+    #iteration works on the maps, and that pickling records the files
+    #rather than the arrays
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState([1,2,3])
+        X = rng.randn(1000,6)
+        y = rng.randint(0,3,(1000,))
+        X_path = os.path.join(tmpdir, 'X.npy')
+        y_path = os.path.join(tmpdir, 'y.npy')
+        np.save(X_path, X)
+        np.save(y_path, y)
+
+        dataset = NpyDataset(X_path, mmap_mode = 'r', targets = y_path)
+        assert isinstance(dataset.get_design_matrix(), np.memmap)
+        assert isinstance(dataset.get_targets(), np.memmap)
+
+        batches = list(dataset.iterator(mode = 'sequential', batch_size = 300,
+                                        targets = True))
+        assert np.allclose(np.concatenate([b[0] for b in batches]), X)
+        assert np.all(np.concatenate([b[1] for b in batches]) == y)
+
+        pickled = cPickle.dumps(dataset)
+        assert len(pickled) < X.nbytes
+        loaded = cPickle.loads(pickled)
+        assert isinstance(loaded.get_design_matrix(), np.memmap)
+        assert np.all(loaded.get_design_matrix() == X)
+        assert np.all(loaded.get_targets() == y)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_npy_mmap_pickle_after_preprocessing():
+    #tests that pickling a memory-mapped dataset whose arrays have been
+    #replaced pickles the new arrays and leaves the source files alone
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState([1,2,3])
+        X = rng.randn(100,6)
+        y = rng.randint(0,3,(100,))
+        X_path = os.path.join(tmpdir, 'X.npy')
+        y_path = os.path.join(tmpdir, 'y.npy')
+        np.save(X_path, X)
+        np.save(y_path, y)
+
+        dataset = NpyDataset(X_path, mmap_mode = 'r', targets = y_path)
+        dataset.get_design_matrix()
+        dataset.set_design_matrix(np.zeros((100,6)))
+        dataset.y = np.ones(100)
+        loaded = cPickle.loads(cPickle.dumps(dataset))
+
+        assert np.all(np.load(X_path) == X)
+        assert np.all(np.load(y_path) == y)
+        assert not isinstance(loaded.get_design_matrix(), np.memmap)
+        assert np.all(loaded.get_design_matrix() == 0)
+        assert np.all(loaded.get_targets() == 1)
+
+        # the unpickled dataset doesn't refer to the files any more
+        cPickle.loads(cPickle.dumps(loaded))
+        assert np.all(np.load(X_path) == X)
+    finally:
+        shutil.rmtree(tmpdir)
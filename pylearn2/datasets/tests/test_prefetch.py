@@ -0,0 +1,45 @@
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.datasets.prefetch import PrefetchingDataset
+
+
+def test_prefetch_matches_synchronous():
+    #tests that the prefetched batches are the ones the wrapped
+    #dataset would have returned, in the same order, and that the
+    #stream position reflects the batches consumed, not those
+    #prefetched
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(50,4)
+    d1 = DenseDesignMatrix(X = X, rng = [4,5,6])
+    d2 = DenseDesignMatrix(X = X, rng = [4,5,6])
+    prefetcher = PrefetchingDataset(d2, depth = 3)
+    for i in xrange(5):
+        expected = d1.get_batch_design(7)
+        batch = prefetcher.get_batch_design(7)
+        assert np.all(batch == expected)
+    pos = prefetcher.get_stream_position()
+    assert np.all(pos.get_state()[1] == d1.rng.get_state()[1])
+    prefetcher.close()
+
+    prefetcher.set_stream_position(pos)
+    assert np.all(prefetcher.get_batch_design(7) == d1.get_batch_design(7))
+    assert prefetcher.stall_time >= 0.
+    prefetcher.close()
+
+
+def test_prefetch_change_batch_size():
+    #tests that asking for a different batch size, or closing the
+    #prefetcher, rewinds the wrapped dataset past the batches that were
+    #prefetched but not consumed
+    X = np.arange(1000.).reshape(100, 10)
+    d1 = DenseDesignMatrix(X = X, rng = [4,5,6])
+    d2 = DenseDesignMatrix(X = X, rng = [4,5,6])
+    prefetcher = PrefetchingDataset(d2, depth = 3)
+    assert np.all(prefetcher.get_batch_design(5) == d1.get_batch_design(5))
+    assert np.all(prefetcher.get_batch_design(3) == d1.get_batch_design(3))
+    assert np.all(prefetcher.get_batch_design(4) == d1.get_batch_design(4))
+    prefetcher.close()
+    assert np.all(d2.rng.get_state()[1] == d1.rng.get_state()[1])
+    assert np.all(prefetcher.get_batch_design(5) == d1.get_batch_design(5))
+    prefetcher.close()
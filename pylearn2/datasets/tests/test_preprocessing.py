@@ -1,6 +1,8 @@
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.datasets.preprocessing import GlobalContrastNormalization
+from pylearn2.datasets.preprocessing import ZCA, Pipeline
 from pylearn2.datasets.preprocessing import ExtractGridPatches, ReassembleGridPatches
+from pylearn2.datasets.preprocessing import ExtractPatches
 from pylearn2.utils import as_floatX
 import numpy as np
 
@@ -61,6 +63,125 @@ class testGlobalContrastNormalization:
 
         assert max_norm_error < tol
 
+def test_blockwise_matches_one_shot():
+    """ Tests that ZCA and GlobalContrastNormalization give the same result
+    when run a few rows at a time, in place or into a memmapped file """
+
+    import os
+    import tempfile
+
+    rng = np.random.RandomState([1,2,3])
+    X = as_floatX(rng.randn(23, 6))
+
+    for make_preprocessor in [
+            lambda **kwargs: ZCA(**kwargs),
+            lambda **kwargs: GlobalContrastNormalization(std_bias=0.,
+                                                         **kwargs)]:
+        expected = DenseDesignMatrix(X = X.copy())
+        expected.apply_preprocessor(make_preprocessor(), can_fit = True)
+        expected = expected.get_design_matrix()
+
+        blockwise = DenseDesignMatrix(X = X.copy())
+        orig = blockwise.X
+        blockwise.apply_preprocessor(make_preprocessor(batch_size = 5),
+                                     can_fit = True)
+        assert blockwise.X is orig
+        assert np.allclose(blockwise.get_design_matrix(), expected,
+                           atol = 1e-4)
+
+        fd, path = tempfile.mkstemp(suffix = '.npy')
+        os.close(fd)
+        try:
+            memmapped = DenseDesignMatrix(X = X.copy())
+            memmapped.apply_preprocessor(make_preprocessor(batch_size = 5,
+                                                           output_path = path),
+                                         can_fit = True)
+            assert isinstance(memmapped.X, np.memmap)
+            assert np.allclose(np.load(path), expected, atol = 1e-4)
+            del memmapped
+        finally:
+            os.remove(path)
+
+class CountingGCN(GlobalContrastNormalization):
+    """ Counts the number of times it was actually applied """
+    applied = 0
+
+    def apply(self, dataset, can_fit = False):
+        CountingGCN.applied += 1
+        super(CountingGCN, self).apply(dataset, can_fit)
+
+def test_pipeline_cache():
+    """ Tests that a Pipeline with a cache_dir reuses fitted preprocessors
+    and transformed data across instances, and evicts old entries """
+
+    import os
+    import shutil
+    import tempfile
+
+    rng = np.random.RandomState([1,2,3])
+    X = as_floatX(rng.randn(20, 5))
+    cache_dir = tempfile.mkdtemp()
+
+    def make_pipeline(**kwargs):
+        pipeline = Pipeline(cache_dir = cache_dir, **kwargs)
+        pipeline.items.append(CountingGCN())
+        pipeline.items.append(ZCA())
+        return pipeline
+
+    try:
+        CountingGCN.applied = 0
+        first = DenseDesignMatrix(X = X.copy())
+        make_pipeline().apply(first, can_fit = True)
+        assert CountingGCN.applied == 1
+        assert len(os.listdir(cache_dir)) == 2
+
+        second = DenseDesignMatrix(X = X.copy())
+        pipeline = make_pipeline()
+        pipeline.apply(second, can_fit = True)
+        assert CountingGCN.applied == 1
+        assert np.allclose(first.X, second.X)
+        assert pipeline.items[1].has_fit_
+
+        #changing a parameter of the first step invalidates the second one
+        third = DenseDesignMatrix(X = X.copy())
+        pipeline = make_pipeline(cache_size = 1)
+        pipeline.items[0].std_bias = 1.
+        pipeline.apply(third, can_fit = True)
+        assert CountingGCN.applied == 2
+        assert not np.allclose(first.X, third.X)
+        #only the most recent entry is kept
+        assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_pipeline_cache_concurrent_write():
+    """ Tests that a cache entry written by another process while ours was
+    being written is treated as a hit, and that no temporary files are left
+    behind """
+
+    import os
+    import shutil
+    import tempfile
+
+    cache_dir = tempfile.mkdtemp()
+    pipeline = Pipeline(cache_dir = cache_dir)
+    path = pipeline._entry_path('key')
+
+    class RacingDataset(DenseDesignMatrix):
+        def get_design_matrix(self):
+            # the other process finishes first
+            os.makedirs(path)
+            open(os.path.join(path, 'X.npy'), 'wb').close()
+            return super(RacingDataset, self).get_design_matrix()
+
+    try:
+        dataset = RacingDataset(X = as_floatX(np.zeros((2, 3))))
+        pipeline._save_entry('key', dataset, [])
+        assert os.listdir(cache_dir) == [os.path.basename(path)]
+        assert os.listdir(path) == ['X.npy']
+    finally:
+        shutil.rmtree(cache_dir)
+
 def test_extract_reassemble():
     """ Tests that ExtractGridPatches and ReassembleGridPatches are
     inverse of each other """
@@ -85,3 +206,43 @@ def test_extract_reassemble():
 
     if not np.all(new_topo == topo):
         assert False
+
+def test_reassemble_bad_shape():
+    """ Tests that ReassembleGridPatches rejects patch shapes that do not
+    tile the original shape """
+
+    for num_patches, orig_shape, patch_shape in [
+            (4*5*3, (3*5, 3*7+1), (3, 7)),
+            #divides the original shape, but is not the shape of the patches
+            (4*3*7, (3*7, 3*7), (7, 3))]:
+        dataset = DenseDesignMatrix(topo_view = np.zeros((num_patches,
+            3, 7, 2)))
+        reassemblor = ReassembleGridPatches(patch_shape = patch_shape,
+                orig_shape = orig_shape)
+        try:
+            dataset.apply_preprocessor(reassemblor)
+        except ValueError:
+            continue
+        assert False
+
+def test_extract_patches():
+    """ Tests that ExtractPatches copies the patches at the coordinates
+    drawn from its rng, in the order they were drawn """
+
+    topo = np.random.RandomState([1,2,3]).randn(5, 9, 11, 2)
+    patch_shape = (3, 4)
+    num_patches = 20
+
+    dataset = DenseDesignMatrix(topo_view = topo)
+    dataset.apply_preprocessor(ExtractPatches(patch_shape, num_patches,
+        rng = np.random.RandomState([4,5,6])))
+    patches = dataset.get_topological_view()
+
+    assert patches.shape == (num_patches, 3, 4, 2)
+
+    rng = np.random.RandomState([4,5,6])
+    for i in xrange(num_patches):
+        n = rng.randint(topo.shape[0])
+        r = rng.randint(topo.shape[1] - patch_shape[0] + 1)
+        c = rng.randint(topo.shape[2] - patch_shape[1] + 1)
+        assert np.all(patches[i] == topo[n, r:r+3, c:c+4, :])
@@ -19,6 +19,21 @@ class GRBM_EnergyFunction(RBM_EnergyFunction):
     def mean_H_given_V(self, V):
         raise NotImplementedError()
 
+    def tempered_mean_H_given_V(self, V, beta):
+        """
+        mean_H_given_V in the models whose energy is multiplied by beta, a
+        vector holding an inverse temperature for each row of V.
+        """
+        raise NotImplementedError()
+
+    def tempered_free_energy(self, V, beta):
+        """
+        The free energy in the models whose energy is multiplied by beta, a
+        vector holding an inverse temperature for each row of V, up to a
+        constant depending only on beta.
+        """
+        raise NotImplementedError()
+
 
 class GRBM_Type_1(GRBM_EnergyFunction):
 
@@ -131,6 +146,20 @@ class GRBM_Type_1(GRBM_EnergyFunction):
                 - bias_term
                 ) / T.sqr(self.sigma) - softplus_term
 
+    def tempered_mean_H_given_V(self, V, beta):
+        return T.nnet.sigmoid(
+                beta.dimshuffle(0, 'x') *
+                (self.bias_hid + self.transformer.lmul(V)) / T.sqr(self.sigma))
+
+    def tempered_free_energy(self, V, beta):
+        sq_term = 0.5 * T.sqr(V).sum(axis=1)
+        bias_term = T.dot(V, self.bias_vis)
+        softplus_term = T.nnet.softplus(
+                beta.dimshuffle(0, 'x') *
+                (self.transformer.lmul(V) + self.bias_hid) / T.sqr(self.sigma)
+                ).sum(axis=1)
+        return beta * (sq_term - bias_term) / T.sqr(self.sigma) - softplus_term
+
     def score(self, V):
         #score(v) = ( v - bias_vis - sigmoid( beta v^T W + bias_hid ) W^T )/sigma^2
 
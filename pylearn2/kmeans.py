@@ -1,26 +1,27 @@
 """KMeans as a postprocessing Block subclass."""
 
+from multiprocessing.pool import ThreadPool
+
 import numpy
+from scipy import sparse
 from pylearn2.base import Block
 from pylearn2.models.model import Model
 from pylearn2.space import VectorSpace
 from pylearn2.utils import sharedX
-import warnings
 
-try:
-    import milk
-except:
-    milk = None
-    warnings.warn(""" Install milk ( http://packages.python.org/milk/ )
-                    It has a better k-means implementation. Falling back to
-                    our own really slow implementation. """)
+# Distances are computed for blocks of about this many (example, centroid)
+# pairs at a time, so the full n x k distance matrix is never held.
+_BLOCK_ELEMENTS = 2 ** 21
+
 
 class KMeans(Block, Model):
     """
     Block that outputs a vector of probabilities that a sample belong to means
     computed during training.
     """
-    def __init__(self, k, nvis, convergence_th=1e-6, max_iter=None, verbose=False):
+    def __init__(self, k, nvis, convergence_th=1e-6, max_iter=None,
+                 verbose=False, init='random', init_size=None,
+                 batch_size=None, num_workers=1, seed=None):
         """
         Parameters in conf:
 
@@ -32,7 +33,31 @@ class KMeans(Block, Model):
         kmeans stops iterating.
 
         :type max_iter: int
-        :param max_iter: maximum number of iterations. Defaults to infinity.
+        :param max_iter: maximum number of iterations (epochs in mini-batch
+        mode). Defaults to infinity.
+
+        :type init: str
+        :param init: how the initial means are chosen when none are given to
+        `train`: 'random' (random examples) or 'k-means++'.
+
+        :type init_size: int
+        :param init_size: number of randomly chosen examples k-means++ seeds
+        from. Defaults to min(number of examples, 20 * k).
+
+        :type batch_size: int
+        :param batch_size: if given, train with mini-batch k-means, streaming
+        batches of this size from the dataset's iterator (in 'shuffled_chunks'
+        mode, so memory-mapped datasets are read near-sequentially), instead
+        of running Lloyd iterations over the whole design matrix.
+
+        :type num_workers: int
+        :param num_workers: number of threads computing the assignments of
+        blocks of examples in parallel. numpy releases the GIL in the matrix
+        products that dominate the cost.
+
+        :type seed: int or list
+        :param seed: seed of the random number generator used for
+        initialization, reseeding empty clusters and drawing batches.
         """
 
         Block.__init__(self)
@@ -49,6 +74,17 @@ class KMeans(Block, Model):
         else:
             self.max_iter = float('inf')
 
+        if init not in ['random', 'k-means++']:
+            raise ValueError("KMeans init: init should be 'random' or "
+                             "'k-means++', got %s" % init)
+        self.init = init
+        self.init_size = init_size
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        if seed is None:
+            seed = [1, 2, 3]
+        self.rng = numpy.random.RandomState(seed)
+
         self.verbose = verbose
 
     def train(self, dataset, mu=None):
@@ -56,121 +92,136 @@ class KMeans(Block, Model):
         Process kmeans algorithm on the input to localize clusters.
         """
 
-        #TODO-- why does this sometimes return X and sometimes return nothing?
-
         X = dataset.get_design_matrix()
 
-        n, m = X.shape
         k = self.k
 
-        if milk is not None:
-            #use the milk implementation of k-means if it's available
-            cluster_ids, mu = milk.kmeans(X,k)
+        # taking initial clusters from the data if user does not provide
+        # them.
+        if mu is not None:
+            if not len(mu) == k:
+                raise Exception('You gave %i clusters, but k=%i were expected'
+                                % (len(mu), k))
+            mu = numpy.array(mu, dtype='float64')
+        elif self.init == 'k-means++':
+            mu = self._kmeans_plus_plus(X)
         else:
-            #our own implementation
-
-            # taking random inputs as initial clusters if user does not provide
-            # them.
-            if mu is not None:
-                if not len(mu) == k:
-                    raise Exception('You gave %i clusters, but k=%i were expected'
-                                    % (len(mu), k))
-            else:
-                indices = numpy.random.randint(X.shape[0], size=k)
-                mu = X[indices]
-
-            try:
-                dists = numpy.zeros((n, k))
-            except MemoryError:
-                print ("dying trying to allocate dists matrix ",
-                       "for %d examples and %d means" % (n, k))
-                raise
-
-            old_kills = {}
-
-            iter = 0
-            mmd = prev_mmd = float('inf')
-            while True:
-                if self.verbose:
-                    print 'kmeans iter ' + str(iter)
-
-                #print 'iter:',iter,' conv crit:',abs(mmd-prev_mmd)
-                #if numpy.sum(numpy.isnan(mu)) > 0:
-                if numpy.any(numpy.isnan(mu)):
-                    print 'nan found'
-                    return X
-
-                #computing distances
-                for i in xrange(k):
-                    dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
-
-                if iter > 0:
-                    prev_mmd = mmd
-
-                min_dists = dists.min(axis=1)
-
-                #mean minimum distance:
-                mmd = min_dists.mean()
-
-                print 'cost: ',mmd
-
-                if iter > 0 and (iter >= self.max_iter or \
-                                        abs(mmd - prev_mmd) < self.convergence_th):
-                    #converged
-                    break
-
-                #finding minimum distances
-                min_dist_inds = dists.argmin(axis=1)
-
-                #computing means
-                i = 0
-                blacklist = []
-                new_kills = {}
-                while i < k:
-                    b = min_dist_inds == i
-                    if not numpy.any(b):
-                        killed_on_prev_iter = True
-                        #initializes empty cluster to be the mean of the d data
-                        #points farthest from their corresponding means
-                        if i in old_kills:
-                            d = old_kills[i] - 1
-                            if d == 0:
-                                d = 50
-                            new_kills[i] = d
-                        else:
-                            d = 5
-                        mu[i, :] = 0
-                        for j in xrange(d):
-                            idx = numpy.argmax(min_dists)
-                            min_dists[idx] = 0
-                            #chose point idx
-                            mu[i, :] += X[idx, :]
-                            blacklist.append(idx)
-                        mu[i, :] /= float(d)
-                        #cluster i was empty, reset it to d far out data points
-                        #recomputing distances for this cluster
-                        dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
-                        min_dists = dists.min(axis=1)
-                        for idx in blacklist:
-                            min_dists[idx] = 0
-                        min_dist_inds = dists.argmin(axis=1)
-                        #done
-                        i += 1
-                    else:
-                        mu[i, :] = numpy.mean(X[b, :], axis=0)
-                        if numpy.any(numpy.isnan(mu)):
-                            print 'nan found at', i
-                            return X
-                        i += 1
-
-                old_kills = new_kills
-
-                iter += 1
+            indices = self.rng.randint(X.shape[0], size=k)
+            mu = numpy.array(X[indices], dtype='float64')
 
+        if self.num_workers > 1:
+            pool = ThreadPool(self.num_workers)
+        else:
+            pool = None
+        try:
+            if self.batch_size is None:
+                mu = self._train_lloyd(X, mu, pool)
+            else:
+                mu = self._train_mini_batch(dataset, mu, pool)
+        finally:
+            if pool is not None:
+                pool.close()
 
         self.mu = sharedX( mu )
         self._params = [ self.mu ]
 
+    def _converged(self, iter, mmd, prev_mmd):
+        if self.verbose:
+            print 'kmeans iter %d, cost: %g' % (iter, mmd)
+        return iter > 0 and (iter >= self.max_iter or
+                             abs(mmd - prev_mmd) < self.convergence_th)
+
+    def _train_lloyd(self, X, mu, pool):
+        iter = 0
+        mmd = float('inf')
+        while True:
+            prev_mmd = mmd
+            min_dists, sums, counts = _assign(X, mu, pool)
+
+            #mean minimum distance:
+            mmd = min_dists.mean()
+
+            if self._converged(iter, mmd, prev_mmd):
+                break
+
+            #computing means
+            nonempty = counts > 0
+            mu[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+            #reinitializes empty clusters to the data points farthest from
+            #their means
+            empty = numpy.nonzero(~ nonempty)[0]
+            if len(empty) > 0:
+                if self.verbose:
+                    print 'reseeding %d empty clusters' % len(empty)
+                farthest = numpy.argsort(min_dists)[::-1][:len(empty)]
+                mu[empty[:len(farthest)]] = X[farthest]
+
+            iter += 1
+
+        return mu
+
+    def _train_mini_batch(self, dataset, mu, pool):
+        # Each mean moves towards the examples assigned to it with a
+        # learning rate of 1 / (number of examples assigned to it so far),
+        # as in Sculley, "Web-Scale K-Means Clustering", WWW 2010.
+        counts = numpy.zeros(self.k)
+        iter = 0
+        mmd = float('inf')
+        while True:
+            prev_mmd = mmd
+            total = 0.
+            num_examples = 0
+            for batch in dataset.iterator(mode='shuffled_chunks',
+                                          batch_size=self.batch_size,
+                                          rng=self.rng):
+                min_dists, sums, batch_counts = _assign(batch, mu, pool)
+                total += min_dists.sum()
+                num_examples += batch.shape[0]
+                counts += batch_counts
+                seen = batch_counts > 0
+                mu[seen] += ((sums[seen] - batch_counts[seen, None] * mu[seen])
+                             / counts[seen, None])
+            mmd = total / num_examples
+
+            if self._converged(iter, mmd, prev_mmd):
+                break
+            iter += 1
+
+        return mu
+
+    def _kmeans_plus_plus(self, X):
+        """
+        Chooses the initial means among a random subset of the examples
+        with the k-means++ rule of Arthur and Vassilvitskii: each new mean
+        is drawn with probability proportional to the squared distance to
+        the nearest mean already chosen.
+        """
+        n = X.shape[0]
+        init_size = self.init_size
+        if init_size is None:
+            init_size = 20 * self.k
+        if init_size < n:
+            sample = numpy.sort(self.rng.permutation(n)[:init_size])
+            X = X[sample]
+        X = numpy.asarray(X, dtype='float64')
+        mu = numpy.empty((self.k, X.shape[1]))
+        mu[0] = X[self.rng.randint(X.shape[0])]
+        min_dists = numpy.square(X - mu[0]).sum(axis=1)
+        for i in xrange(1, self.k):
+            total = min_dists.sum()
+            if total > 0:
+                idx = numpy.searchsorted(min_dists.cumsum(),
+                                         self.rng.uniform(0, total))
+                idx = min(idx, X.shape[0] - 1)
+            else:
+                # fewer distinct examples than means
+                idx = self.rng.randint(X.shape[0])
+            mu[i] = X[idx]
+            numpy.minimum(min_dists, numpy.square(X - mu[i]).sum(axis=1),
+                          out=min_dists)
+        return mu
+
     def get_params(self):
         #patch older pkls
         if not hasattr(self.mu, 'get_value'):
@@ -188,12 +239,10 @@ class KMeans(Block, Model):
         :type inputs: numpy.ndarray, shape (n, d)
         :param inputs: matrix of samples
         """
-        n, m = X.shape
-        k = self.k
         mu = self.mu
-        dists = numpy.zeros((n, k))
-        for i in xrange(k):
-            dists[:, i] = numpy.square((X - mu[i, :])).sum(axis=1)
+        if hasattr(mu, 'get_value'):
+            mu = mu.get_value()
+        dists = _sq_distances(X, mu, numpy.square(mu).sum(axis=1))
         return dists / dists.sum(axis=1).reshape(-1, 1)
 
     def get_weights(self):
@@ -202,3 +251,61 @@ class KMeans(Block, Model):
     def get_weights_format(self):
         return ['h','v']
 
+
+def _sq_distances(X, mu, mu_sq_norms):
+    """
+    Squared euclidean distances between the rows of X and those of mu,
+    computed as |x|^2 - 2 x.mu + |mu|^2 so the bulk of the work is one
+    matrix product.
+    """
+    dists = numpy.dot(X, mu.T)
+    dists *= -2
+    dists += mu_sq_norms
+    dists += numpy.square(X).sum(axis=1)[:, None]
+    # rounding can make the distance to a nearby mean slightly negative
+    numpy.maximum(dists, 0, out=dists)
+    return dists
+
+
+def _assign_block(args):
+    X, mu, mu_sq_norms = args
+    dists = _sq_distances(X, mu, mu_sq_norms)
+    labels = dists.argmin(axis=1)
+    min_dists = dists[numpy.arange(X.shape[0]), labels]
+    one_hot = sparse.csr_matrix((numpy.ones(X.shape[0]),
+                                 (labels, numpy.arange(X.shape[0]))),
+                                shape=(mu.shape[0], X.shape[0]))
+    sums = one_hot.dot(X)
+    counts = numpy.bincount(labels, minlength=mu.shape[0])
+    return min_dists, sums, counts
+
+
+def _assign(X, mu, pool=None):
+    """
+    Assigns each row of X to its nearest row of mu, blockwise.
+
+    Returns the squared distance of each row to its mean, and the sum and
+    number of the rows assigned to each mean.
+    """
+    n = X.shape[0]
+    k = mu.shape[0]
+    block_size = max(1, _BLOCK_ELEMENTS // k)
+    # The distances are computed in the precision of the data, with the
+    # means rounded to it, but the sums are accumulated in float64.
+    if X.dtype not in ['float32', 'float64']:
+        X = numpy.asarray(X, dtype='float64')
+    mu = numpy.asarray(mu, dtype=X.dtype)
+    mu_sq_norms = numpy.square(mu).sum(axis=1)
+    tasks = [(X[start:start + block_size], mu, mu_sq_norms)
+             for start in xrange(0, n, block_size)]
+    if pool is None:
+        results = map(_assign_block, tasks)
+    else:
+        results = pool.map(_assign_block, tasks)
+    min_dists = numpy.concatenate([r[0] for r in results])
+    sums = numpy.zeros(mu.shape)
+    counts = numpy.zeros(k)
+    for r in results:
+        sums += r[1]
+        counts += r[2]
+    return min_dists, sums, counts
@@ -0,0 +1,106 @@
+"""
+A log of monitoring records and other training events, written as one JSON
+object per line so that it can be appended to cheaply while training and
+read back (e.g. by scripts/plot_monitor.py) without unpickling the model.
+
+This module must not import theano, so that reading a log stays fast.
+
+Every line has an "event" field. The events written by pylearn2 are:
+
+    record : one value of a monitoring channel. Fields: channel, value,
+        epoch, batches_seen, examples_seen, time (when the evaluation
+        started, in seconds since the epoch) and duration (of the
+        evaluation of all the channels, in seconds).
+    compile : compilation of a theano function. Fields: function, seconds.
+    epoch : end of a training epoch. Fields: epoch, duration, time.
+"""
+import json
+import time
+
+
+class MetricsWriter(object):
+    """
+    Appends events to a JSON-lines file.
+
+    Lines are buffered and written out at most every `flush_interval`
+    seconds (and when `flush` or `close` is called), so logging costs
+    little even when many records are written.
+    """
+    def __init__(self, path, flush_interval=10.):
+        """
+        Parameters
+        ----------
+        path : str
+            The file to append to. It is created if needed.
+        flush_interval : float, optional
+            Maximum number of seconds between flushes.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, 'a')
+        self._last_flush = time.time()
+
+    def write(self, event, **fields):
+        """
+        Appends an event with the given fields, which must be
+        JSON-serializable (numpy scalars are converted to python ones).
+        """
+        fields['event'] = event
+        for key, value in fields.items():
+            if hasattr(value, 'item'):
+                fields[key] = value.item()
+        self._file.write(json.dumps(fields, sort_keys=True) + '\n')
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class ChannelRecord(object):
+    """
+    The history of one monitoring channel read from a metrics file. Has the
+    same `val_record`, `batch_record`, `example_record` and `epoch_record`
+    fields as `pylearn2.monitor.MonitorChannel`, plus `time_record`.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.val_record = []
+        self.batch_record = []
+        self.example_record = []
+        self.epoch_record = []
+        self.time_record = []
+
+
+def read_channels(path):
+    """
+    Returns a dictionary mapping the name of each channel recorded in the
+    metrics file at `path` to a `ChannelRecord`.
+
+    A last line left incomplete by a process that was killed while writing
+    is ignored.
+    """
+    channels = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('event') != 'record':
+                continue
+            name = event['channel']
+            if name not in channels:
+                channels[name] = ChannelRecord(name)
+            channel = channels[name]
+            channel.val_record.append(event['value'])
+            channel.batch_record.append(event['batches_seen'])
+            channel.example_record.append(event['examples_seen'])
+            channel.epoch_record.append(event['epoch'])
+            channel.time_record.append(event['time'])
+    return channels
@@ -7,7 +7,9 @@ __maintainer__ = "Ian Goodfellow"
 
 import time
 from pylearn2.models import Model
-from theano import config, function, shared
+from theano import config, shared
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.lazy import lazy_function, reset_lazy_functions
 import theano.tensor as T
 import numpy as np
 import warnings
@@ -106,12 +108,12 @@ class DBM(Model):
         self.rng = np.random.RandomState([1,2,3])
 
     def redo_everything(self):
-        """ compiles learn_func if necessary
+        """ discards learn_func if necessary
             makes new negative chains
             does not reset weights or biases
         """
 
-        #compile learn_func if necessary
+        #learn_func is compiled on first use
         if self.autonomous:
             self.redo_theano()
 
@@ -404,18 +406,19 @@ class DBM(Model):
         return total
 
     def redo_theano(self):
+        """ Discards learn_func, which is compiled again the first time
+        it is used """
+        reset_lazy_functions(self)
+
+    @lazy_function
+    def learn_func(self):
         try:
             self.compile_mode()
-            init_names = dir(self)
 
             V = T.matrix(name='V')
             V.tag.test_value = np.cast[config.floatX](self.rng.uniform(0.,1.,(self.test_batch_size,self.nvis)) > 0.5)
 
-            self.learn_func = self.make_learn_func(V)
-
-            final_names = dir(self)
-
-            self.register_names_to_del([name for name in final_names if name not in init_names])
+            return self.make_learn_func(V)
         finally:
             self.deploy_mode()
 
@@ -5,13 +5,24 @@ import numpy as N
 import theano.tensor as T
 
 import theano
-from theano import function, shared, config
+from theano import shared, config
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.parallel import RowParallelInference
 floatX = config.floatX
 
 class DifferentiableSparseCoding(object):
     def __init__(self, nvis, nhid,
             init_lambda,
-            init_p, init_alpha, learning_rate):
+            init_p, init_alpha, learning_rate, num_workers = 1,
+            batch_inference = False):
+        """
+        num_workers: if greater than 1, the codes for a minibatch are
+        inferred by this many worker processes (see
+        pylearn2.utils.parallel.RowParallelInference)
+        batch_inference: if True, the codes for a minibatch (or for each
+        worker's block of it) are inferred jointly by optimize_h_vectorized
+        rather than one example at a time
+        """
         self.nvis = int(nvis)
         self.nhid = int(nhid)
         self.init_lambda = float(init_lambda)
@@ -31,6 +42,9 @@ class DifferentiableSparseCoding(object):
 
         self.instrumented = False
 
+        self.num_workers = num_workers
+        self.batch_inference = batch_inference
+
         self.redo_everything()
 
     def get_output_dim(self):
@@ -107,6 +121,15 @@ class DifferentiableSparseCoding(object):
         return self.recons_error_batch(V,H) + self.sparsity_penalty_batch(V,H)
     #
 
+    def coding_obj_rows(self, V, H):
+        """ a vector whose i-th element is coding_obj(V[i,:],H[i,:]) """
+        recons = T.dot(H,self.W.T)
+        recons_error = T.sqr(recons - V).sum(axis=1) / N.cast[floatX](self.nvis)
+        sparsity_measure = H * T.log(H) - H * T.log(self.p) - H + self.p
+        sparsity_penalty = T.dot(sparsity_measure, self.lamda) / N.cast[floatX](self.nhid)
+        return recons_error + sparsity_penalty
+    #
+
     def predict(self, V):
         rval =  T.nnet.sigmoid(T.dot(V,self.pred_W)+self.pred_b)*self.pred_g
         assert rval.type.dtype == V.type.dtype
@@ -114,6 +137,12 @@ class DifferentiableSparseCoding(object):
 
     def redo_theano(self):
 
+        #worker processes keep the functions that existed when they were
+        #forked, so they are replaced along with them
+        if getattr(self, '_inference', None) is not None:
+            self._inference.close()
+        self._inference = None
+
         self.h = shared(N.zeros(self.nhid, dtype=floatX), name='h')
         self.v = shared(N.zeros(self.nvis, dtype=floatX), name='v')
 
@@ -153,6 +182,20 @@ class DifferentiableSparseCoding(object):
         V = T.matrix(name='V')
         H = T.matrix(name='H')
 
+        #whole-batch versions of the above, used by optimize_h_vectorized
+        self.predict_batch = function([V], self.predict(V))
+
+        coding_obj_rows = self.coding_obj_rows(V,H)
+        #rows are independent, so the gradient of the sum gives each row's gradient
+        coding_grad_rows = T.grad(coding_obj_rows.sum(), H)
+        self.coding_obj_grad_batch = function([V,H], [coding_obj_rows, coding_grad_rows])
+
+        alphas = T.vector(name='alphas')
+        outside_grads = T.matrix(name='outside_grads')
+        new_H = T.clip(H * T.exp(-alphas.dimshuffle(0,'x') * outside_grads), 1e-10, 1e4)
+        self.try_step_batch = function([V,H,alphas,outside_grads],
+                [new_H, self.coding_obj_rows(V,new_H)])
+
         coding_obj_batch = self.coding_obj_batch(V,H)
 
         self.code_learning_obj = function( [V,H], coding_obj_batch)
@@ -181,15 +224,7 @@ class DifferentiableSparseCoding(object):
         return ['v','h']
 
     def error_func(self, x):
-        batch_size = x.shape[0]
-
-        H = N.zeros((batch_size,self.nhid),dtype=floatX)
-
-        for i in xrange(batch_size):
-            assert self.alpha > 9e-8
-            H[i,:] = self.optimize_h(x[i,:])
-            assert self.alpha > 9e-8
-        #
+        H = self.optimize_h_batch(x)
 
         return self.code_learning_obj(x,H)
 
@@ -292,6 +327,137 @@ class DifferentiableSparseCoding(object):
         #print 'final obj ',new_obj
         return self.get_h()
 
+    def optimize_h_vectorized(self, V, out = None):
+        """
+        Runs the same multiplicative updates as optimize_h for all the rows
+        of V at once, so that each iteration costs a few matrix operations
+        rather than several function calls per example.
+
+        Each row has its own step size and failure rate, both starting from
+        the model's current values, and rows stop being updated as soon as
+        they converge (or their line search gives up). Afterward the model's
+        alpha and failure_rate are set to the mean over rows.
+        """
+        assert self.alpha > 9e-8
+
+        H = self.predict_batch(V)
+
+        alpha = N.zeros(V.shape[0], dtype=floatX) + self.alpha
+        failure_rate = N.zeros(V.shape[0]) + self.failure_rate
+        active = N.arange(V.shape[0])
+
+        while len(active) > 0:
+            V_a = V[active]
+            H_a = H[active]
+
+            obj, grad = self.coding_obj_grad_batch(V_a, H_a)
+
+            assert not N.any(N.isnan(obj))
+            assert not N.any(N.isnan(grad))
+
+            moving = N.abs(grad).max(axis=1) >= self.tol
+            active = active[moving]
+            if len(active) == 0:
+                break
+            V_a, H_a, obj, grad = V_a[moving], H_a[moving], obj[moving], grad[moving]
+
+            cur_alpha = alpha[active].copy()
+
+            new_H, new_obj = self.try_step_batch(V_a, H_a, cur_alpha, grad)
+
+            assert not N.any(N.isnan(new_obj))
+
+            cur_failure_rate = (1. - self.time_constant) * failure_rate[active] \
+                    + self.time_constant * (new_obj > obj)
+            failure_rate[active] = cur_failure_rate
+
+            shrink = (cur_failure_rate > .6) & (alpha[active] > 1e-7)
+            grow = (cur_failure_rate < .3) & ~ shrink
+            alpha[active[shrink]] *= .9
+            alpha[active[grow]] *= 1.1
+
+            assert N.all(alpha > 9e-8)
+
+            #backtrack on the rows whose objective did not decrease. rows whose
+            #step size gets too small accept their last try and are frozen
+            gave_up = N.zeros(len(active), dtype='bool')
+            retry = N.nonzero(new_obj >= obj)[0]
+            while len(retry) > 0:
+                cur_alpha[retry] *= .9
+                too_small = cur_alpha[retry] < 1e-12
+                gave_up[retry[too_small]] = True
+                retry = retry[~ too_small]
+                if len(retry) == 0:
+                    break
+                retry_H, retry_obj = self.try_step_batch(V_a[retry], H_a[retry],
+                        cur_alpha[retry], grad[retry])
+                assert not N.any(N.isnan(retry_obj))
+                new_H[retry] = retry_H
+                new_obj[retry] = retry_obj
+                retry = retry[retry_obj >= obj[retry]]
+            #
+
+            H[active] = new_H
+            active = active[~ gave_up]
+        #
+
+        self.alpha = N.cast[floatX](alpha.mean())
+        self.failure_rate = failure_rate.mean()
+
+        if out is None:
+            return H
+        out[...] = H
+        return out
+
+    def _optimize_h_rows(self, X, out, alpha = None, failure_rate = None):
+        #when run by a worker process the step size adaptation state is
+        #passed in from the parent and the final state is sent back
+        if alpha is not None:
+            self.alpha = alpha
+            self.failure_rate = failure_rate
+
+        if getattr(self, 'batch_inference', False):
+            self.optimize_h_vectorized(X, out)
+        else:
+            for i in xrange(X.shape[0]):
+                assert self.alpha > 9e-8
+                out[i,:] = self.optimize_h(X[i,:])
+                assert self.alpha > 9e-8
+            #
+
+        return self.alpha, self.failure_rate
+
+    def optimize_h_batch(self, X, out = None):
+        """
+        Returns a matrix whose rows are optimize_h applied to the rows of X.
+        If out is given, the codes are written to it.
+
+        When using several workers, each block of rows starts from the
+        current step size adaptation state (alpha, failure_rate), and the
+        state carried over to the next call is the final state of the last
+        block, as the serial loop carries over the state reached on the
+        last rows. The rows of a block other than the first therefore use
+        different step sizes than the serial loop would, so the codes only
+        match the serial ones up to the tolerance of the optimization.
+        """
+        if out is None:
+            out = N.zeros((X.shape[0],self.nhid),dtype=floatX)
+
+        if getattr(self, 'num_workers', 1) > 1:
+            if getattr(self, '_inference', None) is None:
+                self._inference = RowParallelInference(self, '_optimize_h_rows',
+                        ['W', 'pred_W', 'pred_b', 'pred_g', 'p', 'lamda'],
+                        self.nhid, self.num_workers)
+            out, states = self._inference(X, out,
+                    args = (self.alpha, self.failure_rate))
+            alpha, failure_rate = states[-1]
+            self.alpha = N.cast[floatX](alpha)
+            self.failure_rate = failure_rate
+        else:
+            self._optimize_h_rows(X, out)
+
+        return out
+
     def learn(self, dataset, batch_size):
         self.learn_mini_batch(dataset.get_batch_design(batch_size))
     #
@@ -299,15 +465,7 @@ class DifferentiableSparseCoding(object):
     def learn_mini_batch(self, x):
         assert self.alpha > 9e-8
 
-        batch_size = x.shape[0]
-
-        H = N.zeros((batch_size,self.nhid),dtype=floatX)
-
-        for i in xrange(batch_size):
-            assert self.alpha > 9e-8
-            H[i,:] = self.optimize_h(x[i,:])
-            assert self.alpha > 9e-8
-        #
+        H = self.optimize_h_batch(x)
 
         self.code_learning_step(x,H,self.learning_rate)
         self.normalize_W()
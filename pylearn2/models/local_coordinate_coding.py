@@ -2,15 +2,22 @@ import warnings
 from theano import function, shared
 from pylearn2.optimization import linear_cg as cg
 from pylearn2.optimization.feature_sign import feature_sign_search
+from pylearn2.utils.parallel import RowParallelInference
 import numpy as N
 import theano.tensor as T
 
 
 class LocalCoordinateCoding(object):
-    def __init__(self, nvis, nhid, coeff):
+    def __init__(self, nvis, nhid, coeff, num_workers=1):
+        """
+        num_workers: if greater than 1, the codes for a minibatch are
+        inferred by this many worker processes (see
+        pylearn2.utils.parallel.RowParallelInference)
+        """
         self.nvis = nvis
         self.nhid = nhid
         self.coeff = float(coeff)
+        self.num_workers = num_workers
         self.rng = N.random.RandomState([1, 2, 3])
 
         self.redo_everything()
@@ -38,6 +45,27 @@ class LocalCoordinateCoding(object):
         g = x / c
         return g
 
+    def _optimize_gamma_rows(self, X, out):
+        for i in xrange(X.shape[0]):
+            out[i, :] = self.optimize_gamma(X[i, :])
+
+    def optimize_gamma_batch(self, X, out=None):
+        """
+        Returns a matrix whose rows are optimize_gamma applied to the rows
+        of X. If out is given, the codes are written to it.
+        """
+        if out is None:
+            out = N.zeros((X.shape[0], self.nhid))
+        if getattr(self, 'num_workers', 1) > 1:
+            if getattr(self, '_inference', None) is None:
+                self._inference = RowParallelInference(
+                        self, '_optimize_gamma_rows', ['W'], self.nhid,
+                        self.num_workers, output_dtype=out.dtype)
+            self._inference(X, out)
+        else:
+            self._optimize_gamma_rows(X, out)
+        return out
+
     def learn(self, dataset, batch_size):
         #TODO-- this results in compilation happening every time learn is
         # called should cache the compilation results, including those
@@ -91,9 +119,7 @@ class LocalCoordinateCoding(object):
 
         #TODO-- optimize gamma
         print 'optimizing gamma'
-        for i in xrange(batch_size):
-            #print str(i+1)+'/'+str(batch_size)
-            gamma[i, :] = self.optimize_gamma(batch_X[i, :])
+        self.optimize_gamma_batch(batch_X, out=gamma)
 
         print 'max min'
         print N.abs(gamma).min(axis=0).max()
@@ -199,6 +199,13 @@ class Model(object):
 
         All Theano functions compiled by this method should be registered
         with the register_names_to_del method.
+
+        Functions that are only needed by some callers can instead be
+        built by methods decorated with
+        `pylearn2.utils.lazy.lazy_function`, which compiles them on first
+        use and registers them with register_names_to_del. redo_theano
+        should then discard them with
+        `pylearn2.utils.lazy.reset_lazy_functions`.
         """
         pass
 
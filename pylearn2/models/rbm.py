@@ -17,6 +17,8 @@ from theano.tensor import nnet
 # Local imports
 from pylearn2.base import Block, StackedBlocks
 from pylearn2.utils import as_floatX, safe_update, sharedX
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.lazy import lazy_function, reset_lazy_functions
 from pylearn2.models import Model
 from pylearn2.optimizer import SGDOptimizer
 from pylearn2.expr.basic import theano_norms
@@ -121,7 +123,8 @@ class BlockGibbsSampler(Sampler):
        International Conference on Machine Learning, Helsinki, Finland,
        2008. http://www.cs.toronto.edu/~tijmen/pcd/pcd.pdf
     """
-    def __init__(self, rbm, particles, rng, steps=1, particles_clip=None):
+    def __init__(self, rbm, particles, rng, steps=1, particles_clip=None,
+                 use_scan=True):
         """
         Construct a BlockGibbsSampler.
 
@@ -142,10 +145,24 @@ class BlockGibbsSampler(Sampler):
         particles_clip: None or (min, max) pair
             The values of the returned particles will be clipped between
             min and max.
+        use_scan : bool, optional
+            If True (the default), the Gibbs steps are run by a single
+            scan, so the size of the graph and the compilation time don't
+            depend on `steps`, and only the last state of the chain is
+            kept in memory. If False, the steps are unrolled in the graph.
         """
         super(BlockGibbsSampler, self).__init__(rbm, particles, rng)
         self.steps = steps
         self.particles_clip = particles_clip
+        self.use_scan = use_scan
+
+    def _gibbs_step(self, particles):
+        particles, _locals = self.rbm.gibbs_step_for_v(
+            particles,
+            self.s_rng
+        )
+        assert particles.type.dtype == self.particles.type.dtype
+        return _clip_particles(particles, self.particles_clip)
 
     def updates(self, particles_clip=None):
         """
@@ -158,34 +175,206 @@ class BlockGibbsSampler(Sampler):
             Dictionary with shared variable instances as keys and symbolic
             expressions indicating how they should be updated as values.
         """
-        steps = self.steps
+        # Samplers pickled before use_scan existed unroll the steps
+        if self.steps > 1 and getattr(self, 'use_scan', False):
+            chain, updates = theano.scan(self._gibbs_step,
+                                         outputs_info=[self.particles],
+                                         n_steps=self.steps)
+            # updates holds those of the random streams used in the scan
+            updates[self.particles] = chain[-1]
+            return updates
+
         particles = self.particles
-        # TODO: do this with scan?
-        for i in xrange(steps):
-            particles, _locals = self.rbm.gibbs_step_for_v(
-                particles,
-                self.s_rng
-            )
-            assert particles.type.dtype == self.particles.type.dtype
-            if self.particles_clip is not None:
-                p_min, p_max = self.particles_clip
-                # The clipped values should still have the same type
-                dtype = particles.dtype
-                p_min = tensor.as_tensor_variable(p_min)
-                if p_min.dtype != dtype:
-                    p_min = tensor.cast(p_min, dtype)
-                p_max = tensor.as_tensor_variable(p_max)
-                if p_max.dtype != dtype:
-                    p_max = tensor.cast(p_max, dtype)
-                particles = tensor.clip(particles, p_min, p_max)
-        if not hasattr(self.rbm, 'h_sample'):
-            self.rbm.h_sample = sharedX(numpy.zeros((0, 0)), 'h_sample')
-        return {
-            self.particles: particles,
-            # TODO: self.rbm.h_sample is never used, why is that here?
-            # Moreover, it does not make sense for things like ssRBM.
-            self.rbm.h_sample: _locals['h_mean']
-        }
+        for i in xrange(self.steps):
+            particles = self._gibbs_step(particles)
+        return {self.particles: particles}
+
+
+class ParallelTemperingSampler(Sampler):
+    """
+    Implements persistent Markov chains on a ladder of tempered versions
+    of the model, whose energies are multiplied by inverse temperatures
+    1 = betas[0] > betas[1] > ... > 0, with swaps of states between
+    adjacent temperatures [1]. The chains at high temperature mix faster
+    and pass their states down the ladder, which helps the negative
+    particles (the chains at inverse temperature 1) move between the
+    modes of the model.
+
+    The chains of all the temperatures are held in a single shared matrix,
+    `replicas`, whose rows `k * n` to `(k + 1) * n` are the `n` chains at
+    inverse temperature `betas[k]`, so that all the Gibbs steps are done by
+    one batched graph. At each update, every chain is paired with the chain
+    of the same index at the next or previous temperature, alternately
+    starting from the first and the second temperature, and all the swaps
+    are proposed and accepted or rejected at once.
+
+    The model must implement `tempered_gibbs_step_for_v` and
+    `tempered_free_energy_given_v`.
+
+    .. [1] G. Desjardins, A. Courville, Y. Bengio, P. Vincent and
+       O. Delalleau. "Tempered Markov Chain Monte Carlo for training of
+       Restricted Boltzmann Machines". Proceedings of the 13th
+       International Conference on Artificial Intelligence and
+       Statistics, 2010.
+    """
+    def __init__(self, rbm, particles, rng, betas=None, steps=1,
+                 particles_clip=None, use_scan=True):
+        """
+        Construct a ParallelTemperingSampler.
+
+        Parameters
+        ----------
+        rbm : object
+            An instance of `RBM` or a derived class, or one implementing
+            the `tempered_gibbs_step_for_v` and
+            `tempered_free_energy_given_v` interface.
+        particles : ndarray
+            An initial state for the set of persistent Markov chain particles
+            at inverse temperature 1. The chains at the other temperatures
+            start from the same state.
+        rng : RandomState object
+            NumPy random number generator object used to initialize a
+            RandomStreams object used in training.
+        betas : array_like, optional
+            Decreasing inverse temperatures, the first of which must be 1.
+            Defaults to 10 evenly spaced values from 1 to 0.1.
+        steps : int, optional
+            Number of Gibbs steps to run the Markov chains for at each
+            iteration, before the swaps.
+        particles_clip: None or (min, max) pair
+            The values of the returned particles will be clipped between
+            min and max.
+        use_scan : bool, optional
+            If True (the default), the Gibbs steps are run by a single
+            scan. If False, they are unrolled in the graph.
+        """
+        if betas is None:
+            betas = numpy.linspace(1., .1, 10)
+        betas = numpy.asarray(betas, dtype='float64')
+        if (betas.ndim != 1 or betas[0] != 1 or betas[-1] <= 0 or
+                numpy.any(numpy.diff(betas) >= 0)):
+            raise ValueError('betas should decrease from 1 to a positive '
+                             'value, got %s' % betas)
+        particles = numpy.asarray(particles)
+        super(ParallelTemperingSampler, self).__init__(
+            rbm, numpy.tile(particles, (len(betas), 1)), rng)
+        self.replicas = self.particles
+        self.replicas.name = 'replicas'
+        # The negative particles are the chains at inverse temperature 1
+        self.particles = self.replicas[:particles.shape[0]]
+        self.num_chains = particles.shape[0]
+        self.betas = betas
+        self.steps = steps
+        self.particles_clip = particles_clip
+        self.use_scan = use_scan
+        # Whether the next swaps pair the first temperature with the
+        # second (0) or the second with the third (1)
+        self.swap_parity = theano.shared(numpy.asarray(0, dtype='int64'),
+                                         name='swap_parity')
+
+    def _gibbs_step(self, replicas):
+        replicas, _locals = self.rbm.tempered_gibbs_step_for_v(
+            replicas,
+            self._beta_rows(),
+            self.s_rng
+        )
+        assert replicas.type.dtype == self.replicas.type.dtype
+        return _clip_particles(replicas, self.particles_clip)
+
+    def _beta_rows(self, partners=None):
+        """
+        Returns the inverse temperature of each row of `replicas`, or of
+        the partner of its temperature in `partners`.
+        """
+        betas = tensor.as_tensor_variable(as_floatX(self.betas))
+        if partners is not None:
+            betas = betas[partners]
+        return tensor.repeat(betas, self.num_chains)
+
+    def _swap(self, replicas):
+        """
+        Proposes to swap the states of the chains of each pair of
+        adjacent temperatures, and returns the replicas after the accepted
+        swaps.
+        """
+        K = len(self.betas)
+        n = self.num_chains
+        partners = tensor.as_tensor_variable(numpy.array(
+            [_swap_partners(K, parity) for parity in (0, 1)]))
+        partners = partners[self.swap_parity]
+
+        # The swap of x_i and x_j between the temperatures beta_i and
+        # beta_j is accepted with probability
+        # min(1, exp(F_i(x_i) + F_j(x_j) - F_i(x_j) - F_j(x_i)))
+        # where F_i is the free energy at inverse temperature beta_i.
+        own = self.rbm.tempered_free_energy_given_v(
+            replicas, self._beta_rows()).reshape((K, n))
+        other = self.rbm.tempered_free_energy_given_v(
+            replicas, self._beta_rows(partners)).reshape((K, n))
+        log_ratio = own + own[partners] - other - other[partners]
+        # Both chains of a pair use the same uniform draw, that of the
+        # first one. Unpaired temperatures are their own partner and
+        # swap with themselves.
+        u = self.s_rng.uniform(size=(K, n), dtype=log_ratio.dtype)
+        u = u[tensor.minimum(tensor.arange(K), partners)]
+        accept = tensor.log(u) < log_ratio
+
+        states = replicas.reshape((K, n, replicas.shape[1]))
+        states = tensor.switch(accept.dimshuffle(0, 1, 'x'),
+                               states[partners], states)
+        return states.reshape(replicas.shape)
+
+    def updates(self):
+        """
+        Get the dictionary of updates for the sampler's persistent state
+        at each step.
+
+        Returns
+        -------
+        updates : dict
+            Dictionary with shared variable instances as keys and symbolic
+            expressions indicating how they should be updated as values.
+        """
+        if self.steps > 1 and self.use_scan:
+            chain, updates = theano.scan(self._gibbs_step,
+                                         outputs_info=[self.replicas],
+                                         n_steps=self.steps)
+            replicas = chain[-1]
+        else:
+            updates = {}
+            replicas = self.replicas
+            for i in xrange(self.steps):
+                replicas = self._gibbs_step(replicas)
+        updates[self.replicas] = self._swap(replicas)
+        updates[self.swap_parity] = 1 - self.swap_parity
+        return updates
+
+
+def _swap_partners(num_temperatures, parity):
+    """
+    Returns the index of the temperature each temperature is paired with
+    for the swaps: the pairs are (parity, parity + 1), (parity + 2,
+    parity + 3), ... and the unpaired temperatures are their own partner.
+    """
+    partners = numpy.arange(num_temperatures)
+    for k in xrange(parity, num_temperatures - 1, 2):
+        partners[k], partners[k + 1] = k + 1, k
+    return partners
+
+
+def _clip_particles(particles, particles_clip):
+    if particles_clip is None:
+        return particles
+    p_min, p_max = particles_clip
+    # The clipped values should still have the same type
+    dtype = particles.dtype
+    p_min = tensor.as_tensor_variable(p_min)
+    if p_min.dtype != dtype:
+        p_min = tensor.cast(p_min, dtype)
+    p_max = tensor.as_tensor_variable(p_max)
+    if p_max.dtype != dtype:
+        p_max = tensor.cast(p_max, dtype)
+    return tensor.clip(particles, p_min, p_max)
 
 
 class RBM(Block, Model):
@@ -414,17 +603,18 @@ class RBM(Block, Model):
     def learn_mini_batch(self, X):
         """ A default learning rule based on SML """
 
-        if not hasattr(self, 'learn_func'):
-            self.redo_theano()
-
         rval =  self.learn_func(X)
 
         return rval
 
     def redo_theano(self):
-        """ Compiles the theano function for the default learning rule """
+        """ Discards learn_func, which is compiled again the first time
+        it is used """
+        reset_lazy_functions(self)
 
-        init_names = dir(self)
+    @lazy_function
+    def learn_func(self):
+        """ The theano function for the default learning rule """
 
         minibatch = tensor.matrix()
 
@@ -437,11 +627,7 @@ class RBM(Block, Model):
         updates = training_updates(visible_batch=minibatch, model=self,
                                             sampler=sampler, optimizer=optimizer)
 
-        self.learn_func = theano.function([minibatch], updates=updates)
-
-        final_names = dir(self)
-
-        self.register_names_to_del([name for name in final_names if name not in init_names])
+        return function([minibatch], updates=updates)
 
     def gibbs_step_for_v(self, v, rng):
         """
@@ -554,7 +740,7 @@ class RBM(Block, Model):
             visible unit for each row of h.
         """
         if isinstance(h, tensor.Variable):
-            return self.bias_vis + tensor.dot(h, self.weights.T)
+            return self.bias_vis + self.transformer.lmul_T(h)
         else:
             return [self.input_to_v_from_h(hid) for hid in h]
 
@@ -603,7 +789,7 @@ class RBM(Block, Model):
             hidden units.
         """
         if isinstance(h, tensor.Variable):
-            return nnet.sigmoid(self.bias_vis + tensor.dot(h, self.weights.T))
+            return nnet.sigmoid(self.input_to_v_from_h(h))
         else:
             return [self.mean_v_given_h(hid) for hid in h]
 
@@ -651,6 +837,68 @@ class RBM(Block, Model):
         return (-tensor.dot(h, self.bias_hid) -
                 nnet.softplus(sigmoid_arg).sum(axis=1))
 
+    def tempered_gibbs_step_for_v(self, v, beta, rng):
+        """
+        Do a round of block Gibbs sampling given visible configuration, in
+        the models whose energy is multiplied by an inverse temperature.
+
+        Parameters
+        ----------
+        v  : tensor_like
+            Theano symbolic representing the visible unit states of a batch
+            of Markov chains, with the first dimension indexing chains and
+            the second indexing data dimensions.
+        beta : tensor_like
+            Theano symbolic vector holding the inverse temperature of each
+            row of v.
+        rng : RandomStreams object
+            Random number generator to use for sampling the hidden and visible
+            units.
+
+        Returns
+        -------
+        v_sample : tensor_like
+            Theano symbolic representing the new visible unit state after one
+            round of Gibbs sampling.
+        locals : dict
+            Contains the auxiliary state of the step, as in
+            `gibbs_step_for_v`.
+        """
+        beta = beta.dimshuffle(0, 'x')
+        h_mean = nnet.sigmoid(beta * self.input_to_h_from_v(v))
+        h_sample = rng.binomial(size=h_mean.shape, n=1, p=h_mean,
+                                dtype=h_mean.type.dtype)
+        v_mean = nnet.sigmoid(beta * self.input_to_v_from_h(h_sample))
+        v_sample = self.sample_visibles([v_mean], v_mean.shape, rng)
+        assert v_sample.type.dtype == v.type.dtype
+        return v_sample, locals()
+
+    def tempered_free_energy_given_v(self, v, beta):
+        """
+        Calculate the free energy of visible unit configurations in the
+        models whose energy is multiplied by an inverse temperature.
+
+        Parameters
+        ----------
+        v : tensor_like
+            Theano symbolic representing the visible unit states, with the
+            first dimension indexing examples and the second indexing data
+            dimensions.
+        beta : tensor_like
+            Theano symbolic vector holding the inverse temperature of each
+            row of v.
+
+        Returns
+        -------
+        f : tensor_like
+            1-dimensional tensor (vector) representing the free energy
+            associated with each row of v, up to a constant depending only
+            on its inverse temperature.
+        """
+        sigmoid_arg = beta.dimshuffle(0, 'x') * self.input_to_h_from_v(v)
+        return (-beta * tensor.dot(v, self.bias_vis) -
+                 nnet.softplus(sigmoid_arg).sum(axis=1))
+
     def __call__(self, v):
         """
         Forward propagate (symbolic) input through this module, obtaining
@@ -837,6 +1085,34 @@ class GaussianBinaryRBM(RBM):
         return self.energy_function.free_energy(V)
     #
 
+    def tempered_gibbs_step_for_v(self, v, beta, rng):
+        """
+        Do a round of block Gibbs sampling given visible configuration, in
+        the models whose energy is multiplied by an inverse temperature,
+        following the conditionals of the energy function. See
+        `RBM.tempered_gibbs_step_for_v`.
+        """
+        h_mean = self.energy_function.tempered_mean_H_given_V(v, beta)
+        h_sample = rng.binomial(size=h_mean.shape, n=1, p=h_mean,
+                                dtype=h_mean.type.dtype)
+        v_mean = self.mean_v_given_h(h_sample)
+        if self.mean_vis:
+            v_sample = v_mean
+        else:
+            # The variance of the visibles is divided by beta
+            v_sample = v_mean + (rng.normal(size=v_mean.shape) * self.sigma /
+                                 tensor.sqrt(beta).dimshuffle(0, 'x'))
+        assert v_sample.type.dtype == v.type.dtype
+        return v_sample, locals()
+
+    def tempered_free_energy_given_v(self, V, beta):
+        """
+        Calculate the free energy of visible unit configurations in the
+        models whose energy is multiplied by an inverse temperature. See
+        `RBM.tempered_free_energy_given_v`.
+        """
+        return self.energy_function.tempered_free_energy(V, beta)
+
     def sample_visibles(self, params, shape, rng):
         """
         Stochastically sample the visible units given hidden unit
@@ -971,6 +1247,30 @@ class mu_pooled_ssRBM(RBM):
         del batch_size
         return v_sample, locals()
 
+    def tempered_gibbs_step_for_v(self, v, beta, rng):
+        # Multiplying the energy by beta multiplies the input to h and
+        # divides the variances of s and v by beta, leaving their means
+        # unchanged.
+        batch_size = v.shape[0]
+        beta = beta.dimshuffle(0, 'x')
+
+        h_mean = nnet.sigmoid(beta * self.input_to_h_from_v(v))
+        h_mean_shape = (batch_size, self.nhid)
+        h_sample = as_floatX(rng.uniform(size=h_mean_shape) < h_mean)
+
+        s_mu, s_var = self.mean_var_s_given_v_h1(v)
+        s_mu_shape = (batch_size, self.nslab)
+        s_sample = (s_mu +
+                    rng.normal(size=s_mu_shape) * tensor.sqrt(s_var / beta))
+
+        v_mean, v_var = self.mean_var_v_given_h_s(h_sample, s_sample)
+        v_mean_shape = (batch_size, self.nvis)
+        v_sample = (v_mean +
+                    rng.normal(size=v_mean_shape) * tensor.sqrt(v_var / beta))
+
+        del batch_size
+        return v_sample, locals()
+
     ## TODO?
     def sample_visibles(self, params, shape, rng):
         raise NotImplementedError('mu_pooled_ssRBM.sample_visibles')
@@ -1020,6 +1320,12 @@ class mu_pooled_ssRBM(RBM):
                 0.5 * (self.B * (v ** 2)).sum(axis=1),
                 -tensor.nnet.softplus(sigmoid_arg).sum(axis=1))
 
+    def tempered_free_energy_given_v(self, v, beta):
+        sigmoid_arg = beta.dimshuffle(0, 'x') * self.input_to_h_from_v(v)
+        return tensor.add(
+                0.5 * beta * (self.B * (v ** 2)).sum(axis=1),
+                -tensor.nnet.softplus(sigmoid_arg).sum(axis=1))
+
     #def __call__(self, v):
     #    inherited version is OK
 
@@ -7,7 +7,9 @@ __maintainer__ = "Ian Goodfellow"
 
 import time
 from pylearn2.models import Model
-from theano import config, function
+from theano import config
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.lazy import lazy_function, reset_lazy_functions
 import theano.tensor as T
 import numpy as np
 import warnings
@@ -1094,8 +1096,12 @@ class S3C(Model, Block):
             self.censored_updates[param] = set([])
 
     def redo_theano(self):
+        """ Makes the symbolic pseudo-parameters and registers the model with
+        the E step. The compiled functions (learn_func and get_B_value) are
+        compiled the first time they are used. """
 
         self.reset_censorship_cache()
+        reset_lazy_functions(self)
 
         if not self.autonomous:
             return
@@ -1108,16 +1114,25 @@ class S3C(Model, Block):
 
             self.e_step.register_model(self)
 
-            self.get_B_value = function([], self.B)
+            final_names = dir(self)
 
-            X = T.matrix(name='V')
-            X.tag.test_value = np.cast[config.floatX](self.rng.randn(self.test_batch_size,self.nvis))
+            self.register_names_to_del([name for name in final_names if name not in init_names])
+        finally:
+            self.deploy_mode()
 
-            self.learn_func = self.make_learn_func(X)
+    @lazy_function
+    def get_B_value(self):
+        return function([], self.B)
 
-            final_names = dir(self)
+    @lazy_function
+    def learn_func(self):
+        try:
+            self.compile_mode()
 
-            self.register_names_to_del([name for name in final_names if name not in init_names])
+            X = T.matrix(name='V')
+            X.tag.test_value = np.cast[config.floatX](self.rng.randn(self.test_batch_size,self.nvis))
+
+            return self.make_learn_func(X)
         finally:
             self.deploy_mode()
 
@@ -1152,6 +1167,12 @@ class S3C(Model, Block):
             print 'W: ',(W.min(),W.mean(),W.max())
             norms = numpy_norms(W)
             print 'W norms:',(norms.min(),norms.mean(),norms.max())
+            summary = lambda x: [ float(x.min()), float(x.mean()), float(x.max()) ]
+            self.monitor.log_event('status', model = 'S3C',
+                    examples_seen = self.monitor.examples_seen,
+                    p = summary(p), B = summary(B), mu = summary(mu),
+                    alpha = summary(alpha), W = summary(W),
+                    W_norms = summary(norms))
 
     def learn_mini_batch(self, X):
 
@@ -0,0 +1,55 @@
+import numpy as np
+from theano import config
+from pylearn2.models.differentiable_sparse_coding import DifferentiableSparseCoding
+
+def test_optimize_h_vectorized():
+    #tests that inferring the codes for a whole batch at once reaches the
+    #same objective as inferring them one example at a time
+    rng = np.random.RandomState([1,2,3])
+    X = np.cast[config.floatX](rng.randn(10,5))
+
+    model = DifferentiableSparseCoding(nvis = 5, nhid = 4, init_lambda = .1,
+            init_p = .1, init_alpha = .1, learning_rate = .01)
+
+    H_rows = np.zeros((10,4), dtype = config.floatX)
+    for i in xrange(10):
+        H_rows[i,:] = model.optimize_h(X[i,:])
+
+    H_batch = model.optimize_h_vectorized(X)
+
+    obj_rows, grad_rows = model.coding_obj_grad_batch(X, H_rows)
+    obj_batch, grad_batch = model.coding_obj_grad_batch(X, H_batch)
+
+    assert np.allclose(obj_rows, obj_batch)
+
+def test_optimize_h_batch_workers():
+    #tests that inferring the codes with several workers matches the serial
+    #loop up to the optimization tolerance, and that the workers are
+    #replaced when the model is recompiled
+    rng = np.random.RandomState([1,2,3])
+    X = np.cast[config.floatX](rng.randn(10,5))
+
+    def make_model(num_workers):
+        return DifferentiableSparseCoding(nvis = 5, nhid = 4, init_lambda = .1,
+                init_p = .1, init_alpha = .1, learning_rate = .01,
+                num_workers = num_workers)
+
+    serial = make_model(1)
+    model = make_model(2)
+    try:
+        H_serial = serial.optimize_h_batch(X)
+        H = model.optimize_h_batch(X)
+        assert np.allclose(H, H_serial, atol = 1e-5)
+
+        inference = model._inference
+        model.redo_everything()
+        assert model._inference is None
+        assert inference._pool is None
+
+        serial.redo_everything()
+        H_serial = serial.optimize_h_batch(X)
+        H = model.optimize_h_batch(X)
+        assert np.allclose(H, H_serial, atol = 1e-5)
+    finally:
+        if model._inference is not None:
+            model._inference.close()
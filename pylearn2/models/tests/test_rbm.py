@@ -1,4 +1,9 @@
-from pylearn2.models.rbm import RBM
+import itertools
+
+import numpy as np
+import theano
+
+from pylearn2.models.rbm import RBM, BlockGibbsSampler, ParallelTemperingSampler
 
 def test_get_weights():
 
@@ -11,3 +16,55 @@ def test_get_input_space():
     model = RBM(nvis = 2, nhid = 3)
 
     space = model.get_input_space()
+
+def test_block_gibbs_sampler_scan():
+
+    model = RBM(nvis = 2, nhid = 3)
+
+    # the scan's graph doesn't grow with the number of steps
+    sizes = []
+    for steps in [2, 20]:
+        sampler = BlockGibbsSampler(model, np.zeros((5, 2)), 1, steps = steps)
+        updates = sampler.updates()
+        assert sampler.particles in updates
+        f = theano.function([], updates = updates)
+        f()
+        sizes.append(len(f.maker.fgraph.toposort()))
+    assert sizes[0] == sizes[1]
+
+    particles = sampler.particles.get_value()
+    assert particles.shape == (5, 2)
+    assert np.all((particles == 0) | (particles == 1))
+
+def test_parallel_tempering_sampler():
+
+    rng = np.random.RandomState(0)
+    nvis = 4
+    model = RBM(nvis = nvis, nhid = 3, irange = 3., rng = rng)
+    betas = [1., .6, .3, .1]
+    n = 2000
+    sampler = ParallelTemperingSampler(model, np.zeros((n, nvis)), rng,
+                                       betas = betas, steps = 2)
+    f = theano.function([], updates = sampler.updates())
+    for i in xrange(200):
+        f()
+
+    replicas = sampler.replicas.get_value()
+    assert replicas.shape == (len(betas) * n, nvis)
+    assert np.all(theano.function([], sampler.particles)() == replicas[:n])
+
+    # the chains of each temperature sample the tempered model
+    V = theano.tensor.matrix()
+    beta = theano.tensor.vector()
+    free_energy = theano.function([V, beta],
+            model.tempered_free_energy_given_v(V, beta))
+    states = np.array(list(itertools.product([0, 1], repeat = nvis)),
+                      dtype = theano.config.floatX)
+    for k, b in enumerate(betas):
+        F = free_energy(states, np.zeros(len(states), states.dtype) + b)
+        p = np.exp(F.min() - F)
+        p /= p.sum()
+        chains = replicas[k * n:(k + 1) * n].astype(int)
+        counts = np.bincount(np.dot(chains, 2 ** np.arange(nvis)[::-1]),
+                             minlength = len(states))
+        assert 0.5 * np.abs(counts / float(n) - p).sum() < .1
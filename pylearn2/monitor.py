@@ -1,10 +1,15 @@
 """TODO: module-level docstring."""
+import sys
+import threading
 import time
+import warnings
 import numpy
-from theano import function, shared
+from theano import shared
 import theano.tensor as T
 import copy
 from pylearn2.config import yaml_parse
+from pylearn2.metrics import MetricsWriter
+from pylearn2.utils.function_cache import function
 
 
 class Monitor(object):
@@ -16,6 +21,18 @@ class Monitor(object):
     quantities of interest (examples: the objective function, measures of
     hidden unit activity, reconstruction error, sum of squared second
     derivatives,  etc.)
+
+    All the channels are computed by a single compiled function, in one
+    pass over (a prefix of) the monitoring dataset. Channel values are
+    assumed to be means over a batch, and are averaged over the pass
+    weighting each batch by its size.
+
+    If `set_dataset` was asked to evaluate in the background, each call
+    copies the values of the model's parameters and evaluates the channels
+    with the copy on a separate thread, while training goes on. The
+    records are added at the start of the next call, or when `wait` is
+    called, so code that reads them right after calling the monitor sees
+    the previous evaluation.
     """
     def __init__(self, model):
         """
@@ -35,12 +52,23 @@ class Monitor(object):
         self.dataset = None
         self.dirty = True
         self.names_to_del = []
+        self.batches = None
+        self.batch_size = None
+        self.frequency = 1
+        self.time_budget = None
+        self.background = False
+        self.calls = 0
+        self._worker = None
+        self._pending = None
+        self.metrics = None
+        self.register_names_to_del(['_worker', '_pending', 'metrics'])
         #Determine whether the model should use topological or vector form of examples
         #If the model acts on a space with more than the batch index and channel dimension,
         #the model has topological dimensions, so the topological view of the data should be used
         self.topo = len(model.get_input_space().make_theano_batch().type.broadcastable) > 2
 
-    def set_dataset(self, dataset, batches, batch_size):
+    def set_dataset(self, dataset, batches, batch_size, frequency=1,
+                    time_budget=None, background=False):
         """
         Determines the data used to calculate the values of each channel.
 
@@ -49,9 +77,22 @@ class Monitor(object):
         dataset : object
             A `pylearn2.datasets.Dataset` object.
         batches : int
-            Number of batches of examples to draw.
+            Number of batches of examples to draw. The first `batches`
+            batches of the dataset are used. If None or negative, the
+            whole dataset is used.
         batch_size : int
             The number of examples per batch.
+        frequency : int, optional
+            The channels are only evaluated on every `frequency`-th call
+            (the first call always evaluates them).
+        time_budget : float, optional
+            If not None, stop drawing batches once an evaluation has taken
+            this many seconds, and average over the batches seen so far.
+        background : bool, optional
+            If True, evaluate the channels on a background thread, with a
+            copy of the model's parameters (see the class docstring).
+            Ignored if some channel has prereqs, since those may modify
+            the state of the model.
         """
         # TODO: why is this not specifiable via the constructor? Is it
         # intended that you be able to switch datasets after using it for
@@ -60,24 +101,35 @@ class Monitor(object):
         # TODO: maybe error checking; check dataset has the appropriate
         # attributes for use by the monitor. Check that batches and batch_size
         # work as indices.
+        if frequency < 1:
+            raise ValueError("frequency must be at least 1, got " +
+                             str(frequency))
+        self.wait()
         self.dataset = dataset
         self.batches = batches
         self.batch_size = batch_size
+        self.frequency = frequency
+        self.time_budget = time_budget
+        if background != self.background:
+            # Evaluating with a copy of the parameters takes a different
+            # function
+            self.dirty = True
+        self.background = background
 
     def __call__(self):
         """
         Runs the model on the monitoring dataset in order to add one
         data point to each of the channels.
         """
+        self.wait()
+
+        self.calls += 1
+        if (self.calls - 1) % self.frequency != 0:
+            return
 
         if self.dirty:
             self.redo_theano()
 
-        model = self.model
-
-        #W = model.W.get_value()
-        #print 'monitoring weights ',':',(W.min(),W.mean(),W.max(),W.shape)
-
         d = self.dataset
 
         if d:
@@ -85,38 +137,112 @@ class Monitor(object):
                 d = yaml_parse.load(d)
                 self.dataset = d
 
-            myiterator = d.iterator(mode='sequential',
-                                    batch_size=self.batch_size,
-                                    topo=self.topo)
-            self.begin_record_entry()
-
-            for X in myiterator:
-                self.run_prereqs(X)
-                self.accum(X)
-
+            seen = (self.batches_seen, self.examples_seen, self.calls - 1,
+                    time.time())
+
+            if self.background and len(self.prereqs) == 0:
+                for param, copy_ in zip(self.model.get_params(),
+                                        self.param_copies):
+                    copy_.set_value(param.get_value())
+                self._worker = threading.Thread(target=self._run_worker,
+                                                args=(d, seen))
+                self._worker.start()
+            else:
+                values = self.evaluate(d)
+                self.record_entry(seen, values, time.time() - seen[3])
+
+    def _run_worker(self, dataset, seen):
+        try:
+            values = self.evaluate(dataset)
+            self._pending = (seen, values, time.time() - seen[3], None)
+        except Exception:
+            self._pending = (seen, None, None, sys.exc_info())
+
+    def wait(self):
+        """
+        Waits for the evaluation running in the background, if any, and
+        adds its results to the records.
+        """
+        worker = getattr(self, '_worker', None)
+        if worker is None:
+            return
+        worker.join()
+        self._worker = None
+        seen, values, duration, exc_info = self._pending
+        self._pending = None
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.record_entry(seen, values, duration)
+
+    def evaluate(self, dataset):
+        """
+        Returns the value of each channel (in the order of
+        `self.channel_names`) on `dataset`.
+        """
+        batches = self.batches
+        if batches is not None and batches < 0:
+            batches = None
+        # Sequential iteration doesn't draw from the dataset's rng
+        myiterator = dataset.iterator(mode='sequential',
+                                      batch_size=self.batch_size,
+                                      topo=self.topo)
+        totals = numpy.zeros(len(self.channel_names))
+        num_batches = 0
+        num_examples = 0
+        start = time.time()
+        for X in myiterator:
+            self.run_prereqs(X)
+            totals += X.shape[0] * numpy.asarray(self.accum(X),
+                                                 dtype='float64')
+            num_batches += 1
+            num_examples += X.shape[0]
+            if batches is not None and num_batches >= batches:
+                break
+            if (self.time_budget is not None and
+                    time.time() - start > self.time_budget):
+                break
+        return totals / max(num_examples, 1)
+
+    def record_entry(self, seen, values, duration):
+        """
+        Appends one data point to each channel.
 
+        Parameters
+        ----------
+        seen : tuple
+            The number of batches and of examples seen, the number of
+            previous calls to the monitor and the time (as returned by
+            time.time()) when the evaluation of the values started.
+        values : list
+            The value of each channel, in the order of
+            `self.channel_names`.
+        duration : float
+            The number of seconds the evaluation took.
+        """
+        batches_seen, examples_seen, epoch, start = seen
+        # TODO: use logging infrastructure so that user can configure
+        # formatting
+        print "Monitoring step:"
+        print "\tBatches seen: %d" % batches_seen
+        print "\tExamples seen: %d" % examples_seen
+        for channel_name, val in zip(self.channel_names, values):
+            channel = self.channels[channel_name]
+            channel.batch_record.append(batches_seen)
+            channel.example_record.append(examples_seen)
+            channel.epoch_record.append(epoch)
+            channel.val_record.append(val)
+            self.log_event('record', channel=channel_name, value=val,
+                           epoch=epoch, batches_seen=batches_seen,
+                           examples_seen=examples_seen, time=start,
+                           duration=duration)
             # TODO: use logging infrastructure so that user can configure
             # formatting
-            print "Monitoring step:"
-            print "\tBatches seen: %d" % self.batches_seen
-            print "\tExamples seen: %d" % self.examples_seen
-            for channel_name in sorted(self.channels):
-                channel = self.channels[channel_name]
-                channel.batch_record.append(self.batches_seen)
-                channel.example_record.append(self.examples_seen)
-                val = (channel.val_shared.get_value(borrow=False) /
-                       float(self.batches))
-                channel.val_record.append(val)
-                # TODO: use logging infrastructure so that user can configure
-                # formatting
-                if abs(val) < 1e4:
-                    val_str = str(val)
-                else:
-                    val_str = '%.3e' % val
-
-                print "\t%s: %s" % (channel_name, val_str)
-
+            if abs(val) < 1e4:
+                val_str = str(val)
+            else:
+                val_str = '%.3e' % val
 
+            print "\t%s: %s" % (channel_name, val_str)
 
     def run_prereqs(self, X):
         for prereq in self.prereqs:
@@ -143,15 +269,6 @@ class Monitor(object):
                         self.prereqs.append(prereq)
 
         init_names = dir(self)
-        updates = {}
-        for channel in self.channels.values():
-            updates[channel.val_shared] = 0.0
-        print "compiling begin_record_entry..."
-        t1 = time.time()
-        self.begin_record_entry = function(inputs=[], updates=updates)
-        t2 = time.time()
-        print "took "+str(t2-t1)+" seconds"
-        updates = {}
         givens = {}
         #Get the appropriate kind of theano variable to represent the data the model
         #acts on
@@ -159,17 +276,52 @@ class Monitor(object):
         print 'monitored channels: '+str(self.channels.keys())
         for channel in self.channels.values():
             givens[channel.graph_input] = X
-            updates[channel.val_shared] = channel.val_shared + channel.val
+        if self.background and len(self.prereqs) > 0:
+            warnings.warn('Some monitoring channels have prereqs, which may '
+                          'modify the state of the model, so the monitor '
+                          'will not evaluate them in the background.')
+        elif self.background:
+            # Evaluate the channels with copies of the parameters, which
+            # are updated before each evaluation
+            params = self.model.get_params()
+            self.param_copies = [shared(param.get_value(),
+                                        name='monitor_copy(%s)' % param.name)
+                                 for param in params]
+            givens.update(zip(params, self.param_copies))
+        self.channel_names = sorted(self.channels)
+        outputs = [self.channels[name].val for name in self.channel_names]
         print "compiling accum..."
         t1 = time.time()
-        self.accum = function([X], givens=givens, updates=updates)
+        self.accum = function([X], outputs, givens=givens)
         t2 = time.time()
-        print "graph size: ",len(self.accum.maker.env.toposort())
         print "took "+str(t2-t1)+" seconds"
+        self.log_event('compile', function='monitor.accum', seconds=t2-t1)
         final_names = dir(self)
         self.register_names_to_del([name for name in final_names
                                     if name not in init_names])
 
+    def log_metrics_to(self, path, flush_interval=10.):
+        """
+        Appends every record, along with compilation times and any event
+        passed to `log_event`, to the JSON-lines file at `path` (see
+        `pylearn2.metrics`).
+        """
+        if self.metrics is not None:
+            self.metrics.close()
+        self.metrics = MetricsWriter(path, flush_interval)
+
+    def log_event(self, event, **fields):
+        """
+        Writes an event to the metrics file set with `log_metrics_to`, if
+        any.
+        """
+        if self.metrics is not None:
+            self.metrics.write(event, **fields)
+
+    def flush_metrics(self):
+        if self.metrics is not None:
+            self.metrics.flush()
+
     def register_names_to_del(self, names):
         """
         Register names of fields that should be deleted before pickling.
@@ -187,9 +339,8 @@ class Monitor(object):
         """
         In order to avoid pickling a copy of the dataset whenever a monitor
         is saved, the __getstate__ method replaces the dataset field with the
-        dataset's yaml source. This is not a perfect solution because it won't
-        work with job resuming, which would require saving the state of the
-        dataset's random number generator.
+        dataset's yaml source. The monitor always iterates over its dataset
+        sequentially, so no random number generator state is lost.
 
         Like in the Model class, we also need to avoid saving any Theano
         functions, so we delete everything that can be regenerated with
@@ -200,7 +351,6 @@ class Monitor(object):
             try:
                 self.dataset = self.dataset.yaml_src
             except AttributeError:
-                import warnings
                 warnings.warn('Trained model saved without indicating yaml_src')
         d = copy.copy(self.__dict__)
         self.dataset = temp
@@ -211,6 +361,14 @@ class Monitor(object):
 
     def __setstate__(self, d):
         self.__dict__.update(d)
+        # The compiled functions were not pickled
+        self.dirty = True
+        # Monitors pickled before these fields existed
+        for name, value in [('batches', None), ('batch_size', None),
+                            ('frequency', 1), ('time_budget', None),
+                            ('background', False), ('calls', 0),
+                            ('metrics', None)]:
+            self.__dict__.setdefault(name, value)
 
     def add_channel(self, name, ipt, val, prereqs = None):
         """
@@ -227,10 +385,21 @@ class Monitor(object):
             The value (function of `ipt`) to be tracked.
         """
 
+        channel = MonitorChannel(ipt, val, name, prereqs)
         if name in self.channels:
-            raise ValueError("Tried to create the same channel twice (%s)" %
-                             name)
-        self.channels[name] = MonitorChannel(ipt, val, name, prereqs)
+            old = self.channels[name]
+            if hasattr(old, 'val'):
+                raise ValueError("Tried to create the same channel twice (%s)"
+                                 % name)
+            # The channel was unpickled, which only keeps its records (see
+            # MonitorChannel.__getstate__). This happens when training is
+            # resumed and the training algorithm sets up its channels
+            # again: keep the records.
+            channel.val_record = old.val_record
+            channel.batch_record = getattr(old, 'batch_record', [])
+            channel.example_record = old.example_record
+            channel.epoch_record = old.epoch_record
+        self.channels[name] = channel
         self.dirty = True
 
     @classmethod
@@ -279,7 +448,6 @@ class MonitorChannel(object):
         self.prereqs = prereqs
         self.graph_input = graph_input
         self.val = val
-        self.val_shared = shared(0.0, name + "_tracker")
         # Value of the desired quantity at measurement time.
         self.val_record = []
         # Number of batches seen at measurement time.
@@ -287,24 +455,33 @@ class MonitorChannel(object):
         # Number of examples seen at measurement time (batch sizes may
         # fluctuate).
         self.example_record = []
+        # Number of previous calls to the monitor (i.e. epochs) at
+        # measurement time. The monitor may not evaluate the channels at
+        # every call.
+        self.epoch_record = []
 
     def __getstate__(self):
-        """ TODO:
-                we need to figure out a good way of saving the other fields.
-                in the current setup, since there's no good way of coordinating
-                with the model/training algorithm, the theano based fields might
-                be invalid after a repickle.
-                This means we can't, for instance, resume a job with monitoring
-                after a crash.
-                For now, to make sure no one erroneously depends on these bad
-                values, I exclude them from the pickle.
+        """ Only the records are pickled: since there's no good way of
+            coordinating with the model/training algorithm, the theano based
+            fields might be invalid after a repickle. To make sure no one
+            erroneously depends on these bad values, they are excluded from
+            the pickle.
+            When training is resumed, the training algorithm adds the
+            channel to the monitor again, and Monitor.add_channel gives the
+            new channel the records of the unpickled one.
         """
         return {
+            'batch_record': self.batch_record,
             'example_record': self.example_record,
+            'epoch_record': self.epoch_record,
             'val_record': self.val_record
         }
 
     def __setstate__(self, d):
+        if 'epoch_record' not in d:
+            # Channels pickled before this field existed were evaluated at
+            # every call.
+            d['epoch_record'] = range(len(d['val_record']))
         self.__dict__.update(d)
 
 # TODO: Remove this at some point
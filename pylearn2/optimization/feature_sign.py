@@ -13,6 +13,7 @@ __all__ = ["feature_sign_search"]
 
 from itertools import izip, count
 import logging
+import multiprocessing
 import numpy as np
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -49,8 +50,28 @@ def _feature_sign_checkargs(dictionary, signals, sparsity, max_iter,
             )
 
 
+def _feature_sign_optimality(grad, signs, sparsity):
+    """
+    Returns the largest gradient magnitude among the zero coefficients
+    and whether the optimality condition holds for the non-zero ones.
+    """
+    zero = signs == 0
+    if zero.any():
+        z_opt = np.max(abs(grad[zero]))
+    else:
+        z_opt = 0.
+    if zero.all():
+        nz_optimal = True
+    else:
+        nz = ~zero
+        nz_opt = np.max(abs(grad[nz] + sparsity * signs[nz]))
+        nz_optimal = np.allclose(nz_opt, 0)
+    return z_opt, nz_optimal
+
+
 def _feature_sign_search_single(dictionary, signal, sparsity, max_iter,
-                                solution=None):
+                                solution=None, gram_matrix=None,
+                                target_correlation=None, warm_start=False):
     """
     Solve a single L1-penalized minimization problem with
     feature-sign search.
@@ -69,6 +90,13 @@ def _feature_sign_search_single(dictionary, signal, sparsity, max_iter,
         The maximum number of iterations to run.
     solution : ndarray, 1-dimensional, optional
         Pre-allocated vector to use to store the solution.
+    gram_matrix : ndarray, 2-dimensional, optional
+        Precomputed `np.dot(dictionary.T, dictionary)`.
+    target_correlation : ndarray, 1-dimensional, optional
+        Precomputed `np.dot(dictionary.T, signal)`.
+    warm_start : bool, optional
+        If True, start from the values already in `solution` rather
+        than from zero.
 
     Returns
     -------
@@ -89,28 +117,38 @@ def _feature_sign_search_single(dictionary, signal, sparsity, max_iter,
     sparsity = np.array(sparsity).astype(dictionary.dtype)
     effective_zero = 1e-18
     # precompute matrices for speed.
-    gram_matrix = np.dot(dictionary.T, dictionary)
-    target_correlation = np.dot(dictionary.T, signal)
+    if gram_matrix is None:
+        gram_matrix = np.dot(dictionary.T, dictionary)
+    if target_correlation is None:
+        target_correlation = np.dot(dictionary.T, signal)
     # initialization goes here.
     if solution is None:
+        assert not warm_start, "warm_start requires a solution to start from"
         solution = np.zeros(gram_matrix.shape[0], dtype=dictionary.dtype)
     else:
         assert solution.ndim == 1, "solution must be 1-dimensional"
         assert solution.shape[0] == dictionary.shape[1], (
             "solution.shape[0] does not match dictionary.shape[1]"
         )
-        # Initialize all elements to be zero.
-        solution[...] = 0.
-    signs = np.zeros(gram_matrix.shape[0], dtype=np.int8)
-    active_set = set()
-    z_opt = np.inf
-    # Used to store whether max(abs(grad[nzidx] + sparsity * signs[nzidx]))
-    # is approximately 0.
-    # Set to True here to trigger a new feature activation on first iteration.
-    nz_optimal = True
-    # second term is zero on initialization.
-    grad = - 2 * target_correlation  # + 2 * np.dot(gram_matrix, solution)
-    max_grad_zero = np.argmax(np.abs(grad))
+        if not warm_start:
+            # Initialize all elements to be zero.
+            solution[...] = 0.
+    if warm_start and np.any(solution != 0):
+        signs = np.int8(np.sign(solution))
+        active_set = set(np.where(signs != 0)[0])
+        grad = - 2 * target_correlation + 2 * np.dot(gram_matrix, solution)
+        z_opt, nz_optimal = _feature_sign_optimality(grad, signs, sparsity)
+    else:
+        signs = np.zeros(gram_matrix.shape[0], dtype=np.int8)
+        active_set = set()
+        z_opt = np.inf
+        # Used to store whether
+        # max(abs(grad[nzidx] + sparsity * signs[nzidx])) is approximately 0.
+        # Set to True here to trigger a new feature activation on first
+        # iteration.
+        nz_optimal = True
+        # second term is zero on initialization.
+        grad = - 2 * target_correlation  # + 2 * np.dot(gram_matrix, solution)
     # Just used to compute exact cost function.
     sds = np.dot(signal.T, signal)
     counter = count(0)
@@ -207,15 +245,34 @@ def _feature_sign_search_single(dictionary, signal, sparsity, max_iter,
         signs[indices] = np.int8(np.sign(solution[indices]))
         active_set.difference_update(zeros)
         grad = - 2 * target_correlation + 2 * np.dot(gram_matrix, solution)
-        z_opt = np.max(abs(grad[signs == 0]))
-        nz_opt = np.max(abs(grad[signs != 0] + sparsity * signs[signs != 0]))
-        nz_optimal = np.allclose(nz_opt, 0)
+        z_opt, nz_optimal = _feature_sign_optimality(grad, signs, sparsity)
 
     return solution, min(counter.next(), max_iter)
 
 
+def _feature_sign_search_block(args):
+    """
+    Solve the problems for a block of rows of `signals`, sharing one Gram
+    matrix. Takes a single tuple so that it can be mapped over a process
+    pool.
+    """
+    (dictionary, gram_matrix, signals, target_correlations, sparsity,
+     max_iter, solution, warm_start, first_row) = args
+    for row, (signal, corr, sol) in enumerate(izip(signals,
+                                                   target_correlations,
+                                                   solution)):
+        _, iters = _feature_sign_search_single(dictionary, signal, sparsity,
+                                               max_iter, sol, gram_matrix,
+                                               corr, warm_start)
+        if iters >= max_iter:
+            log.warning("maximum number of iterations reached when "
+                        "optimizing code for training case %d; solution "
+                        "may not be optimal" % (first_row + row))
+    return solution
+
+
 def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
-                        solution=None):
+                        solution=None, warm_start=False, num_workers=1):
     """
     Solve L1-penalized quadratic minimization problems with
     feature-sign search.
@@ -246,6 +303,16 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
         Pre-allocated vector or matrix used to store the solution(s).
         If provided, it should have the same rank as `signals`. If
         2-dimensional, it should have as many rows as `signals`.
+    warm_start : bool, optional
+        If True, the optimization of each code vector starts from the
+        values already in `solution` (e.g. the codes found for the
+        same signals with a previous dictionary) rather than from
+        zero. Requires `solution`. Default is False.
+    num_workers : int, optional
+        If greater than 1, the rows of `signals` are split into this
+        many blocks which are solved in parallel by a pool of worker
+        processes. Each row is solved exactly as it would be in a
+        single process. Default is 1.
 
     Returns
     -------
@@ -273,6 +340,10 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
     in the case of C-contiguous inputs), this function expects and
     returns input with training examples as rows of a matrix.
 
+    The Gram matrix of the dictionary and the correlations between
+    the dictionary and the signals are computed once per call and
+    shared by all the rows.
+
     References
     ----------
     .. [1] H. Lee, A. Battle, R. Raina, and A. Y. Ng. "Efficient
@@ -281,6 +352,8 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
     """
     dictionary = np.asarray(dictionary)
     _feature_sign_checkargs(dictionary, signals, sparsity, max_iter, solution)
+    if warm_start and solution is None:
+        raise ValueError("warm_start requires a solution to start from")
     # Make things the code a bit simpler by always forcing the
     # 2-dimensional case.
     signals_ndim = signals.ndim
@@ -292,14 +365,30 @@ def feature_sign_search(dictionary, signals, sparsity, max_iter=1000,
     else:
         orig_sol = solution
         solution = np.atleast_2d(solution)
-    # Solve each minimization in sequence.
-    for row, (signal, sol) in enumerate(izip(signals, solution)):
-        _, iters = _feature_sign_search_single(dictionary, signal, sparsity,
-                                               max_iter, sol)
-        if iters >= max_iter:
-            log.warning("maximum number of iterations reached when "
-                        "optimizing code for training case %d; solution "
-                        "may not be optimal" % iters)
+    gram_matrix = np.dot(dictionary.T, dictionary)
+    target_correlations = np.dot(signals, dictionary)
+    num_workers = min(num_workers, signals.shape[0])
+    if num_workers > 1:
+        bounds = np.linspace(0, signals.shape[0],
+                             num_workers + 1).astype(int)
+        blocks = [(dictionary, gram_matrix, signals[start:stop],
+                   target_correlations[start:stop], sparsity, max_iter,
+                   solution[start:stop], warm_start, start)
+                  for start, stop in izip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            results = pool.map(_feature_sign_search_block, blocks)
+        finally:
+            pool.close()
+            pool.join()
+        for start, stop, block_solution in izip(bounds[:-1], bounds[1:],
+                                                 results):
+            solution[start:stop] = block_solution
+    else:
+        # Solve each minimization in sequence.
+        _feature_sign_search_block((dictionary, gram_matrix, signals,
+                                    target_correlations, sparsity, max_iter,
+                                    solution, warm_start, 0))
     # Attempt to return the exact same object reference.
     if orig_sol is not None and orig_sol.ndim == 1:
         solution = orig_sol
@@ -414,3 +414,25 @@ class TestFeatureSign(object):
         newsol = feature_sign_search(self.dictionary, signal, sparsity,
                                      solution=solution)
         assert solution is newsol
+
+    def test_batch_matches_single_rows(self):
+        sparsity = self.penalties[1]
+        rng = np.random.RandomState(1)
+        signals = rng.normal(size=(6, 100)) / 1000
+        batch = feature_sign_search(self.dictionary, signals, sparsity)
+        for signal, code in zip(signals, batch):
+            single = feature_sign_search(self.dictionary, signal, sparsity)
+            assert np.allclose(code, single)
+        pooled = feature_sign_search(self.dictionary, signals, sparsity,
+                                     num_workers=2)
+        assert np.all(pooled == batch)
+
+    def test_warm_start(self):
+        sparsity = self.penalties[3]
+        cold = feature_sign_search(self.dictionary, self.signal, sparsity)
+        solution = feature_sign_search(self.dictionary, self.signal,
+                                       self.penalties[2])
+        warm = feature_sign_search(self.dictionary, self.signal, sparsity,
+                                   solution=solution, warm_start=True)
+        assert warm is solution
+        assert np.allclose(warm, cold)
@@ -47,6 +47,9 @@ except ImportError:
 from pylearn2.base import Block
 from pylearn2.utils import sharedX
 
+# Examples are read in batches of about this many elements.
+_BLOCK_ELEMENTS = 2 ** 21
+
 
 class _PCABase(Block):
     """
@@ -99,13 +102,17 @@ class _PCABase(Block):
 
         If mean is provided, X will not be centered first.
 
-        :type X: numpy.ndarray, shape (n, d)
-        :param X: matrix on which to train PCA
+        :type X: numpy.ndarray, shape (n, d), or dataset
+        :param X: matrix on which to train PCA, or a dataset (e.g. a
+            DenseDesignMatrix) whose design matrix is used. A memory-mapped
+            design matrix stays on disk: CovEigPCA and randomized SVDPCA
+            read it in batches.
 
         :type mean: numpy.ndarray, shape (d)
         :param mean: feature means
         """
 
+        X = _design_matrix(X)
         if self.num_components is None:
             self.num_components = X.shape[1]
 
@@ -339,39 +346,116 @@ class Cov:
 
     def __call__(self, X):
         X = X.T
-        m, n = X.shape
-        mean = X.mean(axis=0)
-        rval = N.zeros((n, n))
-        for i in xrange(0, m, self.batch_size):
-            B = X[i:i + self.batch_size, :] - mean
-            rval += N.dot(B.T, B)
-        return rval / float(m - 1)
+        mean = _mean(X, self.batch_size)
+        return _scatter(X, mean, self.batch_size) / float(X.shape[0] - 1)
 
 
 class CovEigPCA(_PCABase):
+    """
+    PCA from the eigendecomposition of the covariance matrix, which is
+    accumulated in two passes over batches of the examples (one for the
+    mean, one for the covariance), so that neither X - mean nor any other
+    copy of X is made.
+    """
     def __init__(self, cov_batch_size=None, **kwargs):
+        """
+        :type cov_batch_size: int
+        :param cov_batch_size: number of examples per batch. Defaults to
+            about 2 ** 21 / d.
+        """
         super(CovEigPCA, self).__init__(**kwargs)
-        if cov_batch_size is not None:
-            self.cov = Cov(cov_batch_size)
+        self.cov_batch_size = cov_batch_size
+
+    def train(self, X, mean=None):
+        X = _design_matrix(X)
+        batch_size = _batch_size(X, self.cov_batch_size)
+        if mean is None:
+            mean = self.mean_ = _mean(X, batch_size)
         else:
-            self.cov = numpy.cov
+            # X is already centered
+            self.mean_ = numpy.zeros(X.shape[1])
+        super(CovEigPCA, self).train(X, mean=mean)
 
     def _cov_eigen(self, X):
         """
         Perform direct computation of covariance matrix eigen{values,vectors}.
         """
-        v, W = linalg.eigh(self.cov(X.T))
+        batch_size = _batch_size(X, self.cov_batch_size)
+        cov = _scatter(X, self.mean_, batch_size) / float(X.shape[0] - 1)
+        v, W = linalg.eigh(cov)
         # The resulting components are in *ascending* order of eigenvalue, and
         # W contains eigenvectors in its *columns*, so we simply reverse both.
         return v[::-1], W[:, ::-1]
 
 
 class SVDPCA(_PCABase):
+    """
+    PCA from the Singular Value Decomposition of the centered data.
+
+    By default, the full SVD of X - mean is computed. In randomized mode,
+    only the leading `num_components` singular values and vectors are
+    estimated, following Halko, Martinsson and Tropp, "Finding structure
+    with randomness", SIAM Review 2011: a random subspace of dimension
+    num_components + oversampling is refined by power iterations with
+    (X - mean)^T (X - mean), which are computed in batches, and the
+    components are the Ritz vectors of that matrix in the subspace. The
+    memory used is then O(d (num_components + oversampling)) beyond a
+    batch, and the data is read power_iterations + 3 times. Note that
+    `min_variance` is then relative to the variance of the estimated
+    components only.
+    """
+    def __init__(self, randomized=False, oversampling=10, power_iterations=2,
+                 batch_size=None, seed=None, **kwargs):
+        """
+        :type randomized: bool
+        :param randomized: whether to estimate a truncated SVD with the
+            randomized algorithm, instead of computing the full SVD.
+
+        :type oversampling: int
+        :param oversampling: number of random directions sampled beyond
+            num_components in randomized mode.
+
+        :type power_iterations: int
+        :param power_iterations: number of power iterations in randomized
+            mode. More iterations give more accurate components when the
+            spectrum decays slowly.
+
+        :type batch_size: int
+        :param batch_size: number of examples per batch in randomized mode.
+            Defaults to about 2 ** 21 / d.
+
+        :type seed: int or list
+        :param seed: seed of the random number generator drawing the
+            initial subspace in randomized mode.
+        """
+        super(SVDPCA, self).__init__(**kwargs)
+        self.randomized = randomized
+        self.oversampling = oversampling
+        self.power_iterations = power_iterations
+        self.batch_size = batch_size
+        if seed is None:
+            seed = [1, 2, 3]
+        self.seed = seed
+
+    def train(self, X, mean=None):
+        X = _design_matrix(X)
+        # Pickles made before the randomized mode existed lack the attribute
+        if getattr(self, 'randomized', False):
+            batch_size = _batch_size(X, self.batch_size)
+            if mean is None:
+                mean = self.mean_ = _mean(X, batch_size)
+            else:
+                # X is already centered
+                self.mean_ = numpy.zeros(X.shape[1])
+        super(SVDPCA, self).train(X, mean=mean)
+
     def _cov_eigen(self, X):
         """
         Compute covariance matrix eigen{values,vectors} via Singular Value
         Decomposition (SVD).
         """
+        if getattr(self, 'randomized', False):
+            return self._randomized_cov_eigen(X)
         U, s, Vh = linalg.svd(X, full_matrices=False)
         # Vh contains eigenvectors in its *rows*, thus we transpose it.
         # s contains X's singular values in *decreasing* order, thus (noting
@@ -379,6 +463,33 @@ class SVDPCA(_PCABase):
         # simply square it.
         return s ** 2, Vh.T
 
+    def _randomized_cov_eigen(self, X):
+        """
+        Estimate the leading eigen{values,vectors} of (X - mean)'(X - mean),
+        i.e. the squared singular values and right singular vectors of
+        X - mean, with X - mean never formed.
+        """
+        d = X.shape[1]
+        k = min(self.num_components, d)
+        batch_size = _batch_size(X, self.batch_size)
+        rng = numpy.random.RandomState(self.seed)
+
+        Q = rng.normal(size=(d, min(k + self.oversampling, d)))
+        for i in xrange(self.power_iterations + 1):
+            # Orthonormalizing at each iteration keeps the directions of
+            # the smaller singular values from being lost to rounding.
+            Q, R = linalg.qr(_scatter(X, self.mean_, batch_size, Q),
+                             mode='economic')
+
+        # Rayleigh-Ritz: the eigendecomposition of the projection of
+        # (X - mean)'(X - mean) onto the subspace spanned by Q.
+        v, U = linalg.eigh(numpy.dot(Q.T,
+                                     _scatter(X, self.mean_, batch_size, Q)))
+        # The resulting components are in *ascending* order of eigenvalue,
+        # so we keep the k last ones, in reverse order.
+        v, U = v[::-1][:k], U[:, ::-1][:, :k]
+        return v, numpy.dot(Q, U)
+
 
 class SparsePCA(_PCABase):
     def train(self, X, mean=None):
@@ -439,6 +550,53 @@ class SparsePCA(_PCABase):
         inputs = SparseType('csr', dtype=theano.config.floatX)()
         return theano.function([inputs], self(inputs), name=name)
 
+
+def _design_matrix(X):
+    """
+    Returns X, or its design matrix if X is a dataset. A memory-mapped
+    design matrix is returned as is, not read.
+    """
+    if hasattr(X, 'get_design_matrix'):
+        return X.get_design_matrix()
+    return X
+
+
+def _batch_size(X, batch_size=None):
+    if batch_size is None:
+        batch_size = max(1, _BLOCK_ELEMENTS // X.shape[1])
+    return batch_size
+
+
+def _mean(X, batch_size):
+    """
+    Returns the mean of the rows of X, accumulated in float64 over batches
+    of rows.
+    """
+    total = numpy.zeros(X.shape[1])
+    for i in xrange(0, X.shape[0], batch_size):
+        total += X[i:i + batch_size].sum(axis=0, dtype='float64')
+    return total / X.shape[0]
+
+
+def _scatter(X, mean, batch_size, Q=None):
+    """
+    Returns (X - mean)' (X - mean), or (X - mean)' (X - mean) Q if Q is
+    given, accumulated in float64 over batches of rows of X, so that
+    X - mean is never formed.
+    """
+    d = X.shape[1]
+    if Q is None:
+        rval = numpy.zeros((d, d))
+    else:
+        rval = numpy.zeros((d, Q.shape[1]))
+    for i in xrange(0, X.shape[0], batch_size):
+        B = numpy.asarray(X[i:i + batch_size], dtype='float64') - mean
+        if Q is None:
+            rval += numpy.dot(B.T, B)
+        else:
+            rval += numpy.dot(B.T, numpy.dot(B, Q))
+    return rval
+
 ##################################################
 if __name__ == "__main__":
     """
@@ -1,13 +1,43 @@
+import itertools
+
 import numpy
 import theano
 from theano import tensor, config
 from theano.tensor import nnet
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.parallel import fork_pool
+
 
-def compute_log_z(rbm, free_energy_fn, max_bits=15):
+def compute_log_z(rbm, free_energy_fn, max_bits=15, num_workers=1):
     """
-    TODO: document me.
+    Computes the exact log partition function of a small RBM, by summing
+    over all the configurations of its visible or hidden units, whichever
+    are fewer.
+
+    Parameters
+    ----------
+    rbm: RBM
+        the model, used for its `nvis` and `nhid` attributes.
+
+    free_energy_fn: callable
+        free_energy_fn(X) returns the free energy of each row of X, a
+        configuration of the visible units if rbm.nvis < rbm.nhid, of the
+        hidden units otherwise.
+
+    max_bits: int
+        free_energy_fn is called on blocks of 2**max_bits configurations.
+
+    num_workers: int
+        number of forked processes the blocks are spread over.
+
+    Returns
+    -------
+    log_z: float
+        log of the sum of exp(-free energy) over all configurations. Only a
+        running log-sum-exp per worker is kept, so the memory used does not
+        grow with the number of configurations.
     """
     # pick whether to iterate over visible or hidden states
     if rbm.nvis < rbm.nhid:
@@ -19,36 +49,86 @@ def compute_log_z(rbm, free_energy_fn, max_bits=15):
 
     # determine in how many steps to compute Z
     block_bits = width if (not max_bits or width < max_bits) else max_bits
-    block_size = 2 ** block_bits
-
-    # allocate storage for 2**block_bits of the 2**width possible
-    # configurations
-    logz_data_c = numpy.zeros(
-        (block_size, width),
-        order='C',
-        dtype=config.floatX
-    )
+    num_blocks = 2 ** (width - block_bits)
+
+    # each task sums over a range of values of the most-significant bits
+    num_tasks = min(num_blocks, 4 * num_workers)
+    bounds = [num_blocks * i // num_tasks for i in xrange(num_tasks + 1)]
+    tasks = zip(bounds[:-1], bounds[1:])
+
+    blocks = _LogZBlocks(free_energy_fn, width, block_bits)
+    if num_workers > 1:
+        pool, run_task = fork_pool(blocks, num_workers)
+        try:
+            log_sums = pool.map(run_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        log_sums = map(blocks, tasks)
 
-    # fill in the first block_bits, which will remain fixed for all
-    # 2**width configs
-    tensor_10D_idx = numpy.ndindex(*([2] * block_bits))
-    for i, j in enumerate(tensor_10D_idx):
-        logz_data_c[i, -block_bits:] = j
-    logz_data = numpy.array(logz_data_c, order='F', dtype=config.floatX)
+    return _log_sum_exp(numpy.array(log_sums))
 
-    # storage for free-energy of all 2**width configurations
-    FE = numpy.zeros(2 ** width, dtype=config.floatX)
 
-    # now loop 2**(width - block_bits) times, filling in the
-    # most-significant bits
-    for bi, up_bits in enumerate(numpy.ndindex(*([2] * (width - block_bits)))):
-        logz_data[:, :width - block_bits] = up_bits
-        FE[bi * block_size:(bi + 1) * block_size] = free_energy_fn(logz_data)
+def _log_sum_exp(x):
+    alpha = numpy.max(x)
+    return numpy.log(numpy.sum(numpy.exp(x - alpha))) + alpha
 
-    alpha = numpy.max(-FE)
-    log_z = numpy.log(numpy.sum(numpy.exp(-FE - alpha))) + alpha
 
-    return log_z
+class _LogZBlocks(object):
+    """
+    Sums exp(-free energy) over the blocks of configurations of
+    `compute_log_z`.
+
+    Called with a range (start, stop) of values of the `width - block_bits`
+    most-significant bits, returns the log of the sum over the
+    configurations with these bits. The configurations are written to a
+    buffer allocated on first use, whose least-significant bits enumerate
+    all their 2**block_bits values once and for all.
+    """
+    def __init__(self, free_energy_fn, width, block_bits):
+        self.free_energy_fn = free_energy_fn
+        self.width = width
+        self.block_bits = block_bits
+        self.logz_data = None
+
+    def _allocate(self):
+        # allocate storage for 2**block_bits of the 2**width possible
+        # configurations
+        logz_data_c = numpy.zeros(
+            (2 ** self.block_bits, self.width),
+            order='C',
+            dtype=config.floatX
+        )
+
+        # fill in the first block_bits, which will remain fixed for all
+        # 2**width configs
+        tensor_10D_idx = numpy.ndindex(*([2] * self.block_bits))
+        for i, j in enumerate(tensor_10D_idx):
+            logz_data_c[i, self.width - self.block_bits:] = j
+        self.logz_data = numpy.array(logz_data_c, order='F',
+                                     dtype=config.floatX)
+
+    def __call__(self, task):
+        start, stop = task
+        if self.logz_data is None:
+            self._allocate()
+        up_width = self.width - self.block_bits
+        shifts = numpy.arange(up_width - 1, -1, -1)
+
+        # running log-sum-exp: the sum so far is total * exp(alpha)
+        alpha = -numpy.inf
+        total = 0.
+        for bi in xrange(start, stop):
+            # fill in the most-significant bits with the binary digits of bi
+            self.logz_data[:, :up_width] = (bi >> shifts) & 1
+            neg_fe = -numpy.asarray(self.free_energy_fn(self.logz_data),
+                                    dtype='float64')
+            new_alpha = max(alpha, numpy.max(neg_fe))
+            total = (total * numpy.exp(alpha - new_alpha) +
+                     numpy.sum(numpy.exp(neg_fe - new_alpha)))
+            alpha = new_alpha
+        return numpy.log(total) + alpha
 
 
 def compute_nll(rbm, data, log_z, free_energy_fn, bufsize=1000, preproc=None):
@@ -71,7 +151,8 @@ def compute_nll(rbm, data, log_z, free_energy_fn, bufsize=1000, preproc=None):
 
 
 def rbm_ais(rbm_params, n_runs, visbias_a=None, data=None,
-            betas=None, key_betas=None, rng=None, seed=23098):
+            betas=None, key_betas=None, rng=None, seed=23098,
+            num_workers=1, var_target=None, max_runs=None, callback=None):
     """
     Implements Annealed Importance Sampling for Binary-Binary RBMs, as
     described in:
@@ -118,6 +199,23 @@ def rbm_ais(rbm_params, n_runs, visbias_a=None, data=None,
 
     seed: int
         if rng is None, initialize rng with this seed.
+
+    num_workers: int
+        number of processes the particles are split across. See
+        `rbm_z_ratio`.
+
+    var_target: float
+        if not None, batches of `n_runs` more particles are simulated until
+        the variance of the estimate of log Z falls below `var_target` (or
+        `max_runs` particles have been simulated). See `rbm_z_ratio`.
+
+    max_runs: int
+        maximum number of particles simulated when `var_target` is given.
+
+    callback: callable
+        if not None, called as callback(n_runs, log_z, var_dlogz) each time
+        a group of particles has been simulated, with the current estimate
+        of log Z.
     """
     (weights, visbias, hidbias) = rbm_params
 
@@ -139,27 +237,52 @@ def rbm_ais(rbm_params, n_runs, visbias_a=None, data=None,
         visbias_a = -numpy.log(1. / data - 1)
     hidbias_a = numpy.zeros_like(hidbias)
     weights_a = numpy.zeros_like(weights)
+    rbmA_params = (weights_a, visbias_a, hidbias_a)
     # generate exact sample for the base model
-    v0 = numpy.tile(1. / (1 + numpy.exp(-visbias_a)), (n_runs, 1))
-    v0 = numpy.array(v0 > rng.random_sample(v0.shape), dtype=config.floatX)
+    v0 = _sample_base_rate(rbmA_params, n_runs, rng)
+    log_za = weights_a.shape[1] * numpy.log(2) + \
+             numpy.sum(numpy.log(1 + numpy.exp(visbias_a)))
+    if callback is not None:
+        z_ratio_callback = lambda n, dlogz, var_dlogz: \
+                callback(n, log_za + dlogz, var_dlogz)
+    else:
+        z_ratio_callback = None
     # we now compute the log AIS weights for the ratio log(Zb/Za)
-    ais = rbm_z_ratio((weights_a, visbias_a, hidbias_a),
-                      rbm_params, n_runs, v0,
-                      betas=betas, key_betas=key_betas, rng=rng)
+    ais = rbm_z_ratio(rbmA_params, rbm_params, n_runs, v0,
+                      betas=betas, key_betas=key_betas, rng=rng,
+                      num_workers=num_workers, var_target=var_target,
+                      max_runs=max_runs, callback=z_ratio_callback)
     dlogz, var_dlogz = ais.estimate_from_weights()
     # log Z = log_za + dlogz
-    ais.log_za = weights_a.shape[1] * numpy.log(2) + \
-                 numpy.sum(numpy.log(1 + numpy.exp(visbias_a)))
+    ais.log_za = log_za
     ais.log_zb = ais.log_za + dlogz
     return (ais.log_zb, var_dlogz), ais
 
 
+def _sample_base_rate(rbm_params, n_runs, rng):
+    """
+    Draws `n_runs` exact samples of the visible units of an RBM with zero
+    weights.
+    """
+    visbias = rbm_params[1]
+    v0 = numpy.tile(1. / (1 + numpy.exp(-visbias)), (n_runs, 1))
+    return numpy.array(v0 > rng.random_sample(v0.shape), dtype=config.floatX)
+
+
 def rbm_z_ratio(rbmA_params, rbmB_params, n_runs, v0=None,
-                betas=None, key_betas=None, rng=None, seed=23098):
+                betas=None, key_betas=None, rng=None, seed=23098,
+                num_workers=1, var_target=None, max_runs=None,
+                callback=None, log_int=500):
     """
     Computes the AIS log-weights log_wi, such that:
     log Zb = log Za + log 1/M \sum_{i=1}^M \exp(log_ais_wi)
 
+    The particles are split into `num_workers` groups, annealed in parallel
+    by a pool of forked worker processes (or in this process if
+    `num_workers` is 1). Each group gets its own seed, drawn from `rng`, and
+    the log-weights of the groups are concatenated in the returned AIS
+    object.
+
     Parameters
     ----------
     rbmA_params: list
@@ -173,6 +296,28 @@ def rbm_z_ratio(rbmA_params, rbmB_params, n_runs, v0=None,
         partition Z_a is usually known (i.e. baserate model at beta=0).
         Parameters are given in the order:
 
+    num_workers: int
+        number of processes the particles are split across.
+
+    var_target: float
+        if not None, the particles of `v0` are followed by batches of
+        `n_runs` new ones, drawn exactly from model A (whose weights must
+        then be zero), until var_dlogz / M, the variance of the estimate of
+        log(Zb/Za) from M particles, is at most `var_target`.
+
+    max_runs: int
+        if not None, no new batch of particles is started when it would
+        make the total exceed `max_runs`.
+
+    callback: callable
+        if not None, called as callback(M, dlogz, var_dlogz) with the
+        estimate returned by `AIS.estimate_from_weights` each time a group of
+        particles has been annealed, M being the number of particles
+        annealed so far.
+
+    log_int: int
+        see `AIS`.
+
     Additional parameters are as described in the docstring for
     `rbm_ais`.
     """
@@ -187,31 +332,131 @@ def rbm_z_ratio(rbmA_params, rbmB_params, n_runs, v0=None,
     rbmA_params = [numpy.asarray(q, dtype=config.floatX) for q in rbmA_params]
     rbmB_params = [numpy.asarray(q, dtype=config.floatX) for q in rbmB_params]
 
-    # declare symbolic vars for current sample `v_sample` and temp `beta`
-    v_sample = tensor.matrix('ais_v_sample')
-    beta = tensor.scalar('ais_beta')
-
-    ### given current sample `v_sample`, generate new samples from inv.
-    ### temperature `beta`
-    new_v_sample = rbm_ais_gibbs_for_v(rbmA_params, rbmB_params,
-                                       beta, v_sample)
-    sample_fn = theano.function([beta, v_sample], new_v_sample)
-
-    ### build theano function to compute the free-energy
-    fe = rbm_ais_pk_free_energy(rbmA_params, rbmB_params, beta, v_sample)
-    free_energy_fn = theano.function([beta, v_sample],
-                                     fe, allow_input_downcast=False)
+    if var_target is not None and numpy.any(rbmA_params[0]):
+        raise ValueError("rbm_z_ratio can only draw the additional "
+                         "particles needed to reach var_target from a "
+                         "model A with zero weights")
 
     ### RUN AIS ###
-    weights_b = rbmB_params
-    v0 = rng.rand(n_runs, weights_b.shape[0]) if v0 is None else v0
-    ais = AIS(sample_fn, free_energy_fn, v0, n_runs)
+    if v0 is None:
+        v0 = rng.rand(n_runs, rbmB_params[0].shape[0])
+    v0 = numpy.asarray(v0, dtype=config.floatX)
+
+    runner = _AISGroupRunner(rbmA_params, rbmB_params, betas, key_betas,
+                             log_int)
+    # collects the log-weights of all the groups
+    ais = AIS(None, None, v0, 0, log_int=log_int)
     ais.set_betas(betas, key_betas=key_betas)
-    ais.run()
+
+    if num_workers > 1:
+        pool, run_task = fork_pool(runner, num_workers)
+        run_groups = lambda tasks: pool.imap(run_task, tasks)
+    else:
+        pool = None
+        run_groups = lambda tasks: itertools.imap(runner, tasks)
+    try:
+        while True:
+            groups = [group for group in numpy.array_split(v0, num_workers)
+                      if len(group) > 0]
+            tasks = [(group, rng.randint(2 ** 30)) for group in groups]
+            for result in run_groups(tasks):
+                ais.add_runs(*result)
+                if callback is not None:
+                    callback(ais.n_runs, *ais.estimate_from_weights())
+
+            if var_target is None:
+                break
+            dlogz, var_dlogz = ais.estimate_from_weights()
+            if var_dlogz / ais.n_runs <= var_target:
+                break
+            if max_runs is not None and ais.n_runs + n_runs > max_runs:
+                break
+            v0 = _sample_base_rate(rbmA_params, n_runs, rng)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     return ais
 
 
+class _AISGroupRunner(object):
+    """
+    Anneals groups of particles between two RBMs, with a fused annealing
+    function compiled on first use.
+
+    Called with (v_sample0, seed), returns the log AIS weights of the
+    particles at the end of the run, at the key temperatures and every
+    `log_int` temperatures (see `AIS.add_runs`).
+    """
+    def __init__(self, rbmA_params, rbmB_params, betas, key_betas, log_int):
+        self.rbmA_params = rbmA_params
+        self.rbmB_params = rbmB_params
+        self.betas = betas
+        self.key_betas = key_betas
+        self.log_int = log_int
+        self.anneal_fn = None
+
+    def __call__(self, task):
+        v_sample0, seed = task
+        if self.anneal_fn is None:
+            self.anneal_fn, self.theano_rng = rbm_ais_anneal_fn(
+                    self.rbmA_params, self.rbmB_params)
+        self.theano_rng.seed(seed)
+        ais = AIS(None, None, v_sample0, len(v_sample0),
+                  log_int=self.log_int, anneal_fn=self.anneal_fn)
+        ais.set_betas(self.betas, key_betas=self.key_betas)
+        ais.run()
+        return ais.log_ais_w, ais.key_log_ais_w, ais.interval_log_ais_w
+
+
+def rbm_ais_anneal_fn(rbmA_params, rbmB_params, seed=23098):
+    """
+    Compiles a function moving AIS particles through a whole block of
+    temperatures in one call.
+
+    Parameters
+    ----------
+    rbmA_params:
+    rbmB_params:
+        see rbm_z_ratio
+    seed: int
+        seed of the random streams used for Gibbs sampling.
+
+    Returns
+    -------
+    anneal_fn: compiled theano function, anneal_fn(betas, v_sample)
+        for each pair of consecutive temperatures (betas[i], betas[i+1]),
+        adds fe_{betas[i]}(v) - fe_{betas[i+1]}(v) to the log AIS weight of
+        each particle v, then samples v at temperature betas[i+1]. Returns
+        the new particles and the increments of their log AIS weights.
+        The loop runs in a scan, which only keeps its last state.
+
+    theano_rng: MRG_RandomStreams
+        the random streams of anneal_fn, which can be reseeded.
+    """
+    betas = tensor.vector('ais_betas')
+    v_sample = tensor.matrix('ais_v_sample')
+    theano_rng = RandomStreams(seed)
+
+    def step(bp, bp1, v, log_w):
+        # the optimizer merges the products of v with the weights that the
+        # two free energies share
+        log_w = log_w + \
+                rbm_ais_pk_free_energy(rbmA_params, rbmB_params, bp, v) - \
+                rbm_ais_pk_free_energy(rbmA_params, rbmB_params, bp1, v)
+        new_v = rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, bp1, v,
+                                    theano_rng=theano_rng)
+        return new_v, log_w
+
+    (v_samples, log_ws), updates = theano.scan(
+            step, sequences=[betas[:-1], betas[1:]],
+            outputs_info=[v_sample, tensor.zeros_like(v_sample[:, 0])])
+    anneal_fn = function([betas, v_sample], [v_samples[-1], log_ws[-1]],
+                         updates=updates)
+    return anneal_fn, theano_rng
+
+
 def rbm_ais_pk_free_energy(rbmA_params, rbmB_params, beta, v_sample):
     """
     Computes the free-energy of visible unit configuration `v_sample`,
@@ -240,6 +485,10 @@ def rbm_ais_pk_free_energy(rbmA_params, rbmB_params, beta, v_sample):
     def rbm_fe(rbm_params, v, b):
         (weights, visbias, hidbias) = rbm_params
         vis_term = b * tensor.dot(v, visbias)
+        if _is_zero(weights):
+            # the hidden term of a base-rate model doesn't depend on v
+            hid_act = b * hidbias
+            return -vis_term - tensor.sum(tensor.log(1 + tensor.exp(hid_act)))
         hid_act = b * (tensor.dot(v, weights) + hidbias)
         fe = -vis_term - tensor.sum(tensor.log(1 + tensor.exp(hid_act)),
                                     axis=1)
@@ -250,7 +499,8 @@ def rbm_ais_pk_free_energy(rbmA_params, rbmB_params, beta, v_sample):
     return fe_a + fe_b
 
 
-def rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, beta, v_sample, seed=23098):
+def rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, beta, v_sample, seed=23098,
+                        theano_rng=None):
     """
     Parameters:
     -----------
@@ -270,18 +520,31 @@ def rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, beta, v_sample, seed=23098):
 
     seed: int
         optional seed parameter for sampling from binomial units.
+
+    theano_rng: MRG_RandomStreams
+        optional random streams to sample from, instead of new ones seeded
+        with `seed`.
     """
 
     (weights_a, visbias_a, hidbias_a) = rbmA_params
     (weights_b, visbias_b, hidbias_b) = rbmB_params
 
-    theano_rng = RandomStreams(seed)
+    if theano_rng is None:
+        theano_rng = RandomStreams(seed)
 
-    # equation 15 (Salakhutdinov & Murray 2008)
-    ph_a = nnet.sigmoid((1 - beta) * (tensor.dot(v_sample, weights_a) +
-                                    hidbias_a))
-    ha_sample = theano_rng.binomial(size=(v_sample.shape[0], len(hidbias_a)),
-                                    n=1, p=ph_a, dtype=config.floatX)
+    # equation 15 (Salakhutdinov & Murray 2008). The hidden units of a
+    # base-rate model have no effect on the visible ones, so they needn't be
+    # sampled.
+    if _is_zero(weights_a):
+        vis_act_a = visbias_a
+    else:
+        ph_a = nnet.sigmoid((1 - beta) * (tensor.dot(v_sample, weights_a) +
+                                        hidbias_a))
+        ha_sample = theano_rng.binomial(
+            size=(v_sample.shape[0], len(hidbias_a)),
+            n=1, p=ph_a, dtype=config.floatX
+        )
+        vis_act_a = tensor.dot(ha_sample, weights_a.T) + visbias_a
 
     # equation 16 (Salakhutdinov & Murray 2008)
     ph_b = nnet.sigmoid(beta * (tensor.dot(v_sample, weights_b) + hidbias_b))
@@ -289,7 +552,7 @@ def rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, beta, v_sample, seed=23098):
                                     n=1, p=ph_b, dtype=config.floatX)
 
     # equation 17 (Salakhutdinov & Murray 2008)
-    pv_act = (1 - beta) * (tensor.dot(ha_sample, weights_a.T) + visbias_a) + \
+    pv_act = (1 - beta) * vis_act_a + \
                 beta * (tensor.dot(hb_sample, weights_b.T) + visbias_b)
     pv = nnet.sigmoid(pv_act)
     new_v_sample = theano_rng.binomial(
@@ -300,6 +563,14 @@ def rbm_ais_gibbs_for_v(rbmA_params, rbmB_params, beta, v_sample, seed=23098):
     return new_v_sample
 
 
+def _is_zero(weights):
+    """
+    Tells whether `weights` is a numpy array of zeros, as are the weights of
+    the base-rate model.
+    """
+    return isinstance(weights, numpy.ndarray) and not numpy.any(weights)
+
+
 class AIS(object):
     """
     Compute the log AIS weights to approximate a ratio of partition functions.
@@ -323,12 +594,12 @@ class AIS(object):
         return numpy.asarray(a, dtype=config.floatX)
 
     # default configuration for interpolating distributions
-    dflt_beta = numpy.hstack((fX(numpy.linspace(0, 0.5, 1e3)),
-                              fX(numpy.linspace(0.5, 0.9, 1e4)),
-                              fX(numpy.linspace(0.9, 1.0, 1e4))))
+    dflt_beta = numpy.hstack((fX(numpy.linspace(0, 0.5, 1000)),
+                              fX(numpy.linspace(0.5, 0.9, 10000)),
+                              fX(numpy.linspace(0.9, 1.0, 10000))))
 
     def __init__(self, sample_fn, free_energy_fn, v_sample0, n_runs,
-                 log_int=500):
+                 log_int=500, anneal_fn=None):
         """
         Initialized the AIS object.
 
@@ -353,25 +624,28 @@ class AIS(object):
         log_int: int
             log standard deviation of log ais weights every `log_int`
             temperatures.
+
+        anneal_fn: compiled theano function, anneal_fn(betas, v_sample)
+            optional function moving the particles through a block of
+            temperatures at once, as returned by rbm_ais_anneal_fn. When
+            given, sample_fn and free_energy_fn are not used and run()
+            makes one call per block of `log_int` temperatures instead of
+            three calls per temperature.
         """
 
         self.sample_fn = sample_fn
         self.free_energy_fn = free_energy_fn
+        self.anneal_fn = anneal_fn
         self.v_sample0 = v_sample0
         self.n_runs = n_runs
         self.log_int = log_int
 
         # initialize log importance weights
         self.log_ais_w = numpy.zeros(n_runs, dtype=config.floatX)
-
-        # utility function for safely computing log-mean of the ais weights
-        ais_w = tensor.vector()
-        dlogz = (
-            tensor.log(tensor.mean(tensor.exp(ais_w - tensor.max(ais_w)))) \
-                + tensor.max(ais_w)
-        )
-        self.log_mean = theano.function([ais_w], dlogz,
-                                        allow_input_downcast=False)
+        # log_ais_w at every `key_beta` value and every `log_int`
+        # temperatures
+        self.key_log_ais_w = []
+        self.interval_log_ais_w = []
 
     def set_betas(self, betas=None, key_betas=None):
         """
@@ -408,42 +682,101 @@ class AIS(object):
         if not hasattr(self, 'betas'):
             self.set_betas()
 
-        self.std_ais_w = []  # used to log std of log_ais_w regularly
-        self.logz_beta = []  # used to log log_ais_w at every `key_beta` value
-        self.var_logz_beta = []  # used to log variance of log_ais_w as above
+        self.key_log_ais_w = []
+        self.interval_log_ais_w = []
+
+        # step i anneals from betas[i] to betas[i + 1]. The log AIS weights
+        # are recorded after every `log_int` steps and whenever we reach a
+        # "key" beta value, so we can estimate log_Z_{beta=key_betas[i]}
+        # after the fact.
+        num_steps = len(self.betas) - 1
+        interval_steps = set(range(self.log_int - 1, num_steps,
+                                   self.log_int))
+        key_steps = set()
+        if self.key_betas is not None:
+            ki = 0
+            for i in range(num_steps):
+                if ki < len(self.key_betas) and \
+                   self.betas[i + 1] == self.key_betas[ki]:
+                    key_steps.add(i)
+                    ki += 1
 
         # initial sample
         state = self.v_sample0
-        ki = 0
+        start = 0
+
+        # loop over all temperatures from beta=0 to beta=1, in blocks
+        # ending where the weights are recorded
+        for stop in sorted(interval_steps | key_steps | set([num_steps - 1])):
+            if stop < start:
+                continue
+            state = self._anneal(self.betas[start:stop + 2], state)
+            if stop in interval_steps:
+                self.interval_log_ais_w.append(self.log_ais_w.copy())
+            if stop in key_steps:
+                self.key_log_ais_w.append(self.log_ais_w.copy())
+            start = stop + 1
+
+        self._summarize()
+
+    def _anneal(self, betas, state):
+        """
+        Moves the particles `state`, sampled at temperature betas[0],
+        through the temperatures betas[1:], updating the log AIS weights,
+        and returns the final particles.
+        """
+        if self.anneal_fn is not None:
+            state, log_w = self.anneal_fn(betas, state)
+            self.log_ais_w += log_w
+            return state
 
-        # loop over all temperatures from beta=0 to beta=1
-        for i in range(len(self.betas) - 1):
-            bp, bp1 = self.betas[i], self.betas[i + 1]
+        for bp, bp1 in zip(betas[:-1], betas[1:]):
             # log-ratio of (free) energies for two nearby temperatures
             self.log_ais_w += self.free_energy_fn(bp,  state) - \
                               self.free_energy_fn(bp1, state)
-            # log standard deviation of AIS weights (kind of deprecated)
-            if (i + 1) % self.log_int == 0:
-                m = numpy.max(self.log_ais_w)
-                std_ais = (numpy.log(numpy.std(numpy.exp(self.log_ais_w - m)))
-                           + m - numpy.log(self.n_runs) / 2)
-                self.std_ais_w.append(std_ais)
-
-            # whenever we reach a "key" beta value, log log_ais_w and
-            # var(log_ais_w) so we can estimate log_Z_{beta=key_betas[i]} after
-            # the fact.
-            if self.key_betas is not None and \
-               ki < len(self.key_betas) and \
-               bp1 == self.key_betas[ki]:
-
-                log_ais_w_bi, var_log_ais_w_bi = \
-                    self.estimate_from_weights(self.log_ais_w)
-                self.logz_beta.insert(0, log_ais_w_bi)
-                self.var_logz_beta.insert(0, var_log_ais_w_bi)
-                ki += 1
-
             # generate a new sample at temperature beta_{i+1}
             state = self.sample_fn(bp1, state)
+        return state
+
+    def add_runs(self, log_ais_w, key_log_ais_w, interval_log_ais_w):
+        """
+        Adds the log AIS weights of independent runs, over the same
+        temperatures, to those of this object. The arguments are the
+        `log_ais_w`, `key_log_ais_w` and `interval_log_ais_w` attributes of
+        an AIS object after its run() method has been called.
+        """
+        if self.n_runs == 0:
+            self.log_ais_w = log_ais_w.copy()
+            self.key_log_ais_w = [w.copy() for w in key_log_ais_w]
+            self.interval_log_ais_w = [w.copy() for w in interval_log_ais_w]
+        else:
+            self.log_ais_w = numpy.hstack((self.log_ais_w, log_ais_w))
+            self.key_log_ais_w = [
+                    numpy.hstack(ws) for ws in zip(self.key_log_ais_w,
+                                                   key_log_ais_w)]
+            self.interval_log_ais_w = [
+                    numpy.hstack(ws) for ws in zip(self.interval_log_ais_w,
+                                                   interval_log_ais_w)]
+        self.n_runs = len(self.log_ais_w)
+        self._summarize()
+
+    def _summarize(self):
+        # log standard deviation of AIS weights (kind of deprecated)
+        self.std_ais_w = []
+        for log_ais_w in self.interval_log_ais_w:
+            m = numpy.max(log_ais_w)
+            std_ais = (numpy.log(numpy.std(numpy.exp(log_ais_w - m)))
+                       + m - numpy.log(len(log_ais_w)) / 2)
+            self.std_ais_w.append(std_ais)
+
+        # estimates of log Z at every key beta, from the highest down
+        self.logz_beta = []
+        self.var_logz_beta = []
+        for log_ais_w in self.key_log_ais_w:
+            log_ais_w_bi, var_log_ais_w_bi = \
+                self.estimate_from_weights(log_ais_w)
+            self.logz_beta.insert(0, log_ais_w_bi)
+            self.var_logz_beta.insert(0, var_log_ais_w_bi)
 
     def estimate_from_weights(self, log_ais_w=None):
         """
@@ -468,12 +801,12 @@ class AIS(object):
 
         log_ais_w = self.log_ais_w if log_ais_w is None else log_ais_w
 
-        # estimate the log-mean of the AIS weights
-        dlogz = self.log_mean(log_ais_w)
+        # estimate the log-mean of the AIS weights, safely
+        m = numpy.max(log_ais_w)
+        dlogz = numpy.log(numpy.mean(numpy.exp(log_ais_w - m))) + m
 
         # estimate log-variance of the AIS weights
         # VAR(log(X)) \approx VAR(X) / E(X)^2 = E(X^2)/E(X)^2 - 1
-        m = numpy.max(log_ais_w)
         var_dlogz = (log_ais_w.shape[0] *
                      numpy.sum(numpy.exp(2 * (log_ais_w - m))) /
                      numpy.sum(numpy.exp(log_ais_w - m)) ** 2 - 1.)
@@ -11,6 +11,7 @@ See the FeatureExtractor.__init__ method for documentation of options.
 """
 
 
+import json
 import os
 from pylearn2.config import yaml_parse
 import warnings
@@ -20,9 +21,9 @@ import numpy as np
 from theano import config
 from theano import tensor as T
 from theano import function
-from pylearn2.datasets.preprocessing import ExtractPatches, ExtractGridPatches, ReassembleGridPatches
+from pylearn2.datasets.preprocessing import ExtractPatches, ExtractGridPatches
 from pylearn2.utils import serial
-from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultViewConverter
+from pylearn2.utils.parallel import fork_pool
 from pylearn2.datasets.cifar10 import CIFAR10
 from pylearn2.datasets.cifar100 import CIFAR100
 from pylearn2.datasets.tl_challenge import TL_Challenge
@@ -152,31 +153,41 @@ class FeatureExtractor:
     def __init__(self, batch_size, kmeans_path,
            save_path,  dataset_family, which_set,
            num_output_features,
-           chunk_size = None, restrict = None, pool_mode = 'mean'):
+           chunk_size = None, restrict = None, pool_mode = 'mean',
+           num_workers = 1):
         """
             batch_size:  the number of images to process simultaneously
                          this does not affect the final result, it is just for performance
                          larger values allow more parallel processing but require more memory
             kmeans_path: a path to a .pkl file containing a pylearn2.kmeans.KMeans instance
-            save_path:   the base path to save to, should end in .npy
+            save_path:   the path to save to, should end in .npy
             dataset_family: extract_features.stl10, extract_features.cifar10, etc.
             which_set:     'train' or 'test'
             num_output_features: the number of randomly selected pooled features to extract per image
-            chunk_size:   will build a design matrix of this many processed examples before serializing
-                         them. if you use a chunk size of 10,000 on a dataset with 50,000 examples, and
-                         a save_path of foo.npy, this will result in you obtaining foo_A.npy through
-                         foo_E.npy.
-                         Use a small chunk_size to avoid running out of memory.
+            chunk_size:   split the dataset into chunks of this many examples, whose features are
+                         saved to separate files (shards) before being assembled into save_path.
+                         if you use a chunk size of 10,000 on a dataset with 50,000 examples, and
+                         a save_path of foo.npy, the shards are foo_00000.npy through foo_00004.npy.
+                         Shards that already exist are not extracted again, so an interrupted
+                         run can be resumed by running it again, with the same settings (they
+                         are recorded in foo_settings.json; if they changed, every shard is
+                         extracted again). Once all the shards exist, they are copied to
+                         foo.npy, a manifest describing the extraction is written to
+                         foo_manifest.json and the shards are deleted. Running again with the
+                         same settings then does nothing.
             restrict:    a tuple of of (start,end) indices
                          restrict feature extraction to only these examples
-                         the restrict option is used internally to implement the chunk_size option, so
-                         you may not specify both for the same FeatureExtractor
+                         may not be used together with chunk_size
             pool_mode:   'max' or 'mean'
+            num_workers: the number of processes the chunks are spread over. The dataset is
+                         loaded once, before the workers are forked; each of them loads the
+                         preprocessing pipeline and compiles the feature extraction function
+                         once.
         """
 
         if chunk_size is not None and restrict is not None:
-            raise NotImplementedError("Currently restrict is used internally to "
-                    "implement chunk_size, so a client may not specify both")
+            raise NotImplementedError("restrict and chunk_size may not be "
+                    "specified for the same FeatureExtractor")
 
         self.batch_size = batch_size
         self.model_path = kmeans_path
@@ -194,6 +205,7 @@ class FeatureExtractor:
         self.dataset_family = dataset_family
         self.chunk_size = chunk_size
         self.num_output_features = num_output_features
+        self.num_workers = num_workers
 
 
     def __call__(self):
@@ -237,68 +249,131 @@ class FeatureExtractor:
 
         #Run the experiment
         if self.chunk_size is not None:
-            dataset_family = self.dataset_family
-            which_set = self.which_set
-            dataset_descriptor = self.dataset_family[which_set][size]
-
-            num_examples = dataset_descriptor.num_examples
-            assert num_examples % self.chunk_size == 0
-
-            self.chunk_id = 0
-            for i in xrange(0,num_examples, self.chunk_size):
-                self.restrict = (i, i + self.chunk_size)
-
-                self._execute()
-
-                self.chunk_id += 1
+            self._run_chunks()
         else:
-            self._execute()
-
-    def _execute(self):
-
-        global num_superpixels
-        num_output_features = self.num_output_features
-        idxs = self.idxs
-        top = self.top
-        bottom = self.bottom
-        left = self.left
-        right = self.right
+            self._load_dataset()
+            if self.restrict is not None:
+                start, stop = self.restrict
+                assert stop <= self.full_X.shape[0]
+                assert stop > start
+                print 'restricting to examples ',start,' through ',stop,' exclusive'
+            else:
+                start, stop = 0, self.full_X.shape[0]
+            nan = self._extract((start, stop, self.save_path))
+            if nan > 0:
+                warnings.warn(str(nan)+' features were nan')
 
+    def _settings(self):
+        """
+        Returns the settings that determine the extracted features, as
+        recorded in the manifest and in the settings file of the shards.
+        """
+        dataset_descriptor = self.dataset_family[self.which_set][self.size]
+        return { 'kmeans_path' : self.model_path,
+                 'which_set' : self.which_set,
+                 'patch_size' : self.size,
+                 'pipeline_path' : dataset_descriptor.pipeline_path,
+                 'pool_mode' : self.pool_mode,
+                 'num_output_features' : self.num_output_features }
+
+    def _run_chunks(self):
         save_path = self.save_path
-        batch_size = self.batch_size
-        dataset_family = self.dataset_family
-        which_set = self.which_set
-        model = self.model
-        size = self.size
+        num_output_features = self.num_output_features
 
-        nan = 0
+        assert save_path.endswith('.npy')
+        prefix = save_path[:-len('.npy')]
+        settings = self._settings()
+
+        manifest_path = prefix + '_manifest.json'
+        manifest = _load_json(manifest_path)
+        if (manifest is not None and _same_settings(manifest, settings) and
+                _is_complete(save_path, tuple(manifest['shape']))):
+            print 'Not doing anything, '+save_path+' is already complete.'
+            return
+
+        self._load_dataset()
+        num_examples = self.full_X.shape[0]
+
+        chunks = [ (start, min(start + self.chunk_size, num_examples))
+                   for start in xrange(0, num_examples, self.chunk_size) ]
+        shard_paths = [ '%s_%05d.npy' % (prefix, i)
+                        for i in xrange(len(chunks)) ]
+
+        # The shards of an earlier run are only reused if it had the same
+        # settings. They are recorded before any shard is written.
+        shard_settings = dict(settings, chunk_size = self.chunk_size)
+        settings_path = prefix + '_settings.json'
+        previous_settings = _load_json(settings_path)
+        resume = (previous_settings is not None and
+                  _same_settings(previous_settings, shard_settings))
+        if not resume:
+            with open(settings_path, 'w') as f:
+                json.dump(shard_settings, f, indent = 2)
+
+        tasks = []
+        for (start, stop), shard_path in zip(chunks, shard_paths):
+            if resume and _is_complete(shard_path,
+                    (stop - start, num_output_features)):
+                print 'skipping examples ',start,' through ',stop,', already in ',shard_path
+            else:
+                tasks.append((start, stop, shard_path))
+
+        if self.num_workers > 1 and len(tasks) > 1:
+            pool, run_task = fork_pool(self._extract,
+                                       min(self.num_workers, len(tasks)))
+            try:
+                nans = list(pool.imap_unordered(run_task, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            nans = map(self._extract, tasks)
 
+        nan = sum(nans)
+        if nan > 0:
+            warnings.warn(str(nan)+' features were nan')
 
-        dataset_descriptor = dataset_family[which_set][size]
+        print 'assembling '+save_path
+        tmp_path = save_path + '.tmp'
+        output = np.lib.format.open_memmap(tmp_path, mode = 'w+',
+                dtype = 'float32', shape = (num_examples, num_output_features))
+        for (start, stop), shard_path in zip(chunks, shard_paths):
+            output[start:stop,:] = np.load(shard_path, mmap_mode = 'r')
+        output.flush()
+        del output
+        os.rename(tmp_path, save_path)
+
+        manifest = dict(settings)
+        manifest.update({ 'shape' : [num_examples, num_output_features],
+                          'dtype' : 'float32',
+                          'chunks' : [ { 'start' : start, 'stop' : stop }
+                                       for start, stop in chunks ] })
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent = 2)
+
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+        os.remove(settings_path)
+
+    def _load_dataset(self):
+        dataset_descriptor = self.dataset_family[self.which_set][self.size]
 
         dataset = dataset_descriptor.dataset_maker()
         expected_num_examples = dataset_descriptor.num_examples
 
-        full_X = dataset.get_design_matrix()
-        num_examples = full_X.shape[0]
+        self.full_X = dataset.get_design_matrix()
+        num_examples = self.full_X.shape[0]
         assert num_examples == expected_num_examples
 
-        if self.restrict is not None:
-            assert self.restrict[1]  <= full_X.shape[0]
-
-            print 'restricting to examples ',self.restrict[0],' through ',self.restrict[1],' exclusive'
-            full_X = full_X[self.restrict[0]:self.restrict[1],:]
-
-            assert self.restrict[1] > self.restrict[0]
-
-        #update for after restriction
-        num_examples = full_X.shape[0]
-
-        assert num_examples > 0
-
         dataset.X = None
         dataset.design_loc = None
         dataset.compress = False
+        self.dataset = dataset
+
+    def _compile(self):
+        size = self.size
+        model = self.model
+        dataset_descriptor = self.dataset_family[self.which_set][size]
 
         patchifier = ExtractGridPatches( patch_shape = (size,size), patch_stride = (1,1) )
 
@@ -306,6 +381,7 @@ class FeatureExtractor:
 
         assert isinstance(pipeline.items[0], ExtractPatches)
         pipeline.items[0] = patchifier
+        self.pipeline = pipeline
 
 
         print 'defining features'
@@ -325,46 +401,56 @@ class FeatureExtractor:
         if config.device.startswith('gpu') and nhid >= 4000:
             f = halver(f, model.nhid)
 
-        topo_feat_var = T.TensorType(broadcastable = (False,False,False,False), dtype='float32')()
-        if self.pool_mode == 'mean':
-            region_features = function([topo_feat_var],
-                topo_feat_var.mean(axis=(1,2)) )
-        elif self.pool_mode == 'max':
-            region_features = function([topo_feat_var],
-                    topo_feat_var.max(axis=(1,2)) )
-        else:
-            assert False
-
-        def average_pool( stride ):
-            def point( p ):
-                return p * ns / stride
+        self.f = f
 
-            rval = np.zeros( (topo_feat.shape[0], stride, stride, topo_feat.shape[3] ) , dtype = 'float32')
+    def _extract(self, task):
+        """
+        Extracts the features of the examples in range(start, stop) and
+        saves them to save_path. The file only appears once it is
+        complete. Returns the number of nan features.
+        """
+        start, stop, save_path = task
 
-            for i in xrange(stride):
-                for j in xrange(stride):
-                    rval[:,i,j,:] = region_features( topo_feat[:,point(i):point(i+1), point(j):point(j+1),:] )
+        global num_superpixels
+        num_output_features = self.num_output_features
+        idxs = self.idxs
+        top = self.top
+        bottom = self.bottom
+        left = self.left
+        right = self.right
 
-            return rval
+        batch_size = self.batch_size
+        dataset = self.dataset
+        size = self.size
 
-        output =  np.zeros((num_examples,num_output_features),dtype='float32')
+        if not hasattr(self, 'f'):
+            self._compile()
+        pipeline = self.pipeline
+        f = self.f
 
+        nan = 0
 
-        fd = DenseDesignMatrix(X = np.zeros((1,1),dtype='float32'), view_converter = DefaultViewConverter([1, 1, nhid] ) )
+        full_X = self.full_X[start:stop,:]
+        num_examples = full_X.shape[0]
+        assert num_examples > 0
 
+        nhid = self.model.mu.get_value().shape[0]
         ns = 32 - size + 1
-        depatchifier = ReassembleGridPatches( orig_shape  = (ns, ns), patch_shape=(1,1) )
 
-        if len(range(0,num_examples-batch_size+1,batch_size)) <= 0:
-            print num_examples
-            print batch_size
+        # The features are written to the output file as they are computed
+        tmp_path = save_path + '.tmp'
+        output = np.lib.format.open_memmap(tmp_path, mode = 'w+',
+                dtype = 'float32', shape = (num_examples, num_output_features))
 
-        for i in xrange(0,num_examples-batch_size+1,batch_size):
-            print i
+        for i in xrange(0,num_examples,batch_size):
+            print start + i
             t1 = time.time()
 
+            # the last batch may be smaller
+            cur_batch_size = min(batch_size, num_examples - i)
+
             d = copy.copy(dataset)
-            d.set_design_matrix(full_X[i:i+batch_size,:])
+            d.set_design_matrix(full_X[i:i+cur_batch_size,:])
 
             t2 = time.time()
 
@@ -381,56 +467,128 @@ class FeatureExtractor:
 
             assert feat.dtype == 'float32'
 
-            feat_dataset = copy.copy(fd)
-
             if np.any(np.isnan(feat)):
                 nan += np.isnan(feat).sum()
                 feat[np.isnan(feat)] = 0
 
-            feat_dataset.set_design_matrix(feat)
-
-            #print '\treassembling features'
-            feat_dataset.apply_preprocessor(depatchifier)
-
-            #print '\tmaking topological view'
-            topo_feat = feat_dataset.get_topological_view()
-            assert topo_feat.shape[0] == batch_size
+            # ExtractGridPatches orders the patches by image, then by row
+            # and column, so this is the topological view of the detector
+            # feature maps
+            topo_feat = feat.reshape(cur_batch_size, ns, ns, nhid)
 
             t5 = time.time()
 
             #average pooling
-            superpixels = average_pool(num_superpixels)
-
-            assert batch_size == 1
-
-            if self.pool_mode == 'mean':
-                for j in xrange(num_output_features):
-                    output[i:i+batch_size, j] = superpixels[:,top[j]:bottom[j]+1,
-                            left[j]:right[j]+1, idxs[j]].mean()
-            elif self.pool_mode == 'max':
-                for j in xrange(num_output_features):
-                    output[i:i+batch_size, j] = superpixels[:,top[j]:bottom[j]+1,
-                            left[j]:right[j]+1, idxs[j]].max()
-            else:
-                assert False
+            superpixels = superpixel_pool(topo_feat, num_superpixels,
+                                          self.pool_mode)
+
+            output[i:i+cur_batch_size,:] = pool_rectangles(superpixels,
+                    idxs, top, bottom, left, right, self.pool_mode)
 
-            assert output[i:i+batch_size,:].max() < 1e20
+            assert output[i:i+cur_batch_size,:].max() < 1e20
 
             t6 = time.time()
 
             print (t6-t1, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5)
 
-        if self.chunk_size is not None:
-            assert save_path.endswith('.npy')
-            save_path_pieces = save_path.split('.npy')
-            assert len(save_path_pieces) == 2
-            assert save_path_pieces[1] == ''
-            save_path = save_path_pieces[0] + '_' + chr(ord('A')+self.chunk_id)+'.npy'
-        np.save(save_path,output)
+        output.flush()
+        del output
+        os.rename(tmp_path, save_path)
 
+        return nan
+
+
+def _load_json(path):
+    """
+    Returns the object stored in the json file at path, or None if there
+    is no such file or it can't be read.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def _same_settings(recorded, settings):
+    """
+    Tells whether the dict recorded, loaded from a json file, holds the
+    same value as settings for each key of settings.
+    """
+    return all(key in recorded and recorded[key] == value
+               for key, value in settings.iteritems())
+
+
+def _is_complete(path, shape):
+    """
+    Tells whether path is a .npy file holding a float32 array of the given
+    shape.
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        X = np.load(path, mmap_mode = 'r')
+    except Exception:
+        return False
+    return X.shape == shape and X.dtype == 'float32'
+
+
+def superpixel_pool(topo_feat, num_superpixels, pool_mode):
+    """
+    Pools each channel of topo_feat, a batch of feature maps of shape
+    (batch, rows, cols, channels), over a num_superpixels x num_superpixels
+    grid of regions, returning an array of shape
+    (batch, num_superpixels, num_superpixels, channels).
+
+    Region i along an axis of width n spans [i*n/num_superpixels,
+    (i+1)*n/num_superpixels), so the regions differ in size when n is not
+    divisible by num_superpixels.
+    """
+    starts = [ [ i * width / num_superpixels for i in xrange(num_superpixels) ]
+               for width in topo_feat.shape[1:3] ]
+
+    if pool_mode == 'mean':
+        sums = np.add.reduceat(topo_feat, starts[0], axis = 1, dtype = 'float64')
+        sums = np.add.reduceat(sums, starts[1], axis = 2)
+        heights, widths = [ np.diff(axis_starts + [width])
+                            for axis_starts, width in zip(starts, topo_feat.shape[1:3]) ]
+        areas = np.outer(heights, widths)
+        return (sums / areas[None, :, :, None]).astype('float32')
+    elif pool_mode == 'max':
+        rval = np.maximum.reduceat(topo_feat, starts[0], axis = 1)
+        return np.maximum.reduceat(rval, starts[1], axis = 2)
+    else:
+        assert False
+
+
+def pool_rectangles(superpixels, idxs, top, bottom, left, right, pool_mode):
+    """
+    Pools output feature j of each example over the superpixels of
+    channel idxs[j] with rows top[j] through bottom[j] and columns left[j]
+    through right[j], inclusive. Returns an array of shape
+    (batch, len(idxs)).
+
+    All the rectangles are gathered at once, as a mask over the superpixel
+    grid.
+    """
+    batch_size, rows, cols, channels = superpixels.shape
+    r = np.arange(rows)[:, None, None]
+    c = np.arange(cols)[None, :, None]
+    mask = (r >= top) & (r <= bottom) & (c >= left) & (c <= right)
+    mask = mask.reshape(rows * cols, len(idxs))
+
+    gathered = superpixels.reshape(batch_size, rows * cols, channels)[:, :, idxs]
+
+    if pool_mode == 'mean':
+        rval = (gathered * mask).sum(axis = 1) / mask.sum(axis = 0)
+    elif pool_mode == 'max':
+        rval = np.where(mask, gathered, -np.inf).max(axis = 1)
+    else:
+        assert False
+    return rval.astype('float32')
 
-        if nan > 0:
-            warnings.warn(str(nan)+' features were nan')
 
 if __name__ == '__main__':
     assert len(sys.argv) == 2
@@ -4,23 +4,47 @@ usage:
 
 plot_monitor.py model_1.pkl model_2.pkl ... model_n.pkl
 
-Loads any number of .pkl files produced by train.py. Extracts
-all of their monitoring channels and prompts the user to select
-a subset of them to be plotted.
+Loads any number of .pkl files produced by train.py, or of metrics
+files (with the .jsonl extension) written through the metrics_path
+argument of train.py's Train object. Extracts all of their monitoring
+channels and prompts the user to select a subset of them to be plotted.
+
+Metrics files are read directly, without loading the model or theano,
+so they are much faster to plot.
 
 """
 
-from pylearn2.utils import serial
 import matplotlib.pyplot as plt
 import numpy as N
 import sys
-from theano.printing import _TagGenerator
+from pylearn2.metrics import read_channels
+
+
+class _TagGenerator(object):
+    """ Gives the short codes A, B, ..., Z, BA, BB, ... """
+    def __init__(self):
+        self.cur_tag_number = 0
+
+    def get_tag(self):
+        number = self.cur_tag_number
+        self.cur_tag_number += 1
+        rval = ''
+        while True:
+            rval = chr(ord('A') + number % 26) + rval
+            number //= 26
+            if number == 0:
+                return rval
 
 channels = {}
 
 for i, arg in enumerate(sys.argv[1:]):
-    model = serial.load(arg)
-    this_model_channels = model.monitor.channels
+    if arg.endswith('.jsonl'):
+        this_model_channels = read_channels(arg)
+    else:
+        # Only import theano when it's needed to unpickle a model
+        from pylearn2.utils import serial
+        model = serial.load(arg)
+        this_model_channels = model.monitor.channels
 
     if len(sys.argv) > 2:
         prefix = "model_"+str(i)+":"
@@ -16,6 +16,9 @@ import argparse
 import datetime
 import gc
 import os
+import sys
+import threading
+import time
 import warnings
 
 # Third-party imports
@@ -23,7 +26,9 @@ import numpy as np
 
 # Local imports
 import pylearn2.config.yaml_parse
+from pylearn2.utils import checkpoint
 from pylearn2.utils import serial
+from pylearn2.utils.string_utils import preprocess
 from pylearn2.monitor import Monitor
 
 
@@ -61,7 +66,8 @@ class Train(object):
     and each of the registered callbacks are called.
     """
     def __init__(self, dataset, model, algorithm=None, save_path=None,
-                 save_freq=0, callbacks=None):
+                 save_freq=0, callbacks=None, async_save=False,
+                 keep_checkpoints=1, resume_path=None, metrics_path=None):
         """
         Construct a Train instance.
 
@@ -86,6 +92,28 @@ class Train(object):
         callbacks : iterable, optional
             A collection of callbacks that are called, one at a time,
             after each epoch.
+        async_save : bool, optional
+            If True, saving only blocks training for as long as it takes
+            to copy the model's arrays; the copy is written to disk by a
+            background thread, using the format of
+            `pylearn2.utils.checkpoint`. save_path and resume_path must
+            then end with .ckpt. If the previous save is still being
+            written when the next one is due, training waits for it.
+        keep_checkpoints : int, optional
+            Number of saves to keep. The most recent is at save_path, and
+            older ones at save_path.1, save_path.2, etc.
+        resume_path : str, optional
+            If specified, every save also writes the whole state of the
+            training run (this object, including the model, the algorithm
+            and its termination criterion, the callbacks, the monitor and
+            the position of the dataset's random stream) to this path.
+            Running `train.py --resume resume_path` then continues
+            training where that save left off.
+        metrics_path : str, optional
+            If specified, every monitoring record, the duration of each
+            epoch and the compilation times are appended to this file,
+            in the format of `pylearn2.metrics`. scripts/plot_monitor.py
+            can plot it directly.
         """
         self.dataset = dataset
         self.model = model
@@ -106,6 +134,24 @@ class Train(object):
                     tokens = os.environ['PYLEARN2_TRAIN_FILE_NAME'], 'pkl'
                 self.save_path = '.'.join(tokens)
         self.save_freq = save_freq
+        if keep_checkpoints < 1:
+            raise ValueError("keep_checkpoints must be at least 1, got " +
+                             str(keep_checkpoints))
+        if async_save:
+            for path in [getattr(self, 'save_path', None), resume_path]:
+                if path is not None and not path.endswith('.ckpt'):
+                    raise ValueError("async_save writes the format of "
+                                     "pylearn2.utils.checkpoint, so the "
+                                     "save paths must end with .ckpt, got "
+                                     + path)
+        self.async_save = async_save
+        self.keep_checkpoints = keep_checkpoints
+        self.resume_path = resume_path
+        self.metrics_path = metrics_path
+        self._save_thread = None
+        self._save_error = None
+        self._resuming = False
+        self._dataset_position = None
         self.epochs = 0
         self.callbacks = callbacks if callbacks is not None else []
 
@@ -119,32 +165,89 @@ class Train(object):
         Repeatedly runs an epoch of the training algorithm, runs any
         epoch-level callbacks, and saves the model.
         """
+        resuming = self._resuming
+        if resuming:
+            self._restore_dataset()
+            self._resuming = False
+        monitor = Monitor.get_monitor(self.model)
+        if getattr(self, 'metrics_path', None) is not None:
+            monitor.log_metrics_to(self.metrics_path)
         if self.algorithm is None:
-            self.model.monitor = Monitor.get_monitor(self.model)
+            epoch_start = datetime.datetime.now()
             while self.model.train(dataset=self.dataset):
+                self._log_epoch(epoch_start)
+                epoch_start = datetime.datetime.now()
                 self.run_callbacks_and_monitoring()
-                if self.save_freq > 0 and self.epochs % self.save_freq == 0:
-                    self.save()
+                # epochs is incremented before saving so that the saved
+                # state counts the epoch it was saved after
                 self.epochs += 1
+                if (self.save_freq > 0 and
+                        (self.epochs - 1) % self.save_freq == 0):
+                    self.save()
             self.run_callbacks_and_monitoring()
+            self.model.monitor.wait()
             if self.save_freq > 0:
                 self.save()
+            self.wait_for_save()
+            self.model.monitor.flush_metrics()
         else:
             self.algorithm.setup(model=self.model, dataset=self.dataset)
-            self.model.monitor()
+            if not resuming:
+                # A resumed run already has the record of this point
+                self.model.monitor()
             epoch_start = datetime.datetime.now()
             while self.algorithm.train(dataset=self.dataset):
-                epoch_end = datetime.datetime.now()
-                print 'Time this epoch:', str(epoch_end - epoch_start)
+                self._log_epoch(epoch_start)
                 epoch_start = datetime.datetime.now()
                 self.run_callbacks_and_monitoring()
-                if self.save_freq > 0 and self.epochs % self.save_freq == 0:
-                    self.save()
                 self.epochs += 1
+                if (self.save_freq > 0 and
+                        (self.epochs - 1) % self.save_freq == 0):
+                    self.save()
             self.run_callbacks_and_monitoring()
+            self.model.monitor.wait()
 
             if self.save_freq > 0:
                 self.save()
+            self.wait_for_save()
+            self.model.monitor.flush_metrics()
+
+    def _get_dataset_stream_position(self):
+        if not hasattr(self.dataset, 'get_stream_position'):
+            return None
+        # The algorithm may have drawn batches ahead of those it used
+        if hasattr(self.algorithm, 'get_dataset_stream_position'):
+            return self.algorithm.get_dataset_stream_position(self.dataset)
+        return self.dataset.get_stream_position()
+
+    def _restore_dataset(self):
+        if isinstance(self.dataset, basestring):
+            self.dataset = pylearn2.config.yaml_parse.load(self.dataset)
+        if self._dataset_position is not None:
+            self.dataset.set_stream_position(self._dataset_position)
+        self._dataset_position = None
+
+    def __getstate__(self):
+        """
+        Returns the state needed to resume training, which is written to
+        resume_path. The dataset is replaced by its yaml source, if it has
+        one, and the position of its random stream.
+        """
+        d = dict(self.__dict__)
+        d['_dataset_position'] = self._get_dataset_stream_position()
+        if hasattr(self.dataset, 'yaml_src'):
+            d['dataset'] = self.dataset.yaml_src
+        d['_resuming'] = True
+        d['_save_thread'] = None
+        d['_save_error'] = None
+        return d
+
+    def _log_epoch(self, epoch_start):
+        epoch_end = datetime.datetime.now()
+        print 'Time this epoch:', str(epoch_end - epoch_start)
+        self.model.monitor.log_event(
+            'epoch', epoch=self.epochs, time=time.time(),
+            duration=(epoch_end - epoch_start).total_seconds())
 
     def run_callbacks_and_monitoring(self):
         self.model.monitor()
@@ -157,17 +260,99 @@ class Train(object):
 
 
     def save(self):
-        """Saves the model."""
-        #TODO-- save state of dataset and training algorithm so training can be
-        # resumed after a crash
+        """
+        Saves the model to save_path and, if resume_path was specified,
+        the state of the training run to resume_path.
+        """
+        targets = []
         if self.save_path is not None:
-            print 'saving to', self.save_path, '...'
+            targets.append((self.save_path, self.model))
+        if self.resume_path is not None:
+            # The monitor records of an evaluation running in the
+            # background would be lost
+            self.model.monitor.wait()
+            targets.append((self.resume_path, self))
+        if len(targets) == 0:
+            return
+        targets = [(preprocess(path), obj) for path, obj in targets]
+        if self.async_save:
+            self._save_async(targets)
+            return
+        for path, obj in targets:
+            print 'saving to', path, '...'
             save_start = datetime.datetime.now()
-            serial.save(self.save_path, self.model)
+            if path.endswith('.joblib'):
+                # joblib may write other files named after this one, which
+                # can't be renamed with it
+                self._rotate_checkpoints(path)
+                serial.save(path, obj)
+            else:
+                # The previous save is only moved away once this one is on
+                # disk. The temporary file keeps the suffix, which selects
+                # the format.
+                root, ext = os.path.splitext(path)
+                tmp_path = root + '.tmp' + ext
+                try:
+                    serial.save(tmp_path, obj)
+                except:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                self._rotate_checkpoints(path)
+                os.rename(tmp_path, path)
             save_end = datetime.datetime.now()
             delta = (save_end - save_start)
             print '...done. saving took', str(delta)
 
+    def _save_async(self, targets):
+        # Only one save is in flight at a time
+        self.wait_for_save()
+        print 'taking a snapshot for', ', '.join(path for path, obj in targets),
+        print '...'
+        save_start = datetime.datetime.now()
+        snaps = [(path, checkpoint.snapshot(obj)) for path, obj in targets]
+        save_end = datetime.datetime.now()
+        print '...done. the snapshot took', str(save_end - save_start),
+        print '(it is being written in the background)'
+        self._save_thread = threading.Thread(target=self._write_snapshots,
+                                             args=(snaps,))
+        self._save_thread.start()
+
+    def _write_snapshots(self, snaps):
+        try:
+            for path, snap in snaps:
+                tmp_path = path + '.tmp'
+                checkpoint.write_snapshot(tmp_path, snap)
+                self._rotate_checkpoints(path)
+                os.rename(tmp_path, path)
+        except Exception:
+            self._save_error = sys.exc_info()
+
+    def _rotate_checkpoints(self, path):
+        for i in xrange(self.keep_checkpoints - 1, 0, -1):
+            if i == 1:
+                src = path
+            else:
+                src = '%s.%d' % (path, i - 1)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (path, i))
+
+    def wait_for_save(self):
+        """
+        Blocks until the save being written in the background, if any, is
+        on disk, and raises any error that occurred while writing it.
+        """
+        if self._save_thread is not None:
+            wait_start = datetime.datetime.now()
+            self._save_thread.join()
+            self._save_thread = None
+            wait_end = datetime.datetime.now()
+            print 'waited', str(wait_end - wait_start), 'for the previous save'
+        if self._save_error is not None:
+            exc_info = self._save_error
+            self._save_error = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
 
 def make_argument_parser():
     parser = argparse.ArgumentParser(
@@ -177,15 +362,28 @@ def make_argument_parser():
     )
     parser.add_argument('config', action='store',
                         type=argparse.FileType('r'),
-                        choices=None,
+                        choices=None, nargs='?',
                         help='A YAML configuration file specifying the '
                              'training procedure')
+    parser.add_argument('--resume', action='store', default=None,
+                        help='Instead of a YAML configuration file, a file '
+                             'written to the resume_path of a Train object, '
+                             'from which to continue training')
     return parser
 
 
 if __name__ == "__main__":
     parser = make_argument_parser()
     args = parser.parse_args()
+    if args.resume is not None:
+        if args.config is not None:
+            parser.error('a configuration file and --resume are mutually '
+                         'exclusive')
+        train_obj = serial.load(args.resume)
+        train_obj.main_loop()
+        sys.exit(0)
+    if args.config is None:
+        parser.error('either a configuration file or --resume is required')
     config_file_path = args.config.name
     suffix_to_strip = '.yaml'
     if config_file_path.endswith(suffix_to_strip):
@@ -0,0 +1,43 @@
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.kmeans import KMeans
+
+
+def make_blobs():
+    rng = np.random.RandomState([1, 2, 3])
+    centers = np.array([[0., 0., 0.], [10., 0., 0.], [0., 10., 10.]])
+    labels = rng.randint(3, size=600)
+    X = centers[labels] + rng.randn(600, 3)
+    return centers, DenseDesignMatrix(X=X.astype('float32'))
+
+
+def check_centers(model, centers):
+    mu = model.mu.get_value()
+    assert mu.shape == centers.shape
+    for center in centers:
+        assert np.sqrt(np.square(mu - center).sum(axis=1)).min() < 0.5
+
+
+def test_kmeans_lloyd():
+    centers, dataset = make_blobs()
+    model = KMeans(k=3, nvis=3, init='k-means++', num_workers=2, seed=4)
+    model.train(dataset)
+    check_centers(model, centers)
+
+    # same seed, same result
+    other = KMeans(k=3, nvis=3, init='k-means++', seed=4)
+    other.train(dataset)
+    assert np.allclose(other.mu.get_value(), model.mu.get_value())
+
+    probs = model(dataset.X)
+    assert probs.shape == (600, 3)
+    assert np.allclose(probs.sum(axis=1), 1)
+
+
+def test_kmeans_mini_batch():
+    centers, dataset = make_blobs()
+    model = KMeans(k=3, nvis=3, init='k-means++', batch_size=50,
+                   max_iter=5, seed=4)
+    model.train(dataset)
+    check_centers(model, centers)
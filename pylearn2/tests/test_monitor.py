@@ -0,0 +1,197 @@
+import cPickle
+
+import numpy as np
+from theano import shared
+import theano.tensor as T
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.monitor import Monitor
+from pylearn2.space import VectorSpace
+
+
+class DummyModel(object):
+    def __init__(self):
+        self.scale = shared(np.cast['float64'](1.), name='scale')
+
+    def get_input_space(self):
+        return VectorSpace(3)
+
+    def get_params(self):
+        return [self.scale]
+
+
+def make_monitor(**kwargs):
+    model = DummyModel()
+    monitor = Monitor(model)
+    X = np.random.RandomState([1,2,3]).rand(23, 3)
+    monitor.set_dataset(dataset=DenseDesignMatrix(X=X), batch_size=5,
+                        **kwargs)
+    V = T.matrix()
+    monitor.add_channel('mean', ipt=V, val=model.scale * V.mean())
+    return model, monitor, X
+
+
+def test_monitor_weighted_mean():
+    #tests that batch means are weighted by the size of the batches, and
+    #that only the requested number of batches is used
+    model, monitor, X = make_monitor(batches=-1)
+    monitor()
+    assert np.allclose(monitor.channels['mean'].val_record, [X.mean()])
+
+    model, monitor, X = make_monitor(batches=2)
+    monitor()
+    assert np.allclose(monitor.channels['mean'].val_record, [X[:10].mean()])
+
+
+def test_monitor_frequency_and_background():
+    #tests that the monitor skips calls as requested, and that background
+    #evaluations use the parameters as they were when the monitor was
+    #called
+    model, monitor, X = make_monitor(batches=-1, frequency=2,
+                                     background=True)
+    for scale in [1., 2., 3.]:
+        model.scale.set_value(scale)
+        monitor()
+        model.scale.set_value(-1.)
+    monitor.wait()
+    assert np.allclose(monitor.channels['mean'].val_record,
+                       [X.mean(), 3. * X.mean()])
+
+
+def test_readd_unpickled_channel():
+    #tests that when a training algorithm adds its channels again to an
+    #unpickled monitor (as happens when training is resumed), the
+    #channels keep their records, but that a channel can't be added twice
+    monitor = Monitor(DummyModel())
+    X = T.matrix()
+    monitor.add_channel('mean', ipt=X, val=X.mean())
+    channel = monitor.channels['mean']
+    channel.val_record.extend([1., 2.])
+    channel.batch_record.extend([10, 20])
+    channel.example_record.extend([100, 200])
+
+    monitor = cPickle.loads(cPickle.dumps(monitor))
+    X = T.matrix()
+    monitor.add_channel('mean', ipt=X, val=X.mean())
+    channel = monitor.channels['mean']
+    assert channel.val_record == [1., 2.]
+    assert channel.batch_record == [10, 20]
+    assert channel.example_record == [100, 200]
+
+    try:
+        monitor.add_channel('mean', ipt=X, val=X.mean())
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_metrics_log():
+    #tests that records written to a metrics file are read back, and that
+    #reading them doesn't need theano
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    from pylearn2.metrics import read_channels
+
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    try:
+        model, monitor, X = make_monitor(batches=-1)
+        monitor.log_metrics_to(path)
+        monitor()
+        monitor.batches_seen = 4
+        monitor.examples_seen = 20
+        model.scale.set_value(2.)
+        monitor()
+        monitor.metrics.close()
+
+        channels = read_channels(path)
+        assert channels.keys() == ['mean']
+        channel = channels['mean']
+        assert np.allclose(channel.val_record, [X.mean(), 2. * X.mean()])
+        assert channel.batch_record == [0, 4]
+        assert channel.example_record == [0, 20]
+        assert channel.epoch_record == [0, 1]
+
+        script = ('import sys; from pylearn2.metrics import read_channels; '
+                  'read_channels(sys.argv[1]); '
+                  'assert "theano" not in sys.modules')
+        import pylearn2
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(pylearn2.__file__)))
+        assert subprocess.call([sys.executable, '-c', script, path],
+                               env=env) == 0
+    finally:
+        os.remove(path)
+
+
+class DummyAlgorithm(object):
+    def __init__(self, model):
+        self.model = model
+        self.learning_rate = .1
+
+
+def run_epochs(model, monitor, scales, callback):
+    #calls the monitor once for initialization, then once per epoch, with
+    #the given parameter values, each call followed by the callback as in
+    #training algorithms; returns what the callback returned after each
+    #epoch
+    model.monitor = monitor
+    rval = []
+    for i, scale in enumerate(scales):
+        model.scale.set_value(scale)
+        monitor()
+        if i > 0:
+            rval.append(callback())
+    return rval
+
+
+def test_lr_adjuster_deferred_monitor():
+    #tests that the learning rate is adjusted once per new record when
+    #the monitor doesn't add one after every epoch
+    from pylearn2.training_algorithms.sgd import MonitorBasedLRAdjuster
+
+    # the records of the evaluation started at each call are only added
+    # at the next one, so there are records of epochs 0, 1, 2 at the end
+    model, monitor, X = make_monitor(batches=-1, background=True)
+    algorithm = DummyAlgorithm(model)
+    adjuster = MonitorBasedLRAdjuster()
+    run_epochs(model, monitor, [4., 3., 2., 1.],
+               lambda: adjuster(model, None, algorithm))
+    assert np.allclose(algorithm.learning_rate, .1 * 1.01 ** 2)
+
+    # records of epochs 0, 2 and 4
+    model, monitor, X = make_monitor(batches=-1, frequency=2)
+    algorithm = DummyAlgorithm(model)
+    adjuster = MonitorBasedLRAdjuster()
+    run_epochs(model, monitor, [5., 4., 3., 2., 1.],
+               lambda: adjuster(model, None, algorithm))
+    assert np.allclose(algorithm.learning_rate, .1 * 1.01 ** 2)
+
+
+def test_term_crit_deferred_monitor():
+    #tests that N counts epochs, not records, when the monitor doesn't
+    #add a record after every epoch
+    from pylearn2.training_algorithms.sgd import MonitorBasedTermCrit
+
+    # records of epochs 0, 2 and 4: epoch 4 is compared with epoch 2
+    model, monitor, X = make_monitor(batches=-1, frequency=2)
+    crit = MonitorBasedTermCrit(prop_decrease=.1, N=3)
+    rval = run_epochs(model, monitor, [10., 9., 5., 5., 4.9],
+                      lambda: crit(model))
+    assert rval == [True, True, True, False]
+    assert monitor.channels['mean'].epoch_record == [0, 2, 4]
+
+    # the records lag one epoch behind: after epoch 3, those of epochs 0
+    # to 2 are there, and epoch 2 is compared with epoch 1
+    model, monitor, X = make_monitor(batches=-1, background=True)
+    crit = MonitorBasedTermCrit(prop_decrease=.1, N=2)
+    rval = run_epochs(model, monitor, [10., 5., 4.9, 1.],
+                      lambda: crit(model))
+    assert rval == [True, True, False]
+    monitor.wait()
+    assert monitor.channels['mean'].epoch_record == [0, 1, 2, 3]
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.pca import CovEigPCA, SVDPCA
+
+
+def make_data():
+    # 500 examples in 20 dimensions, with a few dominant directions
+    rng = np.random.RandomState([1, 2, 3])
+    scales = np.array([10., 8., 6., 4.] + [.5] * 16)
+    basis = np.linalg.qr(rng.randn(20, 20))[0]
+    X = np.dot(rng.randn(500, 20) * scales, basis.T) + 3.
+    return X.astype('float32')
+
+
+def check_components(model, X, num_components):
+    # compares with the eigendecomposition of the covariance of X
+    Xc = X - X.mean(axis=0, dtype='float64')
+    v, W = np.linalg.eigh(np.dot(Xc.T, Xc))
+    v, W = v[::-1][:num_components], W[:, ::-1][:, :num_components]
+    assert np.allclose(model.mean.get_value(), X.mean(axis=0), atol=1e-4)
+    model_W = model.W.get_value()
+    assert model_W.shape == (20, num_components)
+    # the components are the same up to their sign
+    assert np.allclose(np.abs((model_W * W).sum(axis=0)), 1, atol=1e-3)
+    return v, model.v.get_value()
+
+
+def test_cov_eig_pca():
+    X = make_data()
+    model = CovEigPCA(cov_batch_size=64, num_components=5)
+    model.train(X)
+    v, model_v = check_components(model, X, 5)
+    assert np.allclose(model_v, v / (X.shape[0] - 1), rtol=1e-4)
+
+
+def test_randomized_svd_pca():
+    X = make_data()
+    model = SVDPCA(num_components=4, randomized=True, batch_size=64)
+    model.train(X)
+    v, model_v = check_components(model, X, 4)
+    assert np.allclose(model_v, v, rtol=1e-4)
+
+    # the same as the full SVD
+    full = SVDPCA(num_components=4)
+    full.train(X)
+    assert np.allclose(full.v.get_value(), model_v, rtol=1e-4)
+
+
+def test_pca_memmap_dataset():
+    X = make_data()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'X.npy')
+        np.save(path, X)
+        dataset = DenseDesignMatrix(X=np.load(path, mmap_mode='r'))
+        for model in [CovEigPCA(num_components=4),
+                      SVDPCA(num_components=4, randomized=True)]:
+            model.train(dataset)
+            check_components(model, X, 4)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,82 @@
+import itertools
+
+import numpy
+
+from pylearn2 import rbm_tools
+
+
+def make_rbm(nvis=5, nhid=3):
+    rng = numpy.random.RandomState(1)
+    return [rng.randn(nvis, nhid), rng.randn(nvis) * .5, rng.randn(nhid) * .5]
+
+
+def exact_log_z(rbm_params):
+    weights, visbias, hidbias = rbm_params
+    v = numpy.array(list(itertools.product([0, 1], repeat=len(visbias))))
+    fe = -numpy.dot(v, visbias) - \
+         numpy.log(1 + numpy.exp(numpy.dot(v, weights) + hidbias)).sum(axis=1)
+    return numpy.log(numpy.exp(-fe).sum())
+
+
+def test_rbm_ais():
+    rbm_params = make_rbm()
+    betas = numpy.linspace(0, 1, 1000)
+    (log_z, var_dlogz), ais = rbm_tools.rbm_ais(rbm_params, 100, betas=betas,
+                                                key_betas=[.5])
+    assert abs(log_z - exact_log_z(rbm_params)) < .1
+    assert ais.n_runs == 100
+    # the weights are recorded every log_int temperatures and at the key
+    # temperature
+    assert len(ais.std_ais_w) == 2
+    assert len(ais.logz_beta) == 1
+
+    # logz_beta holds log(Z_beta / Z_0) for the interpolating distributions.
+    # At beta = .5, the visible biases are interpolated between those of the
+    # base-rate model (the same here) and of the RBM, whose weights and
+    # hidden biases are halved. Z_.5 and Z_0 / exp(log_za) both have an
+    # extra factor of 2 per hidden unit, from the hidden units of the
+    # base-rate model at beta = .5, and from those of the RBM at beta = 0.
+    half = [rbm_params[0] * .5, rbm_params[1], rbm_params[2] * .5]
+    assert abs(ais.logz_beta[0] - (exact_log_z(half) - ais.log_za)) < .1
+
+
+def test_rbm_ais_parallel_early_stopping():
+    rbm_params = make_rbm()
+    betas = numpy.linspace(0, 1, 1000)
+    progress = []
+    callback = lambda *args: progress.append(args)
+    # each batch of 20 particles is split across 2 processes, and batches
+    # are added until the variance target is met
+    (log_z, var_dlogz), ais = rbm_tools.rbm_ais(
+            rbm_params, 20, betas=betas, num_workers=2, var_target=1e-9,
+            max_runs=60, callback=callback)
+    assert ais.n_runs == 60
+    assert [n for n, _, _ in progress] == [10, 20, 30, 40, 50, 60]
+    assert progress[-1][1] == log_z
+    assert abs(log_z - exact_log_z(rbm_params)) < .2
+
+
+class FakeRBM(object):
+    def __init__(self, rbm_params):
+        self.nvis, self.nhid = rbm_params[0].shape
+
+
+def test_compute_log_z():
+    rbm_params = make_rbm(nvis=6, nhid=9)
+    weights, visbias, hidbias = rbm_params
+
+    def free_energy_fn(v):
+        return -numpy.dot(v, visbias) - numpy.log(
+                1 + numpy.exp(numpy.dot(v, weights) + hidbias)).sum(axis=1)
+
+    log_z = exact_log_z(rbm_params)
+    rbm = FakeRBM(rbm_params)
+    assert numpy.allclose(rbm_tools.compute_log_z(rbm, free_energy_fn),
+                          log_z)
+    # several blocks, spread over several processes
+    assert numpy.allclose(rbm_tools.compute_log_z(rbm, free_energy_fn,
+                                                  max_bits=2),
+                          log_z)
+    assert numpy.allclose(rbm_tools.compute_log_z(rbm, free_energy_fn,
+                                                  max_bits=3, num_workers=2),
+                          log_z)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import warnings
+
+from pylearn2.scripts.train import Train
+from pylearn2.utils import serial
+
+
+class Picklable(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def make_train(**kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return Train(dataset=None, model=Picklable(1), **kwargs)
+
+
+def test_failed_save_keeps_previous_checkpoint():
+    #tests that a save that fails leaves the previous one in place
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'model.pkl')
+        train = make_train(save_path=path, save_freq=1, keep_checkpoints=2)
+        train.save()
+        train.model.value = lambda: None
+        try:
+            train.save()
+        except Exception:
+            pass
+        else:
+            assert False
+        assert sorted(os.listdir(tmp_dir)) == ['model.pkl']
+        assert serial.load(path).value == 1
+
+        train.model.value = 2
+        train.save()
+        assert serial.load(path).value == 2
+        assert serial.load(path + '.1').value == 1
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_async_save_requires_checkpoint_suffix():
+    try:
+        make_train(save_path='model.pkl', save_freq=1, async_save=True)
+    except ValueError:
+        pass
+    else:
+        assert False
+    make_train(save_path='model.ckpt', save_freq=1, async_save=True)
+
+
+def check_resume(prefetch):
+    import numpy as np
+    from pylearn2.autoencoder import Autoencoder
+    from pylearn2.costs.autoencoder import MeanSquaredReconstructionError
+    from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+    from pylearn2.training_algorithms.sgd import (SGD, EpochCounter,
+                                                  AnnealedLearningRate)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        X = np.random.RandomState([1, 2, 3]).randn(100, 5)
+        dataset = DenseDesignMatrix(X=X.astype('float32'))
+        model = Autoencoder(5, 3, 'sigmoid', None, irange=0.1)
+        algorithm = SGD(0.1, MeanSquaredReconstructionError(),
+                        batch_size=10, batches_per_iter=5,
+                        monitoring_dataset=dataset, monitoring_batches=3,
+                        termination_criterion=EpochCounter(6),
+                        update_callbacks=AnnealedLearningRate(3),
+                        prefetch=prefetch)
+        resume_path = os.path.join(tmp_dir, 'resume.pkl')
+        train = Train(dataset, model, algorithm,
+                      save_path=os.path.join(tmp_dir, 'model.pkl'),
+                      save_freq=1, keep_checkpoints=10,
+                      resume_path=resume_path)
+        train.main_loop()
+
+        #a save made halfway through the uninterrupted run
+        paths = [os.path.join(tmp_dir, name)
+                 for name in os.listdir(tmp_dir)
+                 if name.startswith('resume.pkl')]
+        resumed = [t for t in (serial.load(path) for path in paths)
+                   if t.epochs == 3]
+        assert len(resumed) == 1
+        resumed = resumed[0]
+        resumed.main_loop()
+
+        assert resumed.epochs == train.epochs
+        for a, b in zip(model.get_params(), resumed.model.get_params()):
+            assert np.array_equal(a.get_value(), b.get_value())
+        channels = model.monitor.channels
+        resumed_channels = resumed.model.monitor.channels
+        assert sorted(channels) == sorted(resumed_channels)
+        for name in channels:
+            for record in ['val_record', 'batch_record', 'example_record',
+                           'epoch_record']:
+                assert (getattr(channels[name], record) ==
+                        getattr(resumed_channels[name], record))
+        assert algorithm.learning_rate == resumed.algorithm.learning_rate
+        assert (algorithm.update_callbacks[0]._count ==
+                resumed.algorithm.update_callbacks[0]._count)
+        position = train._get_dataset_stream_position()
+        resumed_position = resumed._get_dataset_stream_position()
+        for a, b in zip(position.get_state(), resumed_position.get_state()):
+            assert np.all(a == b)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_resume():
+    #tests that a run resumed from a save made halfway through ends in the
+    #same state as the run that was not interrupted
+    for prefetch in [0, 2]:
+        yield check_resume, prefetch
@@ -1,16 +1,26 @@
+import datetime
 from pylearn2.monitor import Monitor
+from pylearn2.datasets.prefetch import get_prefetcher
+from pylearn2.training_algorithms.training_algorithm import TrainingAlgorithm
 import theano.tensor as T
 
-class DefaultTrainingAlgorithm(object):
-    def __init__(self, batch_size = None , batches_per_iter = 1000 , monitoring_batches = - 1, monitoring_dataset = None):
+class DefaultTrainingAlgorithm(TrainingAlgorithm):
+    def __init__(self, batch_size = None , batches_per_iter = 1000 , monitoring_batches = - 1, monitoring_dataset = None,
+            prefetch = 0):
         """
         if batch_size is None, reverts to the force_batch_size field of the model
+
+        if prefetch > 0, the batches the model asks for in learn are assembled
+        this many batches ahead on a background thread
+        (see pylearn2.datasets.prefetch.PrefetchingDataset)
         """
 
         self.batch_size, self.batches_per_iter = batch_size, batches_per_iter
         if monitoring_dataset is None:
             assert monitoring_batches == -1
         self.monitoring_dataset, self.monitoring_batches = monitoring_dataset, monitoring_batches
+        self.prefetch = prefetch
+        self._prefetcher = None
 
         self.bSetup = False
 
@@ -29,6 +39,7 @@ class DefaultTrainingAlgorithm(object):
         """
         self.model = model
 
+        self._load_monitoring_dataset()
         self.monitor = Monitor.get_monitor(model)
         self.monitor.set_dataset(dataset = self.monitoring_dataset,
                                  batches = self.monitoring_batches,
@@ -76,9 +87,18 @@ class DefaultTrainingAlgorithm(object):
             if hasattr(model,'force_batch_size'):
                 assert model.force_batch_size <= 0 or batch_size == model.force_batch_size
 
+        if self.prefetch > 0:
+            self._prefetcher = get_prefetcher(dataset, self._prefetcher, self.prefetch)
+            dataset = self._prefetcher
+            stall_start = dataset.stall_time
+
         for i in xrange(self.batches_per_iter):
             model.learn(dataset, batch_size)
             model.monitor.batches_seen += 1
             model.monitor.examples_seen += batch_size
 
+        if self.prefetch > 0:
+            stalled = dataset.stall_time - stall_start
+            print 'Time spent waiting for data this epoch:',str(datetime.timedelta(seconds = stalled))
+
         return True
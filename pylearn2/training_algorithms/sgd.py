@@ -1,10 +1,12 @@
 from __future__ import division
+import bisect
 import datetime
 import numpy as np
 from theano import function, config
 import theano.tensor as T
 from warnings import warn
 from pylearn2.monitor import Monitor
+from pylearn2.datasets.prefetch import get_prefetcher
 from pylearn2.utils.iteration import SequentialSubsetIterator
 from pylearn2.training_algorithms.training_algorithm import TrainingAlgorithm
 
@@ -25,7 +27,8 @@ class SGD(TrainingAlgorithm):
     def __init__(self, learning_rate, cost, batch_size=None,
                  batches_per_iter=1000, monitoring_batches=-1,
                  monitoring_dataset=None, termination_criterion=None,
-                 update_callbacks=None):
+                 update_callbacks=None, prefetch=0, monitoring_frequency=1,
+                 monitoring_time_budget=None, monitor_in_background=False):
         """
         Instantiates an SGD object.
 
@@ -50,6 +53,22 @@ class SGD(TrainingAlgorithm):
             WRITEME
         update_callback : iterable or object, optional
             WRITEME
+        prefetch : int, optional
+            If positive, minibatches are assembled on a background
+            thread, this many batches ahead of the update being run
+            (see `pylearn2.datasets.prefetch.PrefetchingDataset`).
+            The time spent waiting for data is reported after each
+            epoch. Default is 0, i.e. batches are drawn synchronously.
+        monitoring_frequency : int, optional
+            Evaluate the monitoring channels every this many epochs.
+        monitoring_time_budget : float, optional
+            If not None, each evaluation of the monitoring channels stops
+            drawing batches after this many seconds.
+        monitor_in_background : bool, optional
+            If True, the monitoring channels are evaluated on a background
+            thread with a copy of the parameters, while training goes on.
+            Their records then lag one call behind (see
+            `pylearn2.monitor.Monitor`).
 
         Notes
         -----
@@ -72,6 +91,11 @@ class SGD(TrainingAlgorithm):
         self.monitoring_batches = monitoring_batches
         self.termination_criterion = termination_criterion
         self._register_update_callbacks(update_callbacks)
+        self.prefetch = prefetch
+        self._prefetcher = None
+        self.monitoring_frequency = monitoring_frequency
+        self.monitoring_time_budget = monitoring_time_budget
+        self.monitor_in_background = monitor_in_background
         self.bSetup = False
         self.first = True
 
@@ -92,10 +116,14 @@ class SGD(TrainingAlgorithm):
 
         self.model = model
 
+        self._load_monitoring_dataset()
         self.monitor = Monitor.get_monitor(model)
         self.monitor.set_dataset(dataset=self.monitoring_dataset,
                                  batches=self.monitoring_batches,
-                                 batch_size=self.batch_size)
+                                 batch_size=self.batch_size,
+                                 frequency=self.monitoring_frequency,
+                                 time_budget=self.monitoring_time_budget,
+                                 background=self.monitor_in_background)
 
 
         #Make the right kind of theano variable for the type of space
@@ -170,6 +198,11 @@ class SGD(TrainingAlgorithm):
                 raise Exception("NaN in " + param.name)
 
         self.first = False
+        if self.prefetch > 0:
+            self._prefetcher = get_prefetcher(dataset, self._prefetcher,
+                                              self.prefetch)
+            dataset = self._prefetcher
+            stall_start = dataset.stall_time
         for i in xrange(self.batches_per_iter):
             if self.topo:
                 X = dataset.get_batch_topo(batch_size)
@@ -191,6 +224,11 @@ class SGD(TrainingAlgorithm):
             self.monitor.batches_seen += 1
             self.monitor.examples_seen += batch_size
 
+        if self.prefetch > 0:
+            stalled = dataset.stall_time - stall_start
+            print 'Time spent waiting for data this epoch:', str(
+                datetime.timedelta(seconds=stalled))
+
         for callback in self.update_callbacks:
             try:
                 callback(self)
@@ -218,6 +256,7 @@ class UnsupervisedExhaustiveSGD(TrainingAlgorithm):
 
     def setup(self, model, dataset):
         self.model = model
+        self._load_monitoring_dataset()
         self.monitor = Monitor.get_monitor(model)
         # TODO: monitoring batch size ought to be configurable
         # separately from training batch size, e.g. if you would rather
@@ -351,6 +390,14 @@ class MonitorBasedLRAdjuster(object):
                              "(currently)")
         v = v[0].val_record
 
+        # A monitor that evaluates its channels only every few epochs, or
+        # in the background (in which case the records of an evaluation
+        # are only added at the next call), doesn't add a record after
+        # every epoch. The learning rate is only adjusted when there is a
+        # new record.
+        deferred = (getattr(monitor, 'frequency', 1) > 1 or
+                    getattr(monitor, 'background', False))
+
         if len(v) < 2:
 
             if monitor.dataset is None:
@@ -359,6 +406,10 @@ class MonitorBasedLRAdjuster(object):
                         adjustor but the monitor has no entries because you didn't
                         specify a monitoring dataset""")
 
+            if deferred:
+                self._num_records = len(v)
+                return
+
             raise ValueError("""For some reason there are fewer than 2 monitor entries,
                     yet the MonitorBasedLRAdjuster has been called. This should NEVER happen.
                     The training algorithm should call the monitor once on initialization, then
@@ -367,6 +418,10 @@ class MonitorBasedLRAdjuster(object):
                     a training algorithm, or you are using an incorrectly implemented training
                     algorithm.""")
 
+        if len(v) == getattr(self, '_num_records', None):
+            return
+        self._num_records = len(v)
+
         rval = current_learning_rate
 
         if v[-1] > self.high_trigger * v[-2]:
@@ -389,6 +444,10 @@ class MonitorBasedTermCrit(object):
     the model's monitor (this won't work for multiple-channel
     monitors, TODO fix this issue) and checks to see if it has
     decreased by a certain proportion in the last N epochs.
+
+    The last value is compared with the one recorded N - 1 epochs
+    earlier. If the monitor doesn't evaluate the channel at every epoch,
+    the last value recorded at or before that epoch is used instead.
     """
     def __init__(self, prop_decrease, N):
         self.prop_decrease = prop_decrease
@@ -399,10 +458,16 @@ class MonitorBasedTermCrit(object):
         assert len(monitor.channels.values()) == 1, (
             "Only single channel monitors are supported (currently)"
         )
-        v = monitor.channels.values()[0].val_record
-        if len(v) < self.N:
+        channel = monitor.channels.values()[0]
+        v = channel.val_record
+        if len(v) == 0:
+            return True
+        epochs = channel.epoch_record
+        # The last record made at least N - 1 epochs before the last one
+        i = bisect.bisect_right(epochs, epochs[-1] - (self.N - 1)) - 1
+        if i < 0:
             return True
-        return v[- 1] < (1. - self.prop_decrease) * v[-self.N]
+        return v[-1] < (1. - self.prop_decrease) * v[i]
 
 
 class EpochCounter(object):
@@ -1,8 +1,53 @@
+from theano.compile.function_module import Function
+
+from pylearn2.config import yaml_parse
+
+
 class TrainingAlgorithm(object):
     """
     An abstract superclass that defines the interface of training
     algorithms.
     """
+    def get_dataset_stream_position(self, dataset):
+        """
+        Returns the position of `dataset`'s random stream just after the
+        last batch this algorithm trained on. This differs from
+        `dataset.get_stream_position()` if batches are prefetched.
+        """
+        prefetcher = getattr(self, '_prefetcher', None)
+        if prefetcher is not None and prefetcher.raw is dataset:
+            return prefetcher.get_stream_position()
+        return dataset.get_stream_position()
+
+    def __getstate__(self):
+        """
+        Drops compiled theano functions and the batch prefetcher, which
+        `setup` makes again, and replaces the monitoring dataset by its
+        yaml source if it has one, so that the algorithm can be saved to
+        resume training (see the resume_path argument of
+        `pylearn2.scripts.train.Train`).
+        """
+        d = {}
+        for name, value in self.__dict__.iteritems():
+            if not isinstance(value, Function):
+                d[name] = value
+        if '_prefetcher' in d:
+            d['_prefetcher'] = None
+        if 'bSetup' in d:
+            d['bSetup'] = False
+        monitoring_dataset = d.get('monitoring_dataset')
+        if hasattr(monitoring_dataset, 'yaml_src'):
+            d['monitoring_dataset'] = monitoring_dataset.yaml_src
+        return d
+
+    def _load_monitoring_dataset(self):
+        """
+        Loads the monitoring dataset if it was replaced by its yaml source
+        when this object was pickled.
+        """
+        if isinstance(self.monitoring_dataset, basestring):
+            self.monitoring_dataset = yaml_parse.load(self.monitoring_dataset)
+
     def _register_update_callbacks(self, update_callbacks):
         if update_callbacks is None:
             update_callbacks = []
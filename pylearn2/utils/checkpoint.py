@@ -0,0 +1,240 @@
+"""
+An array-aware serialization format for large models.
+
+The object structure is pickled into a small manifest in which every
+numpy array (including the values of theano shared variables) is replaced
+by a reference to a raw blob stored, suitably aligned, later in the same
+file. Arrays are written straight from their memory, without building one
+big pickle string, and are memory-mapped on load, so loading is nearly
+instant and array data is only read from disk when it is first touched.
+
+File layout:
+
+    magic (8 bytes) | version (uint64) | table offset (uint64) |
+    manifest length (uint64) | manifest | blobs | table
+
+where the table is a pickled list giving the offset, dtype, shape and
+memory order of each blob.
+"""
+import cPickle
+import os
+import cStringIO
+import struct
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+
+MAGIC = 'PL2CKPT\0'
+VERSION = 1
+# Blobs start on multiples of this many bytes, which is enough for any
+# dtype and for SIMD loads.
+ALIGNMENT = 64
+
+_HEADER = '<8sQQQ'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
+def is_checkpoint(filepath):
+    """
+    Returns True if the file at `filepath` was written by `save`.
+    """
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _pad(f):
+    position = f.tell()
+    remainder = position % ALIGNMENT
+    if remainder:
+        f.write('\0' * (ALIGNMENT - remainder))
+    return f.tell()
+
+
+def _write_array(f, arr):
+    """
+    Writes the data of `arr` in C order, one slice along the first axis at
+    a time if it is not contiguous, so that no full copy is made.
+    """
+    if arr.ndim == 0 or arr.flags.c_contiguous:
+        np.ascontiguousarray(arr).tofile(f)
+    else:
+        for elem in arr:
+            np.ascontiguousarray(elem).tofile(f)
+
+
+def snapshot(obj, copy=True):
+    """
+    Pickles the structure of `obj`, leaving out its arrays.
+
+    Returns a (manifest, arrays) pair that `write_snapshot` turns into a
+    file. If `copy` is True, the arrays are copies, so `obj` may be
+    modified as soon as this returns, even while the snapshot is being
+    written on another thread.
+    """
+    try:
+        return _snapshot(obj, copy)
+    except RuntimeError, e:
+        # As in serial.save: pickling large theano graphs can exceed the
+        # maximum recursion depth.
+        if str(e).find('recursion') == -1:
+            raise
+        warnings.warn('pylearn2.utils.checkpoint.snapshot encountered the '
+                      'following error: ' + str(e) +
+                      '\nAttempting to resolve this error by calling '
+                      'sys.setrecursionlimit and retrying')
+        old_limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(50000)
+            return _snapshot(obj, copy)
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+
+def _snapshot(obj, copy):
+    arrays = []
+    # Indexed by id; the arrays themselves are kept alive in `arrays` so
+    # that the ids stay unique while pickling.
+    indices = {}
+
+    def persistent_id(x):
+        if type(x) is not np.ndarray and not isinstance(x, np.memmap):
+            return None
+        if x.dtype.hasobject:
+            return None
+        key = id(x)
+        if key not in indices:
+            indices[key] = len(arrays)
+            arrays.append(x)
+        return str(indices[key])
+
+    manifest = cStringIO.StringIO()
+    pickler = cPickle.Pickler(manifest, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+
+    if copy:
+        arrays = [np.array(arr, order='A') for arr in arrays]
+    return manifest.getvalue(), arrays
+
+
+def write_snapshot(filepath, snap):
+    """
+    Writes a snapshot made by `snapshot` to `filepath`.
+
+    The file is written under a temporary name and then renamed, so an
+    existing file at `filepath` is replaced atomically, and arrays that
+    are still memory-mapped from it keep their contents.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(
+        filepath)), prefix=os.path.basename(filepath) + '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            _write(f, snap)
+        # mkstemp creates files only readable by their owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0666 & ~umask)
+        os.rename(tmp_path, filepath)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def save(filepath, obj):
+    """
+    Serializes `obj` to `filepath`, storing each numpy array it refers to
+    as a separate raw blob.
+
+    Arrays referred to several times are stored once and are still shared
+    after loading. Arrays of dtype object are pickled as usual. The file
+    is replaced atomically, as by `write_snapshot`.
+    """
+    write_snapshot(filepath, snapshot(obj, copy=False))
+
+
+def _write(f, snap):
+    manifest, arrays = snap
+    f.write(struct.pack(_HEADER, MAGIC, VERSION, 0, len(manifest)))
+    f.write(manifest)
+
+    table = []
+    for arr in arrays:
+        offset = _pad(f)
+        fortran_order = (arr.ndim > 1 and arr.flags.f_contiguous and
+                         not arr.flags.c_contiguous)
+        if fortran_order:
+            _write_array(f, arr.T)
+        else:
+            _write_array(f, arr)
+        table.append((offset, arr.dtype, arr.shape, fortran_order))
+
+    table_offset = _pad(f)
+    cPickle.dump(table, f, cPickle.HIGHEST_PROTOCOL)
+
+    f.seek(0)
+    f.write(struct.pack(_HEADER, MAGIC, VERSION, table_offset,
+                        len(manifest)))
+
+
+def load(filepath, mmap_mode='c'):
+    """
+    Loads an object written by `save`.
+
+    Parameters
+    ----------
+    filepath : str
+        The file to read.
+    mmap_mode : str or None, optional
+        Mode with which the arrays are memory-mapped, as for
+        `numpy.memmap`. The default, 'c' (copy-on-write), pages arrays in
+        lazily and lets them be modified in memory without changing the
+        file. If None, the arrays are read into memory.
+    """
+    with open(filepath, 'rb') as f, open(filepath, 'rb') as data:
+        magic, version, table_offset, manifest_length = struct.unpack(
+            _HEADER, f.read(_HEADER_SIZE))
+        if magic != MAGIC:
+            raise ValueError(filepath + ' is not a pylearn2 checkpoint')
+        if version > VERSION:
+            raise ValueError(filepath + ' was written by a more recent '
+                             'version of pylearn2 (format version ' +
+                             str(version) + ')')
+
+        f.seek(table_offset)
+        table = cPickle.load(f)
+        loaded = {}
+        # The whole file is mapped once, and each array is a view of it
+        mapped = []
+
+        def persistent_load(pid):
+            index = int(pid)
+            if index in loaded:
+                return loaded[index]
+            offset, dtype, shape, fortran_order = table[index]
+            order = 'F' if fortran_order else 'C'
+            count = int(np.prod(shape))
+            if mmap_mode is None or count == 0 or len(shape) == 0:
+                # The manifest is being read from f, so blobs are read
+                # through a second file object.
+                data.seek(offset)
+                arr = np.fromfile(data, dtype=dtype, count=count)
+                arr = arr.reshape(shape, order=order)
+            else:
+                if not mapped:
+                    mapped.append(np.memmap(filepath, dtype='uint8',
+                                            mode=mmap_mode))
+                # A plain ndarray view keeps the map alive through its
+                # base but doesn't behave differently from the arrays
+                # that were saved.
+                blob = mapped[0][offset:offset + count * dtype.itemsize]
+                arr = blob.view(np.ndarray).view(dtype)
+                arr = arr.reshape(shape, order=order)
+            loaded[index] = arr
+            return arr
+
+        f.seek(_HEADER_SIZE)
+        unpickler = cPickle.Unpickler(f)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
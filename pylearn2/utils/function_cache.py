@@ -0,0 +1,375 @@
+"""
+A persistent on-disk cache of compiled theano functions.
+
+Compiling a theano function is mostly spent optimizing its graph (theano
+already caches the C code it generates). This module stores the optimized
+graph of every function it compiles in a directory, keyed by a canonical
+signature of the graph and of the theano configuration, so that compiling
+the same graph again -- after reloading a checkpoint, in another worker of
+a hyperparameter sweep or when calling `perform` on a freshly unpickled
+model -- only costs unpickling and linking.
+
+The cache is enabled by setting the PYLEARN2_FUNCTION_CACHE environment
+variable to a directory, or by calling `set_cache_dir`. `function` is a
+drop-in replacement for `theano.function` that compiles as usual when the
+cache is disabled or the call can't be cached (e.g. inputs given as `In`
+instances, or profiling).
+
+The values of shared variables are not stored. The cached graph refers to
+them by their position in the canonical order of the graph, and they are
+bound to the shared variables of the graph being compiled when an entry
+is loaded, so the function reads and updates the caller's variables.
+
+The cache directory can be deleted at any time.
+"""
+import cPickle
+import cStringIO
+import hashlib
+import os
+import tempfile
+import time
+import types
+import warnings
+
+import numpy as np
+import theano
+from theano import configparser, gof
+from theano.compile.mode import get_mode
+from theano.compile.pfunc import rebuild_collect_shared
+from theano.compile.sharedvalue import SharedVariable
+
+# Changing this invalidates the entries written by earlier versions.
+VERSION = 1
+
+# Keyword arguments of theano.function that can be cached. They are part
+# of the key.
+_CACHEABLE_KWARGS = ('no_default_updates', 'accept_inplace',
+                     'rebuild_strict', 'allow_input_downcast',
+                     'on_unused_input')
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+class FunctionCache(object):
+    """
+    A directory of compiled theano functions.
+
+    The `hits`, `misses` and `time_saved` (in seconds: the time the cached
+    functions took to compile minus the time it took to load them)
+    counters are updated by `function`.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    def function(self, inputs, outputs=None, **kwargs):
+        """
+        Like `theano.function`, but loads the function from the cache if
+        the same graph was compiled before.
+        """
+        try:
+            key, shared = _signature(inputs, outputs, kwargs)
+        except _Uncacheable:
+            return theano.function(inputs, outputs, **kwargs)
+        path = os.path.join(self.cache_dir, key + '.pkl')
+
+        t1 = time.time()
+        if os.path.exists(path):
+            try:
+                fn, compile_time = _load(path, shared, kwargs.get('name'))
+            except Exception, e:
+                warnings.warn("Could not load the cached function %s, "
+                              "compiling it again: %s" % (path, e))
+            else:
+                self.hits += 1
+                self.time_saved += compile_time - (time.time() - t1)
+                return fn
+
+        self.misses += 1
+        fn = theano.function(inputs, outputs, **kwargs)
+        compile_time = time.time() - t1
+        try:
+            _store(path, fn.maker, shared, compile_time)
+        except _Uncacheable:
+            pass
+        return fn
+
+    def __str__(self):
+        return ('%d hits, %d misses, %.2fs saved (%s)' %
+                (self.hits, self.misses, self.time_saved, self.cache_dir))
+
+
+_cache = None
+if os.environ.get('PYLEARN2_FUNCTION_CACHE'):
+    _cache = FunctionCache(os.environ['PYLEARN2_FUNCTION_CACHE'])
+
+
+def set_cache_dir(cache_dir):
+    """
+    Makes `function` use the cache in `cache_dir`, or disables the cache if
+    `cache_dir` is None. Returns the new `FunctionCache` (or None).
+    """
+    global _cache
+    if cache_dir is None:
+        _cache = None
+    else:
+        _cache = FunctionCache(cache_dir)
+    return _cache
+
+
+def get_cache():
+    """
+    Returns the `FunctionCache` used by `function`, or None if the cache
+    is disabled.
+    """
+    return _cache
+
+
+def function(inputs, outputs=None, **kwargs):
+    """
+    Compiles a theano function, through the cache if it is enabled. Takes
+    the same arguments as `theano.function`.
+    """
+    if _cache is None:
+        return theano.function(inputs, outputs, **kwargs)
+    return _cache.function(inputs, outputs, **kwargs)
+
+
+def _signature(inputs, outputs, kwargs):
+    """
+    Returns the cache key of a call to theano.function and the list of
+    the shared variables of its graph in canonical order.
+
+    Raises _Uncacheable if the call can't be cached.
+    """
+    if theano.config.profile or kwargs.get('profile'):
+        raise _Uncacheable()
+    for name in kwargs:
+        if name not in _CACHEABLE_KWARGS + ('updates', 'givens', 'mode',
+                                            'name'):
+            raise _Uncacheable()
+    if outputs is None:
+        output_list = []
+    elif isinstance(outputs, (list, tuple)):
+        output_list = list(outputs)
+    else:
+        output_list = [outputs]
+    for var in list(inputs) + output_list:
+        if not isinstance(var, gof.Variable):
+            raise _Uncacheable()
+
+    # This applies the givens and collects the default updates the same
+    # way theano.function does.
+    inputs, output_list, (_, update_d, _, _) = rebuild_collect_shared(
+            output_list, list(inputs), replace=kwargs.get('givens'),
+            updates=kwargs.get('updates') or [],
+            rebuild_strict=kwargs.get('rebuild_strict', True),
+            copy_inputs_over=True,
+            no_default_updates=kwargs.get('no_default_updates', False))
+
+    # The updates are a dictionary, whose order changes from one process
+    # to the next, so they are sorted by a first signature in which all
+    # the shared variables look alike. The shared variables are then
+    # numbered in the order in which a traversal of the graph meets them,
+    # which only depends on its structure.
+    sig = _graph_signature(inputs, output_list + update_d.keys() +
+                           update_d.values(), lambda var: None)
+    updates = sorted(update_d.items(),
+                     key=lambda (var, update): (sig(var), sig(update)))
+    shared = []
+    index = {}
+
+    def shared_index(var):
+        if var not in index:
+            index[var] = len(shared)
+            shared.append(var)
+        return index[var]
+
+    roots = output_list + [var for pair in updates for var in pair]
+    sig = _graph_signature(inputs, roots, shared_index)
+    mode = get_mode(kwargs.get('mode'))
+    key = _digest(
+        VERSION, theano.__version__, np.__version__, _config_signature(),
+        _describe(mode.provided_linker), str(mode.provided_optimizer),
+        _describe([(name, kwargs.get(name)) for name in _CACHEABLE_KWARGS]),
+        type(outputs).__name__,
+        [sig(var) for var in inputs],
+        [sig(var) for var in output_list],
+        [(sig(var), sig(update)) for var, update in updates])
+    return key, shared
+
+
+def _graph_signature(inputs, roots, shared_index):
+    """
+    Returns a function mapping the variables of the graph between
+    `inputs` and `roots` to a digest of their structure. Shared variables
+    are identified by `shared_index(var)`.
+    """
+    sigs = {}
+    for i, var in enumerate(inputs):
+        sigs[var] = _digest('input', i, _describe(var.type))
+
+    def sig(var):
+        if var not in sigs:
+            if isinstance(var, SharedVariable):
+                sigs[var] = _digest('shared', shared_index(var),
+                                    _describe(var.type))
+            elif isinstance(var, gof.Constant):
+                sigs[var] = _digest('constant', _describe(var.type),
+                                    _describe(var.data))
+            else:
+                # theano.function will complain about the missing input
+                raise _Uncacheable()
+        return sigs[var]
+
+    for node in gof.graph.io_toposort(inputs, roots):
+        node_sig = _digest(_describe(node.op),
+                           [sig(var) for var in node.inputs])
+        for i, var in enumerate(node.outputs):
+            if var not in sigs:
+                sigs[var] = _digest(node_sig, i)
+    for var in roots:
+        sig(var)
+    return sig
+
+
+def _config_signature():
+    """
+    A digest of the values of all the theano flags.
+    """
+    params = sorted(configparser._config_var_list,
+                    key=lambda param: param.fullname)
+    return _digest(*['%s = %s' % (param.fullname, param.__get__(True, None))
+                     for param in params])
+
+
+def _describe(value, enclosing=()):
+    """
+    Returns a string that identifies `value`, and is the same in another
+    process for an equal value.
+
+    `enclosing` holds the ids of the objects being described that contain
+    `value`, to detect cycles.
+    """
+    if isinstance(value, (type(None), bool, int, long, float, basestring)):
+        return repr(value)
+    if isinstance(value, np.generic):
+        return '%s(%r)' % (value.dtype.str, value.item())
+    if isinstance(value, np.dtype):
+        return 'dtype(%s)' % value.str
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return 'ndarray(%s, %s, %s)' % (
+                value.dtype.str, value.shape,
+                hashlib.sha1(np.ascontiguousarray(value).data).hexdigest())
+    if isinstance(value, (type, types.FunctionType,
+                          types.BuiltinFunctionType)):
+        return '%s.%s' % (value.__module__, value.__name__)
+
+    if id(value) in enclosing:
+        raise _Uncacheable()
+    enclosing = enclosing + (id(value),)
+    if isinstance(value, (list, tuple)):
+        return '(%s)' % ', '.join(_describe(elem, enclosing)
+                                  for elem in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ', '.join(sorted(_describe(elem, enclosing)
+                                         for elem in value))
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted(
+                '%s: %s' % (_describe(k, enclosing), _describe(v, enclosing))
+                for k, v in value.iteritems()))
+    cls = value.__class__
+    if isinstance(value, gof.Op) and hasattr(value, '__props__'):
+        # Ops with __props__ are equal iff their props are
+        state = tuple(getattr(value, prop) for prop in value.__props__)
+    elif hasattr(value, '__dict__'):
+        # Pickling would be simpler, but the pickle of an object can
+        # change with the order in which its attributes were set
+        state = value.__dict__
+    else:
+        try:
+            return '%s.%s<%s>' % (cls.__module__, cls.__name__,
+                                  hashlib.sha1(cPickle.dumps(
+                                      value, cPickle.HIGHEST_PROTOCOL))
+                                  .hexdigest())
+        except Exception:
+            raise _Uncacheable()
+    return '%s.%s%s' % (cls.__module__, cls.__name__,
+                        _describe(state, enclosing))
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def _store(path, maker, shared, compile_time):
+    """
+    Writes the FunctionMaker of a compiled function to `path`, with
+    references to the containers of the variables in `shared` in place of
+    their values.
+    """
+    indices = dict((id(var.container), i) for i, var in enumerate(shared))
+
+    def persistent_id(obj):
+        if isinstance(obj, gof.Container):
+            if id(obj) not in indices:
+                raise _Uncacheable()
+            return indices[id(obj)]
+        return None
+
+    buf = cStringIO.StringIO()
+    pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    try:
+        pickler.dump((len(shared), compile_time, maker))
+    except _Uncacheable:
+        raise
+    except Exception:
+        # Not all ops can be pickled
+        raise _Uncacheable()
+
+    # Another process may be writing the same entry, so it is written
+    # under a temporary name and renamed.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buf.getvalue())
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def _load(path, shared, name):
+    """
+    Reads a FunctionMaker written by `_store`, binding it to the
+    containers of the variables in `shared`, and returns the function it
+    makes and the time it took to compile originally.
+    """
+    with open(path, 'rb') as f:
+        unpickler = cPickle.Unpickler(f)
+        unpickler.persistent_load = lambda i: shared[i].container
+        num_shared, compile_time, maker = unpickler.load()
+    if num_shared != len(shared):
+        raise ValueError("expected %d shared variables, found %d" %
+                         (len(shared), num_shared))
+    if maker is None:
+        raise ValueError("theano.config.unpickle_function is False")
+    maker.name = name
+    with theano.change_flags(compute_test_value='off'):
+        fn = maker.create([getattr(i, 'value', None) for i in maker.inputs])
+    return fn, compile_time
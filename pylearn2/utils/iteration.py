@@ -27,6 +27,11 @@ class SubsetIterator(object):
     # Does this class make use of random number generators?
     stochastic = False
 
+    # Are the subsets drawn from within contiguous chunks of the dataset?
+    # If so, the iterator has a `chunk` attribute, a slice giving the
+    # chunk the last subset was drawn from.
+    chunked = False
+
 
 class SequentialSubsetIterator(SubsetIterator):
     def __init__(self, dataset_size, batch_size, num_batches, rng=None):
@@ -123,10 +128,86 @@ class RandomSliceSubsetIterator(RandomUniformSubsetIterator):
     stochastic = True
 
 
+class ShuffledChunkSubsetIterator(SubsetIterator):
+    """
+    Visits the dataset one contiguous chunk of examples at a time, with the
+    chunks in a random order, and returns batches drawn without replacement
+    from within the current chunk, in a random order.
+
+    This is meant for datasets that live on disk (memory-mapped .npy files,
+    HDF5 files): FiniteDatasetIterator reads each chunk into memory with a
+    single sequential read and assembles the batches from that copy, so
+    disk access is near-sequential while the two levels of shuffling keep
+    the batches well mixed.
+
+    If `num_batches` is None, iteration stops after one pass over the
+    dataset; otherwise it stops after `num_batches` batches, starting new
+    passes (with a new chunk order) as needed. The last batch of a chunk
+    is smaller than `batch_size` when the chunk size is not a multiple of
+    it, which only happens for the chunk at the end of the dataset.
+    """
+    # Default number of batches per chunk.
+    batches_per_chunk = 64
+
+    def __init__(self, dataset_size, batch_size, num_batches, rng=None,
+                 chunk_size=None):
+        if rng is not None and hasattr(rng, 'random_integers'):
+            self._rng = rng
+        else:
+            self._rng = numpy.random.RandomState(rng)
+        if batch_size is None:
+            raise ValueError("batch_size cannot be None for shuffled chunk "
+                             "iteration")
+        if chunk_size is None:
+            chunk_size = batch_size * self.batches_per_chunk
+        # Round up to a whole number of batches.
+        chunk_size = int(numpy.ceil(chunk_size / batch_size)) * batch_size
+        self.dataset_size = dataset_size
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.chunk_size = chunk_size
+        self._next_batch_no = 0
+        self._chunk_starts = []
+        self._chunk_order = None
+        self.chunk = None
+
+    def _next_chunk(self):
+        if len(self._chunk_starts) == 0:
+            if self._next_batch_no > 0 and self.num_batches is None:
+                raise StopIteration()
+            starts = numpy.arange(0, self.dataset_size, self.chunk_size)
+            self._rng.shuffle(starts)
+            self._chunk_starts = list(starts[::-1])
+        start = self._chunk_starts.pop()
+        self.chunk = slice(start, min(start + self.chunk_size,
+                                      self.dataset_size))
+        self._chunk_order = self._rng.permutation(
+            numpy.arange(self.chunk.start, self.chunk.stop))
+        self._chunk_pos = 0
+
+    def next(self):
+        if (self.num_batches is not None and
+                self._next_batch_no >= self.num_batches):
+            raise StopIteration()
+        if (self._chunk_order is None or
+                self._chunk_pos >= len(self._chunk_order)):
+            self._next_chunk()
+        stop = self._chunk_pos + self.batch_size
+        self._last = self._chunk_order[self._chunk_pos:stop]
+        self._chunk_pos = stop
+        self._next_batch_no += 1
+        return self._last
+
+    fancy = True
+    stochastic = True
+    chunked = True
+
+
 _iteration_schemes = {
     'sequential': SequentialSubsetIterator,
     'random_slice': RandomSliceSubsetIterator,
     'random_uniform': RandomUniformSubsetIterator,
+    'shuffled_chunks': ShuffledChunkSubsetIterator,
 }
 
 
@@ -141,33 +222,130 @@ def resolve_iterator_class(mode):
 
 
 class FiniteDatasetIterator(object):
-    """A thin wrapper around one of the mode iterators."""
-    def __init__(self, dataset, subset_iterator, topo=False, targets=False):
+    """
+    A thin wrapper around one of the mode iterators.
+
+    By default every batch is a freshly allocated array. If `num_buffers`
+    is 1 or 2, the iterator instead owns that many sets of batch buffers
+    and cycles through them: examples are gathered into a buffer with
+    `numpy.take(..., out=...)` (or a slice assignment) and cast to floatX
+    in place, so that steady-state iteration allocates no new arrays.
+
+    The contract in that mode is that a batch returned by `next()` is only
+    valid until `num_buffers` further calls to `next()`: with one buffer
+    the batch is overwritten by the next one, with two the caller may hold
+    on to the previous batch while it gets the next (e.g. to transfer it
+    while the next one is being assembled). Callers that need to keep a
+    batch longer must copy it. Topological batches are converted from the
+    buffer into a new array, and data that is not an ndarray (e.g. an
+    HDF5 dataset) is read into a new array before being copied into the
+    buffer.
+    """
+    def __init__(self, dataset, subset_iterator, topo=False, targets=False,
+                 num_buffers=0):
+        if num_buffers not in [0, 1, 2]:
+            raise ValueError("num_buffers must be 0, 1 or 2, got " +
+                             str(num_buffers))
         self._topo = topo
         self._targets = targets
         self._dataset = dataset
         self._subset_iterator = subset_iterator
+        self._num_buffers = num_buffers
+        self._buffers = {}
+        self._slot = 0
         # TODO: More thought about how to handle things where this
         # fails (gigantic HDF5 files, etc.)
-        if self._topo:
-            self._raw_data = self._dataset.get_topological_view()
-        else:
-            self._raw_data = self._dataset.get_design_matrix()
+        # Batches are always read from the design matrix and converted
+        # to a topological view one at a time, so that a memory-mapped
+        # design matrix is never converted (i.e. read) as a whole.
+        self._raw_data = self._dataset.get_design_matrix()
         if self._targets:
             self._raw_targets = self._dataset.get_targets()
             if self._raw_targets is None:
                 raise ValueError("Can't iterate with targets=True on a "
                                  "dataset object with no targets")
+        # In-memory copy of the current chunk, for chunked iterators.
+        self._chunk = None
 
     def __iter__(self):
         return self
 
+    def _buffer(self, name, shape, dtype):
+        """
+        Returns a buffer of the given shape and dtype, reusing the one
+        previously allocated under `name` if it is big enough.
+        """
+        buf = self._buffers.get(name)
+        if (buf is None or buf.shape[0] < shape[0] or
+                buf.shape[1:] != shape[1:] or buf.dtype != dtype):
+            buf = numpy.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:shape[0]]
+
+    def _gather(self, name, raw, index, dtype):
+        """
+        Copies raw[index] into the buffer `name`, cast to `dtype`.
+        """
+        if isinstance(index, slice):
+            num = len(xrange(*index.indices(raw.shape[0])))
+        else:
+            num = len(index)
+        out = self._buffer(name, (num,) + raw.shape[1:], dtype)
+        if isinstance(index, slice) or not isinstance(raw, numpy.ndarray):
+            # A slice of an ndarray is a view, so this only copies once.
+            out[...] = raw[index]
+        elif raw.dtype == out.dtype:
+            # The indices come from the subset iterator, so there is no
+            # need for the (buffered) bounds checking of mode='raise'.
+            numpy.take(raw, index, axis=0, out=out, mode='clip')
+        else:
+            gathered = self._buffer(name + '_uncast', out.shape, raw.dtype)
+            numpy.take(raw, index, axis=0, out=gathered, mode='clip')
+            out[...] = gathered
+        return out
+
+    def _load_chunk(self, chunk):
+        # One contiguous read (and cast) per chunk; batches are then
+        # gathered from memory.
+        self._chunk = chunk
+        if self._num_buffers > 0:
+            self._chunk_data = self._gather('chunk', self._raw_data, chunk,
+                                            config.floatX)
+        else:
+            self._chunk_data = numpy.cast[config.floatX](
+                self._raw_data[chunk])
+        if self._targets:
+            self._chunk_targets = numpy.asarray(self._raw_targets[chunk])
+
     def next(self):
         next_index = self._subset_iterator.next()
-        # TODO: handle fancy-index copies by allocating a buffer and
-        # using numpy.take()
-        features = numpy.cast[config.floatX](self._raw_data[next_index])
+        if self._subset_iterator.chunked:
+            chunk = self._subset_iterator.chunk
+            if chunk != self._chunk:
+                self._load_chunk(chunk)
+            raw_data = self._chunk_data
+            if self._targets:
+                raw_targets = self._chunk_targets
+            next_index = next_index - chunk.start
+        else:
+            raw_data = self._raw_data
+            if self._targets:
+                raw_targets = self._raw_targets
+        if self._num_buffers > 0:
+            slot = str(self._slot)
+            self._slot = (self._slot + 1) % self._num_buffers
+            features = self._gather('features' + slot, raw_data,
+                                    next_index, config.floatX)
+            if self._targets:
+                targets = self._gather('targets' + slot, raw_targets,
+                                       next_index, raw_targets.dtype)
+        else:
+            features = numpy.cast[config.floatX](raw_data[next_index])
+            if self._targets:
+                targets = raw_targets[next_index]
+        if self._topo:
+            features = self._dataset.get_topological_view(features)
         if self._targets:
-            return features, self._raw_targets[next_index]
+            return features, targets
         else:
             return features
@@ -0,0 +1,49 @@
+"""
+Deferred compilation of the theano functions of models.
+
+A model that is loaded only to look at its weights, extract features or
+score data needn't compile its learning machinery. Methods that build
+compiled functions can be decorated with `lazy_function`, so that each
+function is compiled the first time it is used.
+"""
+
+
+class lazy_function(object):
+    """
+    Decorator turning a method that returns a compiled theano function into
+    an attribute that calls the method the first time it is read.
+
+    The function is then stored in the instance's __dict__ under the name
+    of the method, so later reads are plain attribute lookups. That name,
+    and those of any other attributes the method sets, are registered with
+    the object's `register_names_to_del` method, if it has one, so that
+    they are not pickled and the function is compiled again when it is
+    first used after unpickling.
+    """
+    def __init__(self, make):
+        self.make = make
+        self.__name__ = make.__name__
+        self.__doc__ = make.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        init_names = set(obj.__dict__)
+        fn = self.make(obj)
+        obj.__dict__[self.__name__] = fn
+        if hasattr(obj, 'register_names_to_del'):
+            obj.register_names_to_del([name for name in obj.__dict__
+                                       if name not in init_names])
+        return fn
+
+
+def reset_lazy_functions(obj):
+    """
+    Discards the functions `obj` compiled through `lazy_function`, so that
+    they are compiled again, from the current state of `obj`, the next time
+    they are used.
+    """
+    for cls in type(obj).__mro__:
+        for name, value in cls.__dict__.iteritems():
+            if isinstance(value, lazy_function):
+                obj.__dict__.pop(name, None)
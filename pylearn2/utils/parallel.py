@@ -0,0 +1,224 @@
+"""
+Helpers for spreading independent per-example computations over a pool
+of worker processes.
+
+The workers are forked from the parent process, so they inherit the
+objects that exist when the pool is created without having to pickle
+them. Arrays that change between calls (model parameters, minibatches,
+results) are exchanged through anonymous shared memory rather than
+through the pool's task queue.
+"""
+import multiprocessing
+
+import numpy as np
+
+
+def shared_ndarray(shape, dtype):
+    """
+    Returns an ndarray of the given shape and dtype backed by anonymous
+    shared memory, so that writes made by forked worker processes are seen
+    by the parent (and vice versa).
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    raw = multiprocessing.RawArray('b', max(size, 1))
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))
+                         ).reshape(shape)
+
+
+# The callable a worker process of a pool made by `fork_pool` serves. Set
+# by the pool initializer in each worker.
+_worker_target = None
+
+
+def _init_worker(target):
+    global _worker_target
+    _worker_target = target
+
+
+def _run_task(task):
+    return _worker_target(task)
+
+
+def fork_pool(target, num_workers):
+    """
+    Forks a pool of worker processes that each serve the callable `target`.
+
+    The workers inherit `target` when they are forked, so it does not need
+    to be picklable (it may be a bound method, or an object holding
+    compiled theano functions), and it is not sent again with every task.
+    Only the tasks and the results are pickled.
+
+    Parameters
+    ----------
+    target : callable
+        Called as `target(task)` in a worker for each task.
+    num_workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    pool : multiprocessing.Pool
+        The pool. The caller must close and join it.
+    run_task : function
+        The function to pass to the pool's `map`, `imap`, etc. along with
+        the tasks: `pool.map(run_task, tasks)` returns
+        `[target(task) for task in tasks]`.
+    """
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(target,))
+    return pool, _run_task
+
+
+class RowParallelInference(object):
+    """
+    Runs a model's row-wise inference method on a minibatch by splitting
+    the rows across a pool of worker processes.
+
+    The inference method is called as `method(X, out, *args)` on a block
+    of rows `X` and must write its result for each row to the matching row
+    of `out`. Its return value (which should be small) is collected and
+    returned to the caller, one entry per block.
+
+    The values of the theano shared variables named in `param_names` are
+    copied once per call into shared memory that all the workers read
+    from, rather than pickled for every task. The minibatch and the
+    result are exchanged through shared memory as well.
+
+    The pool is created on first use, with the model as it is at that
+    point, and reused for subsequent calls. Only the shared variables
+    listed in `param_names` and the arguments passed to `__call__` are
+    refreshed in the workers afterwards; any other state the method
+    depends on must be passed through `args`.
+
+    Workers are forked, so this only works on platforms where
+    `multiprocessing` uses fork (i.e. not on Windows).
+    """
+    def __init__(self, model, method, param_names, output_dim, num_workers,
+                 output_dtype=None):
+        """
+        Parameters
+        ----------
+        model : object
+            The model whose method is run by the workers.
+        method : str
+            Name of the model's row-wise inference method.
+        param_names : list of str
+            Names of the model's theano shared variables that the method
+            reads and that may change between calls.
+        output_dim : int
+            Number of columns of the result.
+        num_workers : int
+            Number of worker processes.
+        output_dtype : str or dtype, optional
+            dtype of the result. Defaults to the dtype of the input.
+        """
+        self.model = model
+        self.method = method
+        self.param_names = list(param_names)
+        self.output_dim = output_dim
+        self.num_workers = num_workers
+        self.output_dtype = output_dtype
+        self._pool = None
+
+    def _allocate(self, X):
+        self.close()
+        self._input = shared_ndarray(X.shape, X.dtype)
+        output_dtype = self.output_dtype
+        if output_dtype is None:
+            output_dtype = X.dtype
+        self._output = shared_ndarray((X.shape[0], self.output_dim),
+                                      output_dtype)
+        self._param_buffers = {}
+        for name in self.param_names:
+            value = getattr(self.model, name).get_value(borrow=True)
+            self._param_buffers[name] = shared_ndarray(value.shape,
+                                                       value.dtype)
+        self._pool, self._run_task = fork_pool(self._run_block,
+                                               self.num_workers)
+
+    def _run_block(self, task):
+        # Runs in a worker process
+        start, stop, args = task
+        for name in self.param_names:
+            # borrow=True lets theano read the shared memory directly; if
+            # it makes a copy instead, this refreshes it.
+            getattr(self.model, name).set_value(self._param_buffers[name],
+                                                borrow=True)
+        method = getattr(self.model, self.method)
+        return method(self._input[start:stop], self._output[start:stop],
+                      *args)
+
+    def _fits(self, X):
+        if self._pool is None:
+            return False
+        if (X.shape[0] > self._input.shape[0] or
+                X.shape[1:] != self._input.shape[1:] or
+                X.dtype != self._input.dtype):
+            return False
+        for name in self.param_names:
+            value = getattr(self.model, name).get_value(borrow=True)
+            if value.shape != self._param_buffers[name].shape:
+                return False
+        return True
+
+    def __call__(self, X, out=None, args=()):
+        """
+        Runs the inference method on all the rows of `X`.
+
+        Parameters
+        ----------
+        X : ndarray
+            The minibatch, one example per row.
+        out : ndarray, optional
+            Preallocated matrix to store the result in.
+        args : tuple, optional
+            Extra arguments passed to every call of the method.
+
+        Returns
+        -------
+        out : ndarray
+            The result, one row per row of `X`.
+        results : list
+            The return values of the method, one per block of rows.
+        """
+        if not self._fits(X):
+            self._allocate(X)
+        num_rows = X.shape[0]
+        self._input[:num_rows] = X
+        for name in self.param_names:
+            self._param_buffers[name][...] = getattr(
+                self.model, name).get_value(borrow=True)
+        num_blocks = min(self.num_workers, num_rows)
+        bounds = np.linspace(0, num_rows, num_blocks + 1).astype(int)
+        tasks = [(start, stop, args)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        results = self._pool.map(self._run_task, tasks)
+        if out is None:
+            out = np.empty((num_rows, self.output_dim),
+                           dtype=self._output.dtype)
+        out[...] = self._output[:num_rows]
+        return out, results
+
+    def close(self):
+        """
+        Shuts down the worker processes. A new pool is created the next
+        time the object is called.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        self._input = None
+        self._output = None
+        self._param_buffers = None
+
+    def __getstate__(self):
+        # The pool and the shared memory belong to this process; they are
+        # recreated on first use after unpickling.
+        rval = dict(self.__dict__)
+        rval['_pool'] = None
+        rval['_input'] = None
+        rval['_output'] = None
+        rval['_param_buffers'] = None
+        return rval
@@ -5,6 +5,7 @@ import os
 import time
 import warnings
 import sys
+from pylearn2.utils import checkpoint
 from pylearn2.utils.string_utils import preprocess
 from cPickle import BadPickleGet
 io = None
@@ -59,45 +60,50 @@ def load(filepath, recurse_depth=0):
             time.sleep(nsec)
             return load(filepath, recurse_depth + 1)
 
-    try:
-        if not joblib_available:
-            with open(filepath, 'rb') as f:
-                obj = cPickle.load(f)
-        else:
-            obj = joblib.load(filepath)
+    if checkpoint.is_checkpoint(filepath):
+        # Checkpoints are only renamed into place once they are complete,
+        # so errors reading them are not transient and are not retried
+        obj = checkpoint.load(filepath)
+    else:
+        try:
+            if not joblib_available:
+                with open(filepath, 'rb') as f:
+                    obj = cPickle.load(f)
+            else:
+                obj = joblib.load(filepath)
 
-    except BadPickleGet, e:
-        print ('Failed to open ' + str(filepath) +
-               ' due to BadPickleGet with exception string ' + str(e))
+        except BadPickleGet, e:
+            print ('Failed to open ' + str(filepath) +
+                   ' due to BadPickleGet with exception string ' + str(e))
 
-        obj =  exponential_backoff()
-    except EOFError, e:
-        print ('Failed to open ' + str(filepath) +
-               ' due to EOFError with exception string ' + str(e))
+            obj =  exponential_backoff()
+        except EOFError, e:
+            print ('Failed to open ' + str(filepath) +
+                   ' due to EOFError with exception string ' + str(e))
 
-        obj =  exponential_backoff()
-    except ValueError, e:
-        print ('Failed to open ' + str(filepath) +
-               ' due to ValueError with string ' + str(e))
+            obj =  exponential_backoff()
+        except ValueError, e:
+            print ('Failed to open ' + str(filepath) +
+                   ' due to ValueError with string ' + str(e))
 
-        obj =  exponential_backoff()
-    except Exception, e:
-        #assert False
-        exc_str = str(e)
-        if len(exc_str) > 0:
-            import pdb
-            tb = pdb.traceback.format_exc()
-            raise Exception("Couldn't open '" + str(filepath) +
-                            "' due to: " + str(type(e)) + ', ' + str(e) +
-                            ". Orig traceback:\n" + tb)
-        else:
-            print ("Couldn't open '" + str(filepath) +
-                   "' and exception has no string. Opening it again outside "
-                   "the try/catch so you can see whatever error it prints on "
-                   "its own.")
-            f = open(filepath, 'rb')
-            obj = cPickle.load(f)
-            f.close()
+            obj =  exponential_backoff()
+        except Exception, e:
+            #assert False
+            exc_str = str(e)
+            if len(exc_str) > 0:
+                import pdb
+                tb = pdb.traceback.format_exc()
+                raise Exception("Couldn't open '" + str(filepath) +
+                                "' due to: " + str(type(e)) + ', ' +
+                                str(e) + ". Orig traceback:\n" + tb)
+            else:
+                print ("Couldn't open '" + str(filepath) +
+                       "' and exception has no string. Opening it again "
+                       "outside the try/catch so you can see whatever error "
+                       "it prints on its own.")
+                f = open(filepath, 'rb')
+                obj = cPickle.load(f)
+                f.close()
 
     #if the object has no yaml_src, we give it one that just says it
     #came from this file. could cause trouble if you save obj again
@@ -123,7 +129,11 @@ def save(filepath, obj):
         pickling mechanisms; this results in much faster saves by
         saving arrays as separate .npy files on disk. If the file
         suffix is `.npy` than `numpy.save` is attempted on `obj`.
-        Otherwise, (c)pickle is used.
+        If the suffix is `.ckpt`, `pylearn2.utils.checkpoint.save` is
+        used: arrays are stored as raw blobs next to a small pickled
+        manifest, and are memory-mapped by `load`, which is much faster
+        for large models and avoids holding two copies of them in
+        memory. Otherwise, (c)pickle is used.
 
     obj : object
         A Python object to be serialized.
@@ -178,6 +188,9 @@ def _save(filepath, obj):
         raise IOError("save path %s exists, not a directory" % save_dir)
     elif not os.access(save_dir, os.W_OK):
         raise IOError("permission error creating %s" % filepath)
+    if filepath.endswith('.ckpt'):
+        checkpoint.save(filepath, obj)
+        return
     try:
         if joblib_available and filepath.endswith('.joblib'):
             joblib.dump(obj, filepath)
@@ -0,0 +1,130 @@
+import os
+import struct
+import tempfile
+
+import numpy as np
+from theano import shared
+
+from pylearn2.utils import checkpoint
+from pylearn2.utils import serial
+
+
+class Container(object):
+    pass
+
+
+def test_checkpoint_round_trip():
+    #tests that arrays of various layouts, shared variables and other
+    #python objects survive a save and load, and that an array referred
+    #to twice is still shared after loading
+    rng = np.random.RandomState([1,2,3])
+    obj = Container()
+    obj.W = shared(rng.randn(7, 5).astype('float32'), name='W')
+    obj.F = np.asfortranarray(rng.randn(4, 6))
+    obj.strided = rng.randn(8, 6)[::2, 1::2]
+    obj.ints = np.arange(10, dtype='int16')
+    obj.scalar = np.array(3.5)
+    obj.empty = np.zeros((0, 3))
+    obj.objects = np.array([None, 'a'], dtype=object)
+    obj.alias = [obj.ints, obj.ints]
+    obj.name = 'container'
+
+    fd, path = tempfile.mkstemp(suffix='.ckpt')
+    os.close(fd)
+    try:
+        serial.save(path, obj)
+        assert checkpoint.is_checkpoint(path)
+        for mmap_mode in ['c', None]:
+            loaded = checkpoint.load(path, mmap_mode=mmap_mode)
+            assert np.all(loaded.W.get_value() == obj.W.get_value())
+            assert loaded.W.get_value().dtype == 'float32'
+            for name in ['F', 'strided', 'ints', 'scalar', 'empty']:
+                value = getattr(loaded, name)
+                assert value.shape == getattr(obj, name).shape
+                assert value.dtype == getattr(obj, name).dtype
+                assert np.all(value == getattr(obj, name))
+            assert loaded.F.flags.f_contiguous
+            assert list(loaded.objects) == [None, 'a']
+            assert loaded.alias[0] is loaded.alias[1]
+            assert loaded.alias[0] is loaded.ints
+            assert loaded.name == 'container'
+            #copy-on-write: modifying the loaded arrays leaves the file alone
+            loaded.ints[0] = 100
+        loaded = serial.load(path)
+        assert loaded.ints[0] == 0
+    finally:
+        os.remove(path)
+
+
+def test_newer_version_is_not_retried():
+    #tests that serial.load reports a checkpoint written by a more recent
+    #format version right away, rather than retrying as if it was being
+    #written
+    import time
+
+    fd, path = tempfile.mkstemp(suffix='.ckpt')
+    os.close(fd)
+    try:
+        checkpoint.save(path, np.arange(3.))
+        with open(path, 'r+b') as f:
+            f.seek(len(checkpoint.MAGIC))
+            f.write(struct.pack('<Q', checkpoint.VERSION + 1))
+        start = time.time()
+        try:
+            serial.load(path)
+        except ValueError, e:
+            assert 'more recent' in str(e)
+        else:
+            assert False
+        assert time.time() - start < 1.
+    finally:
+        os.remove(path)
+
+
+def test_snapshot_is_a_copy():
+    #tests that changes made to an object after snapshot returns are not
+    #written
+    obj = Container()
+    obj.W = shared(np.zeros((3, 2)), name='W')
+    obj.record = [1., 2.]
+    snap = checkpoint.snapshot(obj)
+    obj.W.get_value(borrow=True)[...] = 1.
+    obj.record.append(3.)
+
+    fd, path = tempfile.mkstemp(suffix='.pkl')
+    os.close(fd)
+    try:
+        checkpoint.write_snapshot(path, snap)
+        loaded = serial.load(path)
+        assert np.all(loaded.W.get_value() == 0.)
+        assert loaded.record == [1., 2.]
+    finally:
+        os.remove(path)
+
+
+def test_checkpoint_deep_object():
+    #tests that objects nested deeper than the recursion limit allows
+    #pickling (as large theano graphs can be) are saved, as by serial.save
+    import sys
+    import warnings
+
+    #some modules raise the limit when they are imported
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(1000)
+    depth = 1000
+    obj = np.arange(3.)
+    for i in xrange(depth):
+        obj = [obj]
+    fd, path = tempfile.mkstemp(suffix='.ckpt')
+    os.close(fd)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            checkpoint.save(path, obj)
+        loaded = checkpoint.load(path)
+        for i in xrange(depth):
+            loaded = loaded[0]
+        assert np.all(loaded == np.arange(3.))
+    finally:
+        sys.setrecursionlimit(old_limit)
+        os.remove(path)
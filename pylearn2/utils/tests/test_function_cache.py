@@ -0,0 +1,66 @@
+import cPickle
+import shutil
+import tempfile
+
+import numpy as np
+import theano
+from theano import tensor
+
+from pylearn2.base import Block
+from pylearn2.utils import function_cache
+from pylearn2.utils import sharedX
+
+
+def make_graph(W_value):
+    X = tensor.matrix()
+    W = sharedX(W_value, name='W')
+    b = sharedX(np.zeros(2), name='b')
+    return X, W, b, tensor.dot(X, W) + b
+
+
+class Linear(Block):
+    def __init__(self):
+        super(Linear, self).__init__()
+        self.W = sharedX(np.arange(6.).reshape(3, 2), name='W')
+
+    def __call__(self, inputs):
+        return tensor.dot(inputs, self.W)
+
+
+def test_function_cache():
+    #tests that a graph compiled again, in terms of other shared variables,
+    #is loaded from the cache and reads and updates the new variables,
+    #and that a different graph is not
+    cache_dir = tempfile.mkdtemp()
+    old_cache = function_cache.get_cache()
+    try:
+        cache = function_cache.set_cache_dir(cache_dir)
+        ones = np.ones((1, 3), dtype=theano.config.floatX)
+
+        X, W, b, y = make_graph(np.ones((3, 2)))
+        f = function_cache.function([X], y, updates={b: b + 1, W: 2 * W})
+        assert np.allclose(f(ones), 3)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        X, W, b, y = make_graph(np.ones((3, 2)) * 5)
+        f = function_cache.function([X], y, updates={b: b + 1, W: 2 * W})
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert np.allclose(f(ones), 15)
+        assert np.allclose(W.get_value(), 10)
+        assert np.allclose(b.get_value(), 1)
+        assert np.allclose(f(ones), 31)
+
+        function_cache.function([X], y, updates={b: b + 2, W: 2 * W})
+        function_cache.function([X], y.T)
+        assert (cache.hits, cache.misses) == (1, 3)
+
+        # Block.perform on an unpickled model
+        block = Linear()
+        block.perform(ones)
+        block.fn = None
+        block = cPickle.loads(cPickle.dumps(block))
+        assert np.allclose(block.perform(ones), [[6, 9]])
+        assert (cache.hits, cache.misses) == (2, 4)
+    finally:
+        function_cache._cache = old_cache
+        shutil.rmtree(cache_dir)
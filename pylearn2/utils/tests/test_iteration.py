@@ -0,0 +1,54 @@
+import numpy as np
+from theano import config
+
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
+from pylearn2.utils.iteration import ShuffledChunkSubsetIterator
+
+
+def test_shuffled_chunks_visits_each_example_once():
+    iterator = ShuffledChunkSubsetIterator(103, 10, None, rng=[1,2,3],
+                                           chunk_size=25)
+    assert iterator.chunk_size == 30
+    seen = []
+    for batch in iterator:
+        chunk = iterator.chunk
+        assert np.all(batch >= chunk.start)
+        assert np.all(batch < chunk.stop)
+        seen.extend(batch)
+    assert sorted(seen) == range(103)
+
+
+def test_shuffled_chunks_dataset_iterator():
+    #tests that batches gathered from the in-memory chunk are the right
+    #rows of the dataset, with matching targets
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(50,3)
+    y = np.arange(50)
+    dataset = DenseDesignMatrix(X = X, y = y)
+    iterator = dataset.iterator(mode = 'shuffled_chunks', batch_size = 4,
+                                num_batches = 30, targets = True)
+    num_batches = 0
+    for features, targets in iterator:
+        assert np.allclose(features, X[targets])
+        num_batches += 1
+    assert num_batches == 30
+
+
+def test_reused_buffers():
+    #tests that batches assembled into reused buffers have the right
+    #values and dtype, and that the buffers are cycled through rather
+    #than reallocated
+    rng = np.random.RandomState([1,2,3])
+    X = rng.randn(40,3)
+    dataset = DenseDesignMatrix(X = X, y = np.arange(40))
+    for mode in ['sequential', 'random_uniform', 'shuffled_chunks']:
+        iterator = dataset.iterator(mode = mode, batch_size = 8,
+                                    num_batches = 5, targets = True,
+                                    num_buffers = 2)
+        batches = []
+        for features, targets in iterator:
+            assert features.dtype == config.floatX
+            assert np.allclose(features, X[targets])
+            batches.append(features)
+        assert np.may_share_memory(batches[0], batches[2])
+        assert not np.may_share_memory(batches[0], batches[1])
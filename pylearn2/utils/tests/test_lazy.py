@@ -0,0 +1,45 @@
+import cPickle
+
+import numpy as np
+
+from pylearn2.models.model import Model
+from pylearn2.utils import sharedX
+from pylearn2.utils.function_cache import function
+from pylearn2.utils.lazy import lazy_function, reset_lazy_functions
+
+
+class Doubler(Model):
+    def __init__(self):
+        super(Doubler, self).__init__()
+        self.W = sharedX(np.ones(3), name='W')
+        self.compiled = 0
+
+    @lazy_function
+    def double_func(self):
+        self.compiled += 1
+        self.scratch = 'made while compiling'
+        return function([], updates={self.W: 2 * self.W})
+
+
+def test_lazy_function():
+    #tests that the function is compiled on first use only, is not
+    #pickled, and is compiled again after reset_lazy_functions
+    model = Doubler()
+    assert 'double_func' not in model.__dict__
+    model.double_func()
+    model.double_func()
+    assert model.compiled == 1
+    assert np.allclose(model.W.get_value(), 4)
+    assert 'double_func' in model.names_to_del
+    assert 'scratch' in model.names_to_del
+
+    model = cPickle.loads(cPickle.dumps(model))
+    assert 'double_func' not in model.__dict__
+    assert 'scratch' not in model.__dict__
+    model.double_func()
+    assert model.compiled == 2
+    assert np.allclose(model.W.get_value(), 8)
+
+    reset_lazy_functions(model)
+    model.double_func()
+    assert model.compiled == 3
@@ -0,0 +1,47 @@
+import numpy as np
+from theano import shared
+
+from pylearn2.utils.parallel import RowParallelInference, fork_pool
+
+
+class DummyModel(object):
+    def __init__(self):
+        self.W = shared(np.ones((3, 2)), name='W')
+
+    def project_rows(self, X, out, scale):
+        out[...] = scale * np.dot(X, self.W.get_value(borrow=True))
+        return X.shape[0]
+
+
+def test_row_parallel_inference():
+    #tests that the result matches the serial computation and that
+    #changes to the parameters after the pool was created are seen by
+    #the workers
+    model = DummyModel()
+    inference = RowParallelInference(model, 'project_rows', ['W'], 2, 3)
+    X = np.random.RandomState([1,2,3]).randn(7, 3)
+    try:
+        out, counts = inference(X, args=(2.,))
+        assert np.allclose(out, 2. * np.dot(X, model.W.get_value()))
+        assert sum(counts) == 7
+        model.W.set_value(np.arange(6.).reshape(3, 2))
+        out = np.zeros((5, 2))
+        rval, counts = inference(X[:5], out, args=(1.,))
+        assert rval is out
+        assert np.allclose(out, np.dot(X[:5], model.W.get_value()))
+    finally:
+        inference.close()
+
+
+def test_fork_pool():
+    #tests that the workers serve the callable they were forked with,
+    #which need not be picklable
+    offset = np.arange(3.)
+    pool, run_task = fork_pool(lambda x: x + offset, 2)
+    try:
+        results = pool.map(run_task, range(4))
+    finally:
+        pool.close()
+        pool.join()
+    assert all(np.all(result == i + offset)
+               for i, result in enumerate(results))